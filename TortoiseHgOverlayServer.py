@@ -43,10 +43,10 @@ except ImportError, e:
 from mercurial import demandimport
 demandimport.ignore.append('win32com.shell')
 demandimport.enable()
-from mercurial import ui, error
+from mercurial import ui, error, util
 from mercurial.windows import posixfile, unlink, rename
 from tortoisehg.util.i18n import agettext as _
-from tortoisehg.util import thread2, paths, shlib, version
+from tortoisehg.util import thread2, paths, shlib, statusdaemon, version
 
 APP_TITLE = _('TortoiseHg Overlay Icon Server')
 
@@ -247,12 +247,11 @@ PIPEBUFSIZE = 4096
 def getrepos(batch):
     roots = set()
     notifypaths = set()
-    for path in batch:
-        r = paths.find_root(path)
+    for path, r in zip(batch, paths.find_roots(batch)):
         if r is None:
             try:
-                for n in os.listdir(path):
-                    r = paths.find_root(os.path.join(path, n))
+                subpaths = [os.path.join(path, n) for n in os.listdir(path)]
+                for r in paths.find_roots(subpaths):
                     if (r is not None):
                         roots.add(r)
                         notifypaths.add(r)
@@ -265,6 +264,17 @@ def getrepos(batch):
             notifypaths.add(path)
     return roots, notifypaths
 
+def relpaths(root, batch):
+    '''paths of batch below root relative to it, None if one is not'''
+    prefix = os.path.join(root, '')
+    files = []
+    for path in batch:
+        if path.startswith(prefix):
+            files.append(util.pconvert(path[len(prefix):]))
+        elif prefix.startswith(os.path.join(path, '')):
+            return None
+    return files or None
+
 def update_batch(batch):
     '''updates thgstatus for all paths in batch'''
     roots, notifypaths = getrepos(batch)
@@ -280,7 +290,8 @@ def update_batch(batch):
             updated_any = False
             for r in sorted(roots):
                 try:
-                    if shlib.update_thgstatus(_ui, r, wait=False):
+                    files = relpaths(r, batch)
+                    if shlib.update_thgstatus(_ui, r, wait=False, files=files):
                         updated_any = True
                     shlib.shell_notify([r], noassoc=True)
                     logger.msg('Updated ' + r)
@@ -339,30 +350,13 @@ def get_config():
     return (show_taskbaricon, hgighlight_taskbaricon)
 
 def update(args, hwnd):
-    batch = []
     r = args[0]
     print "got update request %s (first in batch)" % r
-    batch.append(r)
     print "wait a bit for additional requests..."
     show, highlight = get_config()
     if show and highlight:
         SetIcon(hwnd, "hgB.ico")
-    time.sleep(0.2)
-    deferred_requests = []
-    try:
-        while True:
-            req = requests.get_nowait()
-            s = req.split('|')
-            cmd, args = s[0], s[1:]
-            if cmd == 'update':
-                print "got update request %s" % req
-                batch.append(args[0])
-            else:
-                deferred_requests.append(req)
-    except Queue.Empty:
-        pass
-    for req in deferred_requests:
-        requests.put(req)
+    batch = statusdaemon.collectbatch(requests, [r])
     msg = "processing batch with %i update requests"
     print msg % len(batch)
     update_batch(batch)
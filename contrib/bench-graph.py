@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# bench-graph.py - Measure time to build revision graphs
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+"""Measure time to build revision graphs of a repository
+
+usage: bench-graph.py [-R REPO] [REVSET]...
+
+The unfiltered graph is built first, then a graph filtered by each REVSET
+as the log view does when a revision set filter is active.
+"""
+import optparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mercurial import hg, ui, revset
+from tortoisehg.hgqt import graph
+
+def buildgraph(repo, **opts):
+    g = graph.Graph(repo, graph.revision_grapher(repo, **opts))
+    start = time.time()
+    while g.build_nodes():
+        pass
+    return g, time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-R REPO] [REVSET]...')
+    parser.add_option('-R', '--repository', default='.',
+                      help='repository to graph (default: current dir)')
+    options, args = parser.parse_args()
+
+    repo = hg.repository(ui.ui(), options.repository)
+    repo = getattr(repo, 'unfiltered', lambda: repo)()
+    g, elapsed = buildgraph(repo)
+    print 'all: %d revisions, %d rows, %.3f sec' % (len(repo), len(g),
+                                                    elapsed)
+
+    for query in args:
+        start = time.time()
+        func = revset.match(repo.ui, query)
+        revs = graph.RevisionSet(func(repo, list(repo)))
+        queryelapsed = time.time() - start
+        if not revs:
+            print '%s: no matches' % query
+            continue
+        g, elapsed = buildgraph(repo, revset=revs)
+        print ('%s: %d revisions, %d rows, query %.3f sec, graph %.3f sec'
+               % (query, len(revs), len(g), queryelapsed, elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -44,7 +44,7 @@ def _thg_path():
         sys.path.insert(0, thgpath)
 _thg_path()
 
-from tortoisehg.util import paths, debugthg, cachethg
+from tortoisehg.util import paths, debugthg, cachethg, statusdaemon
 
 if debugthg.debug('N'):
     debugf = debugthg.debugf
@@ -62,6 +62,7 @@ class HgExtensionDefault(GObject.GObject):
         self.scanStack = []
         self.allvfs = {}
         self.inv_dirs = set()
+        self.usedaemon = False
 
         from tortoisehg.util import menuthg
         self.hgtk = paths.find_in_path(thg_main)
@@ -88,6 +89,15 @@ class HgExtensionDefault(GObject.GObject):
         self.gmon = Gio.file_new_for_path(self.notify).monitor(Gio.FileMonitorFlags.NONE, None)
         self.gmon.connect('changed', self.notified)
 
+        # the status daemon, and thg started from here, notify this file
+        os.environ['THG_NOTIFY'] = self.notify
+        if self.hgtk and statusdaemon.request('states') is None:
+            try:
+                subprocess.Popen([sys.executable, self.hgtk, 'thgstatus',
+                                  '--daemon'], close_fds=True)
+            except OSError, e:
+                debugf(e)
+
     def icon(self, iname):
         return paths.get_tortoise_icon(iname)
 
@@ -114,7 +124,7 @@ class HgExtensionDefault(GObject.GObject):
         Find mercurial repository for vfs_file
         Returns hg.repo
         '''
-        p = paths.find_root(path)
+        p = paths.find_root_cached(path)
         if not p:
             return None
         try:
@@ -228,7 +238,17 @@ class HgExtensionDefault(GObject.GObject):
                                "Version control status"),
 
     def _get_file_status(self, localpath, repo=None):
-        cachestate = cachethg.get_state(localpath, repo)
+        return self._get_files_status([localpath], repo)[0]
+
+    def _get_files_status(self, localpaths, repo=None):
+        states = statusdaemon.query(localpaths)
+        self.usedaemon = states is not None
+        if states is None:
+            # no daemon, run Mercurial here
+            states = [cachethg.get_state(p, repo) for p in localpaths]
+        return [self._status_of_state(st[:1]) for st in states]
+
+    def _status_of_state(self, cachestate):
         cache2state = {cachethg.UNCHANGED:   ('default',   'clean'),
                        cachethg.ADDED:       ('list-add',  'added'),
                        cachethg.MODIFIED:    ('important', 'modified'),
@@ -254,23 +274,24 @@ class HgExtensionDefault(GObject.GObject):
             f.close()
         if not files:
             return
+        if self.usedaemon:
+            statusdaemon.request('update', files)
         root = os.path.commonprefix(files)
-        root = paths.find_root(root)
+        root = paths.find_root_cached(root)
         if root:
             self.invalidate(files, root)
 
     def invalidate(self, paths, root = ''):
         started = bool(self.inv_dirs)
-        if cachethg.cache_pdir == root and root not in self.inv_dirs:
-            cachethg.overlay_cache.clear()
+        if root not in self.inv_dirs:
+            cachethg.invalidate(root)
         self.inv_dirs.update([os.path.dirname(root), '/', ''])
         for path in paths:
             path = os.path.join(root, path)
+            cachethg.invalidate(path)
             while path not in self.inv_dirs:
                 self.inv_dirs.add(path)
                 path = os.path.dirname(path)
-                if cachethg.cache_pdir == path:
-                    cachethg.overlay_cache.clear()
         if started:
             return
         if len(paths) > 1:
@@ -364,19 +385,31 @@ class HgExtensionIcons(HgExtensionDefault):
         if not self.scanStack:
             return False
         try:
-            vfs_file = self.scanStack.pop()
-            path = self.get_path_for_vfs_file(vfs_file, False)
-            if not path:
+            # the daemon answers for many files at once
+            count = self.usedaemon and 64 or 1
+            files = []
+            changed = []
+            while self.scanStack and len(files) < count:
+                vfs_file = self.scanStack.pop()
+                path = self.get_path_for_vfs_file(vfs_file, False)
+                if not path:
+                    continue
+                oldvfs = self.get_vfs(path)
+                if oldvfs and oldvfs != vfs_file:
+                    #file has changed on disc (not invalidated)
+                    self.get_path_for_vfs_file(vfs_file) #save new vfs
+                    self.invalidate([os.path.dirname(path)])
+                    changed.append(path)
+                files.append((vfs_file, path))
+            if changed and self.usedaemon:
+                statusdaemon.request('update', changed)
+            if not files:
                 return True
-            oldvfs = self.get_vfs(path)
-            if oldvfs and oldvfs != vfs_file:
-                #file has changed on disc (not invalidated)
-                self.get_path_for_vfs_file(vfs_file) #save new vfs
-                self.invalidate([os.path.dirname(path)])
-            emblem, status = self._get_file_status(path)
-            if emblem is not None:
-                vfs_file.add_emblem(emblem)
-            vfs_file.add_string_attribute('hg_status', status)
+            statuses = self._get_files_status([p for f, p in files])
+            for (vfs_file, path), (emblem, status) in zip(files, statuses):
+                if emblem is not None:
+                    vfs_file.add_emblem(emblem)
+                vfs_file.add_string_attribute('hg_status', status)
         except StandardError, e:
             debugf(e)
         return True
@@ -0,0 +1,88 @@
+import os
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util import annotatecache
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def lines(annotation):
+    return [(fctx.path(), fctx.rev(), lineno) for fctx, lineno in annotation]
+
+def test_annotate():
+    path = os.path.join(_tmpdir, 'annotate')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'a\nb\nc\n')
+    client.commit('-Am', 'add a')
+    client.fwrite('a', 'a\nB\nc\nd\n')
+    client.commit('-m', 'change a')
+    client.update('0')
+    client.fwrite('a', 'z\na\nb\nc\n')
+    client.commit('-m', 'change a on a branch')
+    client.merge('--tool', 'internal:local')
+    client.fwrite('a', 'z\na\nB\nc\nd\n')
+    client.commit('-m', 'merge')
+    client.rename('a', 'b')
+    client.fappend('b', 'e\n')
+    client.commit('-m', 'rename a')
+
+    repo = hg.repository(ui.ui(), path)
+    cache = annotatecache.AnnotateCache()
+    annotatecache._caches[repo.root] = cache
+    for rev in xrange(len(repo)):
+        for f in repo[rev]:
+            fctx = repo[rev][f]
+            expected = lines(l for l, _text in fctx.annotate(True, True))
+            assert_equal(expected, lines(annotatecache.annotate(fctx)))
+    # the annotation of the requested revision is read back from disk
+    cache._entries.clear()
+    fctx = repo['tip']['b']
+    assert_equal([('a', 2, 1), ('a', 0, 1), ('a', 1, 2), ('a', 0, 3),
+                  ('a', 1, 4), ('b', 4, 6)],
+                 lines(annotatecache.annotate(fctx)))
+    assert_equal(1, len(cache._entries))
+
+def test_annotate_cr():
+    path = os.path.join(_tmpdir, 'annotatecr')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'a\rb\nc\n')
+    client.commit('-Am', 'add a')
+    client.fwrite('a', 'a\rb\nc\rd\n')
+    client.commit('-m', 'change a')
+    client.fappend('a', 'e')
+    client.commit('-m', 'append e')
+
+    repo = hg.repository(ui.ui(), path)
+    annotatecache._caches[repo.root] = annotatecache.AnnotateCache()
+    for rev in xrange(len(repo)):
+        fctx = repo[rev]['a']
+        expected = lines(l for l, _text in fctx.annotate(True, True))
+        assert_equal(expected, lines(annotatecache.annotate(fctx)))
+    # one entry per line shown, bare CRs ending lines, though diff blocks
+    # of lines ending with LF attribute them as filectx.annotate() does
+    assert_equal([('a', 0, 1), ('a', 1, 2), ('a', 2, 3), ('a', 2, 4),
+                  ('a', 2, 5)],
+                 lines(annotatecache.annotate(repo['tip']['a'])))
+
+def test_iterannotate():
+    path = os.path.join(_tmpdir, 'iterannotate')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'a\nb\n')
+    client.commit('-Am', 'add a')
+    client.fappend('a', 'c\n')
+    client.commit('-m', 'append c')
+    client.fwrite('a', 'A\nb\nc\n')
+    client.commit('-m', 'change a')
+
+    repo = hg.repository(ui.ui(), path)
+    annotatecache._caches[repo.root] = annotatecache.AnnotateCache()
+    found = [[(i, fctx.rev(), lineno) for i, fctx, lineno in lines]
+             for lines in annotatecache.iterannotate(repo['tip']['a'])]
+    assert_equal([[(0, 2, 1)], [(2, 1, 3)], [(1, 0, 2)]], found)
@@ -0,0 +1,43 @@
+import os
+from nose.tools import *
+
+from tortoisehg.util import cachethg
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = os.path.realpath(helpers.mktmpdir(__name__))
+
+def createrepo(name):
+    client = helpers.HgClient(os.path.join(_tmpdir, name))
+    client.init()
+    client.ftouch('clean', 'dir/modified')
+    client.commit('-Am', 'add files')
+    client.fappend('dir/modified', 'modified\n')
+    return client
+
+def test_get_states():
+    client = createrepo('states')
+    cachethg.invalidate()
+    assert_equal(cachethg.ROOT, cachethg.get_state(client.path))
+    assert_equal('C', cachethg.get_state(client.wjoin('clean')))
+    assert_equal('M', cachethg.get_state(client.wjoin('dir')))
+    assert_equal('M', cachethg.get_state(client.wjoin('dir/modified')))
+    assert_equal(cachethg.NOT_IN_REPO,
+                 cachethg.get_state(client.wjoin('.hg/dirstate')))
+
+def test_repos_kept():
+    clients = [createrepo('kept%d' % i) for i in xrange(2)]
+    cachethg.invalidate()
+    for client in clients * 2:
+        cachethg.get_state(client.wjoin('clean'))
+    assert_equal([c.path for c in clients],
+                 [e.root for e in cachethg.repo_cache])
+
+def test_dirstate_changed():
+    client = createrepo('dirstate')
+    cachethg.invalidate()
+    assert_equal('M', cachethg.get_state(client.wjoin('dir/modified')))
+    client.commit('-m', 'modify')
+    assert_equal('C', cachethg.get_state(client.wjoin('dir/modified')))
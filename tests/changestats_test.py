@@ -0,0 +1,71 @@
+import os
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util.changestats import ChangeStats, changecounts
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def openrepo(name):
+    return hg.repository(ui.ui(), os.path.join(_tmpdir, name))
+
+def statuscounts(repo, rev):
+    ctx = repo[rev]
+    modified, added, removed = repo.status(ctx.p1().node(), ctx.node())[:3]
+    return len(added), len(modified), len(removed)
+
+def test_changecounts():
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'changecounts'))
+    hg.init()
+    hg.fappend('foo', 'foo0\n')
+    hg.fappend('bar', 'bar0\n')
+    hg.commit('-Am', 'add foo and bar')
+    hg.fappend('foo', 'foo1\n')
+    hg.remove('bar')
+    hg.fappend('baz', 'baz1\n')
+    hg.commit('-Am', 'modify foo, remove bar, add baz')
+    hg.update('0')
+    hg.fappend('qux', 'qux2\n')
+    hg.commit('-Am', 'add qux')
+    hg.merge('1')
+    hg.commit('-m', 'merge')
+    repo = openrepo('changecounts')
+    assert_equal((2, 0, 0), changecounts(repo, 0))
+    assert_equal((1, 1, 1), changecounts(repo, 1))
+    assert_equal((1, 0, 0), changecounts(repo, 2))
+    for rev in repo:
+        assert_equal(statuscounts(repo, rev), changecounts(repo, rev))
+
+def test_changestats():
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'changestats'))
+    hg.init()
+    hg.fappend('foo', 'foo0\n')
+    hg.commit('-Am', 'foo0')
+    hg.fappend('foo', 'foo1\n')
+    hg.commit('-m', 'foo1')
+    repo = openrepo('changestats')
+    stats = ChangeStats(repo)
+    assert_equal([0, 1], stats.pending())
+    assert_equal(None, stats.get(1))
+    stats[1] = changecounts(repo, 1)
+    stats.save()
+
+    # appended revisions are pending, counted ones are kept
+    hg.fappend('foo', 'foo2\n')
+    hg.commit('-m', 'foo2')
+    stats = ChangeStats(openrepo('changestats'))
+    assert_equal([0, 2], stats.pending())
+    assert_equal((0, 1, 0), stats.get(1))
+    stats.save()
+
+    # removed revisions invalidate the stored counts
+    hg.rollback()
+    hg.update('-C', '1')
+    hg.fappend('bar', 'bar2\n')
+    hg.commit('-Am', 'bar2')
+    stats = ChangeStats(openrepo('changestats'))
+    assert_equal([0, 1, 2], stats.pending())
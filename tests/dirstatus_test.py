@@ -0,0 +1,44 @@
+import os
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util import dirstatus
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def test_update():
+    path = os.path.join(_tmpdir, 'update')
+    client = helpers.HgClient(path)
+    client.init()
+    client.ftouch('a/b/modified', 'a/removed', 'c/modified')
+    client.commit('-Am', 'add files')
+    client.fappend('a/b/modified', 'modified\n')
+    client.remove('a/removed')
+    client.ftouch('c/added')
+    client.add('c/added')
+
+    repo = hg.repository(ui.ui(), path)
+    states, full = dirstatus.update(repo)
+    assert full
+    assert_equal({'a/b/modified': 'm', 'a/removed': 'r', 'c/added': 'a'},
+                 states)
+    f = dirstatus.read(path)
+    try:
+        assert_equal(states, f.files())
+        assert_equal('r', f.get(''))
+        assert_equal('r', f.get('a'))
+        assert_equal('m', f.get('a/b'))
+        assert_equal('a', f.get('c'))
+        assert_equal(None, f.get('d'))
+    finally:
+        f.close()
+
+    client.fappend('c/modified', 'modified\n')
+    states, full = dirstatus.update(repo, ['c'])
+    assert not full
+    assert_equal('m', states['c/modified'])
+    assert_equal(4, len(states))
@@ -1,4 +1,4 @@
-import os
+import itertools, os
 from nose.tools import *
 
 from mercurial import hg, ui
@@ -106,3 +106,107 @@ def test_linecolor_filelog():
         0: [],
         }
     assert_equal(expectedtable, actualtable)
+
+def test_graph_index():
+    repo = openrepo('named-branch')
+    g = graph.Graph(repo, graph.revision_grapher(repo))
+    assert_equal(4, g.index(5))  # builds nodes down to rev 5
+    assert_equal(5, g[4].rev)
+    assert_equal(0, g.index(None))
+    while g.build_nodes():
+        pass
+    for row, node in enumerate(g.nodes):
+        assert_equal(row, g.index(node.rev))
+    assert_equal(-1, g.index(9))
+    assert_equal(-1, g.index('unknown.patch'))
+
+def test_graph_append_nodes():
+    repo = openrepo('named-branch')
+    g = graph.Graph(repo, graph.revision_grapher(repo))
+    g.build_nodes(3)
+    g.suspend()
+    assert_true(g.build_nodes(3))
+    assert_equal(3, len(g))
+
+    rows = graph.graph_rows(graph.revision_grapher(repo), g.maxlog)
+    assert_equal([None, 8, 7], [n.rev for n in itertools.islice(rows, 3)])
+    g.append_nodes(list(itertools.islice(rows, 2)), 2)
+    g.resume(rows)
+    while g.build_nodes():
+        pass
+    assert_true(g.isfilled())
+
+    expected = graph.Graph(repo, graph.revision_grapher(repo))
+    while expected.build_nodes():
+        pass
+    assert_equal(buildlayouttable(expected), buildlayouttable(g))
+    assert_equal(expected[4].bottomlines, g[5].toplines)
+
+def test_graphnode_packedlines():
+    lines = [(0, 0, 1, graph.LINE_TYPE_PARENT, (5,), 4),
+             (0, 1, 2, graph.LINE_TYPE_GRAFT, (5,), 2),
+             (1, 2, 3, graph.LINE_TYPE_PARENT, (6, 7), 1)]
+    parents = [(4, graph.LINE_TYPE_PARENT), (2, graph.LINE_TYPE_GRAFT)]
+    node = graph.GraphNode(5, 0, 1, lines, parents)
+    assert_equal(lines, node.bottomlines)
+    assert_equal(parents, node.parents)
+    assert_equal(3, node.cols)
+    assert_equal([], node.toplines)
+
+    child = graph.GraphNode(4, 0, 1, [], [])
+    child.above = node
+    assert_equal(lines, child.toplines)
+    assert_equal([], child.parents)
+
+    filenode = graph.GraphNode(5, 0, 1, lines, [4, 2], extra=['data'])
+    assert_equal([4, 2], filenode.parents)
+
+def buildlayouttable(graph):
+    return [(node.rev, node.x, sorted(l[:2] for l in node.bottomlines))
+            for node in graph.nodes]
+
+def test_layoutcache_appended():
+    helpers.HgClient(_tmpdir).clone('named-branch', 'layout-appended')
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'layout-appended'))
+    repo = openrepo('layout-appended')
+    g = graph.LayoutCache(repo).graph()
+    while g.build_nodes():
+        pass
+
+    hg.fappend('data', 'foo9\n')
+    hg.commit('-m', 'foo9')
+    repo = openrepo('layout-appended')
+    layoutcache = graph.LayoutCache(repo)
+    layout = layoutcache.load()
+    assert_equal(9, layout.revcount)
+    g = layoutcache.graph(layout=layout)
+    assert_true(g.isfilled())
+    assert_true(layout.nodes[-1] is g.nodes[-1])
+
+    expected = graph.Graph(repo, graph.revision_grapher(repo))
+    while expected.build_nodes():
+        pass
+    assert_equal(buildlayouttable(expected), buildlayouttable(g))
+
+def test_layoutcache_extendgraph():
+    helpers.HgClient(_tmpdir).clone('named-branch', 'layout-extended')
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'layout-extended'))
+    repo = openrepo('layout-extended')
+    layoutcache = graph.LayoutCache(repo)
+    oldgraph = layoutcache.graph()
+    oldgraph.build_nodes(nnodes=4)
+    oldnodes = oldgraph.nodes[1:]
+
+    hg.fappend('data', 'foo9\n')
+    hg.commit('-m', 'foo9')
+    layoutcache.repo = repo = openrepo('layout-extended')
+    g = layoutcache.extendgraph(oldgraph)
+    assert_equal([None, 9], [node.rev for node in g.nodes[:2]])
+    assert_true(oldnodes[0] is g.nodes[2])
+    while g.build_nodes():
+        pass
+
+    expected = graph.Graph(repo, graph.revision_grapher(repo))
+    while expected.build_nodes():
+        pass
+    assert_equal(buildlayouttable(expected), buildlayouttable(g))
@@ -0,0 +1,68 @@
+import os, re
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util import grepengine
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def searchall(repo, ctx, pattern, **kwargs):
+    files = sorted(ctx)
+    found = []
+    for count, matches, errors in grepengine.search(repo, ctx,
+                                                    re.compile(pattern),
+                                                    files, **kwargs):
+        found.extend((path, lineno) for path, lineno, l, s in matches)
+    return found
+
+def test_search():
+    path = os.path.join(_tmpdir, 'search')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'foo\nbar\nfoo bar\n')
+    client.fwrite('b', 'bar\r\nfoo\r\n')
+    client.fwrite('binary', 'foo\0')
+    client.commit('-Am', 'add files')
+    client.fwrite('a', 'bar\n')
+
+    repo = hg.repository(ui.ui(), path)
+    for kwargs in ({}, {'minfiles': 0, 'workers': 2, 'shardsize': 1}):
+        assert_equal([('a', 1), ('a', 3), ('b', 2)],
+                     searchall(repo, repo['tip'], '^foo', **kwargs))
+        assert_equal([('a', 1), ('b', 2)],
+                     searchall(repo, repo['tip'], 'foo', once=True,
+                               **kwargs))
+        assert_equal([('b', 2)],
+                     searchall(repo, repo[None], 'foo$', **kwargs))
+
+def test_searchhistory():
+    path = os.path.join(_tmpdir, 'searchhistory')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'foo\nbar\n')
+    client.commit('-Am', 'add a')
+    client.fwrite('a', 'bar\nfoo baz\n')
+    client.commit('-m', 'change a')
+    client.rename('a', 'b')
+    client.commit('-m', 'rename a')
+
+    repo = hg.repository(ui.ui(), path)
+    regexp = re.compile('foo')
+    paths = grepengine.changedfiles(repo)
+    assert_equal(['a', 'b'], paths)
+    for kwargs in ({}, {'minfiles': 0, 'workers': 2, 'shardsize': 1}):
+        changes = []
+        for count, c, errors in grepengine.searchhistory(repo, regexp, paths,
+                                                         **kwargs):
+            changes.extend(c)
+        assert_equal([('a', 1, 1, '-', 'foo'), ('a', 1, 2, '+', 'foo baz'),
+                      ('a', 0, 1, '+', 'foo'), ('b', 2, 2, '+', 'foo baz')],
+                     changes)
+    changes = []
+    for count, c, errors in grepengine.searchhistory(repo, regexp, ['b'], 2):
+        changes.extend(c)
+    assert_equal([], changes)
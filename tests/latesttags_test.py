@@ -0,0 +1,57 @@
+import os
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util.latesttags import LatestTags
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def openrepo(name):
+    return hg.repository(ui.ui(), os.path.join(_tmpdir, name))
+
+def alltags(repo):
+    latesttags = LatestTags(repo)
+    return [latesttags[r] for r in xrange(len(repo))]
+
+def test_latesttags():
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'latesttags'))
+    hg.init()
+    hg.fappend('data', 'foo0\n')
+    hg.commit('-Am', 'foo0')
+    hg.tag('-r', '0', '1.0')
+    hg.fappend('data', 'foo2\n')
+    hg.commit('-m', 'foo2')
+    hg.update('0')
+    hg.fappend('other', 'bar3\n')
+    hg.commit('-Am', 'bar3')
+    hg.tag('-l', 'local')
+    hg.merge('2')
+    hg.commit('-m', 'merge4')
+    assert_equal([('1.0', 0), ('1.0', 1), ('1.0', 2), ('1.0', 1),
+                  ('1.0', 2)], alltags(openrepo('latesttags')))
+
+    # appended revisions are computed from the stored tags
+    hg.fappend('data', 'foo5\n')
+    hg.commit('-m', 'foo5')
+    assert_equal(('1.0', 3), alltags(openrepo('latesttags'))[5])
+
+    # a new tag invalidates the stored ones
+    hg.tag('-r', '2', '2.0')
+    assert_equal([('1.0', 0), ('1.0', 1), ('2.0', 0), ('1.0', 1),
+                  ('2.0', 1), ('2.0', 2), ('2.0', 3)],
+                 alltags(openrepo('latesttags')))
+
+def test_latesttags_null():
+    hg = helpers.HgClient(os.path.join(_tmpdir, 'latesttags-null'))
+    hg.init()
+    hg.fappend('data', 'foo0\n')
+    hg.commit('-Am', 'foo0')
+    hg.fappend('data', 'foo1\n')
+    hg.commit('-m', 'foo1')
+    latesttags = LatestTags(openrepo('latesttags-null'))
+    assert_equal(('null', 2), latesttags[1])
+    assert_equal(('null', 0), latesttags[-1])
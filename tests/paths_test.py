@@ -0,0 +1,33 @@
+import os
+from nose.tools import *
+
+from tortoisehg.util import paths
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = os.path.realpath(helpers.mktmpdir(__name__))
+
+def mkdirs(*names):
+    for name in names:
+        os.makedirs(os.path.join(_tmpdir, name))
+
+def test_find_roots():
+    mkdirs('roots/repo/.hg', 'roots/repo/dir', 'roots/repo/nested/.hg',
+           'roots/other')
+    files = [os.path.join(_tmpdir, 'roots', f) for f in
+             ('repo', 'repo/dir', 'repo/dir/file', 'repo/nested/file',
+              'other/file')]
+    expected = [paths.find_root(f) for f in files]
+    assert_equal(expected, paths.RootCache().find(files))
+
+def test_root_created():
+    mkdirs('created/dir')
+    cache = paths.RootCache()
+    dirpath = os.path.join(_tmpdir, 'created', 'dir')
+    filepath = os.path.join(dirpath, 'file')
+    assert_equal([paths.find_root(dirpath)] * 2,
+                 cache.find([dirpath, filepath]))
+    mkdirs('created/dir/.hg')
+    assert_equal([dirpath, dirpath], cache.find([dirpath, filepath]))
@@ -0,0 +1,32 @@
+import os, re
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.hgqt import grep
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def test_search_subrepo():
+    path = os.path.join(_tmpdir, 'subrepo')
+    client = helpers.HgClient(path)
+    client.init()
+    subclient = helpers.HgClient(os.path.join(path, 'sub'))
+    subclient.init()
+    subclient.fwrite('f', 'foo in sub\n')
+    subclient.commit('-Am', 'add f')
+    client.fwrite('.hgsub', 'sub = sub\n')
+    client.fwrite('f', 'bar\n')
+    client.commit('-Am', 'add sub')
+
+    repo = hg.repository(ui.ui(), path)
+    thread = grep.CtxSearchThread(repo, re.compile('foo'), repo[None], [],
+                                  [], False, True)
+    rows = []
+    thread.matchedRow.connect(lambda w: rows.append(w.data[:2]))
+    thread.run()
+    assert thread.completed
+    assert_equal([[os.path.join('sub', 'f'), 1]], rows)
@@ -0,0 +1,60 @@
+import os, sys, time, unittest
+from nose.plugins.skip import SkipTest
+from PyQt4.QtCore import QCoreApplication
+from tortoisehg.hgqt import thgrepo
+
+import helpers
+
+def setup():
+    if not sys.platform.startswith('linux'):
+        raise SkipTest
+
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def waitevents():
+    time.sleep(0.05)
+    QCoreApplication.processEvents()
+
+class InotifyWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.watcher = thgrepo.InotifyWatcher()
+        self.changed = []
+        self.watcher.directoryChanged.connect(self.changed.append)
+        self.watcher.fileChanged.connect(self.changed.append)
+        self.dir = os.path.join(_tmpdir, self.id())
+        os.mkdir(self.dir)
+
+    def test_coalesce_events(self):
+        self.watcher.addPath(self.dir)
+        for i in xrange(100):
+            open(os.path.join(self.dir, str(i)), 'w').close()
+        waitevents()
+        self.assertEqual([self.dir], self.changed)
+
+    def test_watch_file(self):
+        path = os.path.join(self.dir, 'file')
+        open(path, 'w').close()
+        self.watcher.addPath(path)
+        self.assertEqual([path], self.watcher.files())
+        self.assertEqual([], self.watcher.directories())
+        open(path, 'a').write('data')
+        waitevents()
+        self.assertEqual([path], self.changed)
+
+    def test_removed_file(self):
+        path = os.path.join(self.dir, 'file')
+        open(path, 'w').close()
+        self.watcher.addPath(path)
+        os.unlink(path)
+        waitevents()
+        self.assertEqual([path], self.changed)
+        self.assertEqual([], self.watcher.files())
+
+    def test_remove_paths(self):
+        self.watcher.addPath(self.dir)
+        self.watcher.removePaths([self.dir])
+        self.assertEqual([], self.watcher.directories())
+        open(os.path.join(self.dir, 'file'), 'w').close()
+        waitevents()
+        self.assertEqual([], self.changed)
@@ -0,0 +1,69 @@
+import os, unittest
+from tortoisehg.hgqt import thgrepo
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+class RepoWatcherTest(unittest.TestCase):
+    def setUp(self):
+        path = os.path.join(_tmpdir, self.id())
+        self.hg = hg = helpers.HgClient(path)
+        hg.init()
+        hg.ftouch('foo')
+        hg.commit('-Am', 'add foo')
+        self.repo = thgrepo.repository(path=path)
+        self.watcher = thgrepo.RepoWatcher(self.repo)
+        self.changes = []
+        self.watcher.repositoryChanged.connect(self.changes.append)
+
+    def test_commit(self):
+        self.hg.fwrite('foo', 'foo\n')
+        self.hg.commit('-m', 'modify foo')
+        self.watcher.pollStatus()
+        self.assertEqual(1, len(self.changes))
+        self.assertTrue(self.changes[0] & thgrepo.CHANGE_CHANGELOG)
+        self.assertTrue(self.changes[0] & thgrepo.CHANGE_DIRSTATE)
+        self.assertFalse(self.changes[0] & thgrepo.CHANGE_BOOKMARKS)
+
+    def test_bookmark(self):
+        self.hg.bookmark('-r', '0', 'mark')
+        self.watcher.pollStatus()
+        self.assertEqual([thgrepo.CHANGE_BOOKMARKS], self.changes)
+
+    def test_no_change(self):
+        self.watcher.pollStatus()
+        self.assertEqual([], self.changes)
+        self.assertEqual(0, self.watcher.signalsEmitted)
+
+class ThgInvalidateTest(unittest.TestCase):
+    def setUp(self):
+        path = os.path.join(_tmpdir, self.id())
+        hg = helpers.HgClient(path)
+        hg.init()
+        hg.ftouch('foo')
+        hg.commit('-Am', 'add foo')
+        self.repo = thgrepo.repository(path=path)
+
+    def test_counts(self):
+        self.repo.thginvalidate(thgrepo.CHANGE_BOOKMARKS)
+        self.repo.thginvalidate(thgrepo.CHANGE_BOOKMARKS
+                                | thgrepo.CHANGE_PHASES)
+        counts = self.repo.thginvalidatecounts
+        self.assertEqual(2, counts['bookmarks'])
+        self.assertEqual(1, counts['phases'])
+        self.assertEqual(0, counts['changelog'])
+
+    def test_keep_unaffected_caches(self):
+        self.repo.tabwidth
+        self.repo._branchheads
+        self.repo.thginvalidate(thgrepo.CHANGE_BOOKMARKS)
+        self.assertTrue('tabwidth' in self.repo.__dict__)
+        self.assertTrue('_branchheads' in self.repo.__dict__)
+        self.repo.thginvalidate(thgrepo.CHANGE_CHANGELOG)
+        self.assertTrue('tabwidth' in self.repo.__dict__)
+        self.assertFalse('_branchheads' in self.repo.__dict__)
+        self.repo.thginvalidate()
+        self.assertFalse('tabwidth' in self.repo.__dict__)
@@ -0,0 +1,51 @@
+import unittest
+from PyQt4.QtCore import QObject, Qt
+from tortoisehg.hgqt import status
+
+OPTS = dict(modified=True, added=True, removed=True, deleted=True,
+            unknown=True, clean=True, ignored=False, subrepo=True)
+
+class Parent(QObject):
+    partials = {}
+
+class WctxModelTest(unittest.TestCase):
+    def setUp(self):
+        self.parent = Parent()
+        self.model = status.WctxModel(None, {}, None, True, OPTS, {},
+                                      self.parent)
+
+    def paths(self):
+        return [row[status.COL_PATH] for row in self.model.getAllRows()]
+
+    def test_batches_sorted(self):
+        m = self.model
+        m.sort(status.COL_STATUS, Qt.AscendingOrder)
+        m.addFiles([('b', 'C', 1), ('a', '?', 1)])
+        m.addFiles([('c', 'M', 1), ('A', 'C', None), ('i', 'I', 1)])
+        self.assertEqual(['c', 'a', 'A', 'b'], self.paths())
+
+    def test_sort_descending(self):
+        m = self.model
+        m.addFiles([('x.c', 'M', 1), ('y.py', 'M', 1), ('z.c', 'M', 1)])
+        m.sort(status.COL_EXTENSION, Qt.DescendingOrder)
+        # ties are still sorted by ascending path
+        self.assertEqual(['y.py', 'x.c', 'z.c'], self.paths())
+        m.sort(status.COL_PATH_DISPLAY, Qt.DescendingOrder)
+        self.assertEqual(['z.c', 'y.py', 'x.c'], self.paths())
+
+    def test_filter(self):
+        m = self.model
+        m.sort(status.COL_PATH_DISPLAY, Qt.AscendingOrder)
+        m.addFiles([('Foo/a', 'M', 1), ('bar/b', 'M', 1)])
+        m.setFilter(u'foo')
+        self.assertEqual(['Foo/a'], self.paths())
+        # rows added while filtered
+        m.addFiles([('foo/c', 'A', 1), ('bar/d', 'A', 1)])
+        self.assertEqual(['Foo/a', 'foo/c'], self.paths())
+        m.setFilter(u'')
+        self.assertEqual(['bar/b', 'bar/d', 'Foo/a', 'foo/c'], self.paths())
+
+    def test_checked(self):
+        m = self.model
+        m.addFiles([('m', 'M', 1), ('u', '?', 1), ('d', '!', None)])
+        self.assertEqual({'m': True, 'u': False, 'd': False}, m.getChecked())
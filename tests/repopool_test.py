@@ -0,0 +1,73 @@
+import os
+from nose.tools import *
+
+from mercurial import ui
+from tortoisehg.util.repopool import RepoPool
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def createrepo(name):
+    path = os.path.join(_tmpdir, name)
+    hg = helpers.HgClient(path)
+    hg.init()
+    hg.ftouch('foo')
+    hg.commit('-Am', 'add foo')
+    return hg, path
+
+def test_reuse():
+    hg, path = createrepo('reuse')
+    pool = RepoPool()
+    repo1 = pool.acquire(ui.ui(), path)
+    repo2 = pool.acquire(ui.ui(), path)
+    assert repo1 is not repo2
+    pool.release(repo1)
+    assert pool.acquire(ui.ui(), path) is repo1
+    assert_equal({'idle': 0, 'inuse': 2, 'opened': 2, 'reused': 1},
+                 pool.stats())
+
+def test_ui_restored():
+    hg, path = createrepo('ui')
+    pool = RepoPool()
+    repo = pool.acquire(ui.ui(), path)
+    repo.ui.setconfig('ui', 'username', 'changed by job')
+    pool.release(repo)
+    repo = pool.acquire(ui.ui(), path)
+    assert_not_equal('changed by job', repo.ui.config('ui', 'username'))
+
+def test_other_ui():
+    hg, path = createrepo('otherui')
+    pool = RepoPool()
+    repo = pool.acquire(ui.ui(), path)
+    pool.release(repo)
+    otherui = ui.ui()
+    otherui.setconfig('ui', 'username', 'other')
+    newrepo = pool.acquire(otherui, path)
+    assert newrepo is not repo
+    assert_equal('other', newrepo.ui.config('ui', 'username'))
+    pool.release(newrepo)
+    assert pool.acquire(ui.ui(), path) is repo
+
+def test_outdated():
+    hg, path = createrepo('outdated')
+    pool = RepoPool()
+    repo = pool.acquire(ui.ui(), path)
+    pool.release(repo)
+    hg.fappend('foo', 'foo\n')
+    hg.commit('-m', 'modify foo')
+    newrepo = pool.acquire(ui.ui(), path)
+    assert newrepo is not repo
+    assert_equal(2, len(newrepo))
+    assert_equal(0, pool.stats()['idle'])
+
+def test_maxidle():
+    hg, path = createrepo('maxidle')
+    pool = RepoPool(maxidle=1)
+    repos = [pool.acquire(ui.ui(), path) for i in xrange(3)]
+    for repo in repos:
+        pool.release(repo)
+    assert_equal(1, pool.stats()['idle'])
+    assert pool.acquire(ui.ui(), path) is repos[-1]
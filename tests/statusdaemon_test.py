@@ -0,0 +1,75 @@
+import os, socket, threading, time
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+from mercurial import ui
+from tortoisehg.util import statusdaemon
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def waitfor(func, timeout=10):
+    deadline = time.time() + timeout
+    while not func():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.05)
+
+def test_parserequest():
+    assert_equal(('update', ['/a']),
+                 statusdaemon.parserequest(
+                     statusdaemon.formatrequest('update', ['/a'])))
+
+def test_serve():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SkipTest
+    root = os.path.realpath(os.path.join(_tmpdir, 'repo'))
+    client = helpers.HgClient(root)
+    client.init()
+    client.ftouch('clean', 'dir/modified')
+    client.commit('-Am', 'add files')
+    client.fappend('dir/modified', 'modified\n')
+    client.ftouch('unknown')
+
+    sockpath = os.path.join(_tmpdir, 'sock')
+    assert_equal(None, statusdaemon.query([root], sockpath))
+    thread = threading.Thread(target=statusdaemon.serve,
+                              args=(ui.ui(), sockpath))
+    thread.start()
+    try:
+        waitfor(lambda: statusdaemon.request('states', (), sockpath)
+                is not None)
+        files = [os.path.join(root, f) for f in
+                 ('clean', 'dir', 'dir/modified', 'unknown', '.hg')]
+        waitfor(lambda: statusdaemon.query(files, sockpath)[0])
+        states = statusdaemon.query(files + [root, _tmpdir], sockpath)
+        assert_equal(['C', 'M', 'M', '?', ' ', 'r', ' '],
+                     [st[:1] for st in states])
+    finally:
+        statusdaemon.request('terminate', (), sockpath)
+        thread.join()
+    assert not os.path.exists(sockpath)
+
+def test_outdated_states():
+    root = os.path.realpath(os.path.join(_tmpdir, 'outdated'))
+    client = helpers.HgClient(root)
+    client.init()
+    client.ftouch('a')
+    path = os.path.join(root, 'a')
+    index = statusdaemon.StatusIndex(ui.ui())
+    index.update([root])
+    assert_equal(['?'], [st[:1] for st in index.states([path])])
+    assert index.requests.empty()
+
+    client.commit('-Am', 'add a')
+    # the previous states are replied until they are computed again
+    assert_equal(['?'], [st[:1] for st in index.states([path])])
+    assert_equal(('update', [root]),
+                 statusdaemon.parserequest(index.requests.get_nowait()))
+    index.states([path])
+    assert index.requests.empty()
+    index.update([root])
+    assert_equal(['C'], [st[:1] for st in index.states([path])])
@@ -0,0 +1,86 @@
+import os
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+from mercurial import hg, ui
+from tortoisehg.util import statusengine
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def openrepo(name):
+    return hg.repository(ui.ui(), os.path.join(_tmpdir, name))
+
+def test_status():
+    path = os.path.join(_tmpdir, 'status')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('.hgignore', 'syntax: glob\nignored*\n')
+    client.ftouch('clean', 'modified', 'removed', 'deleted', 'dir/clean',
+                  'ignoreddir/tracked')
+    client.add('ignoreddir/tracked')
+    client.commit('-Am', 'add files')
+    client.fappend('modified', 'modified\n')
+    client.remove('removed')
+    os.unlink(os.path.join(path, 'deleted'))
+    client.ftouch('added', 'unknown', 'ignored', 'dir/unknown',
+                  'ignoreddir/ignored', 'nested/.hg/hgrc', 'nested/file')
+    client.add('added')
+
+    repo = openrepo('status')
+    if not statusengine.supported(repo):
+        raise SkipTest
+    found = []
+    status, sizes = statusengine.status(repo, ignored=True, clean=True,
+                                        report=found.extend)
+    expected = repo.status(ignored=True, clean=True, unknown=True)
+    assert_equal([sorted(l) for l in expected], status)
+    assert_equal(sorted(sum(status, [])), sorted(f for f, st, sz in found))
+    assert_equal(len('modified\n'), sizes['modified'])
+    assert 'deleted' not in sizes
+
+def test_status_unlisted():
+    client = helpers.HgClient(os.path.join(_tmpdir, 'unlisted'))
+    client.init()
+    client.ftouch('clean')
+    client.commit('-Am', 'add clean')
+    client.ftouch('unknown')
+    repo = openrepo('unlisted')
+    if not statusengine.supported(repo):
+        raise SkipTest
+    status, sizes = statusengine.status(repo, unknown=False)
+    assert_equal([[], [], [], [], [], [], []], status)
+
+def test_status_cache():
+    path = os.path.join(_tmpdir, 'cache')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('.hgignore', 'syntax: glob\nignored\n')
+    # not modified in the second of the commit, thus clean in the dirstate
+    os.utime(client.wjoin('.hgignore'), (0, 0))
+    client.fwrite('same', 'a\n')
+    client.commit('-Am', 'add same')
+    # same size and mode as committed, and not modified meanwhile
+    client.fwrite('same', 'b\n')
+    os.utime(client.wjoin('same'), (0, 0))
+    client.ftouch('unknown', 'ignored')
+
+    repo = openrepo('cache')
+    if not statusengine.supported(repo):
+        raise SkipTest
+    cache = statusengine.StatusCache()
+    first = statusengine.status(repo, ignored=True, cache=cache)[0]
+    assert_equal(0, cache.hits)
+    second = statusengine.status(repo, ignored=True, cache=cache)[0]
+    assert_equal(first, second)
+    assert_equal(cache.misses, cache.hits)
+    assert_equal([['same'], [], [], [], ['unknown'], ['ignored'], []], second)
+
+    # entries of changed files are computed again
+    client.fwrite('same', 'a\n')
+    os.utime(client.wjoin('same'), (1, 1))
+    third = statusengine.status(repo, ignored=True, cache=cache)[0]
+    assert_equal([[], [], [], [], ['unknown'], ['ignored'], []], third)
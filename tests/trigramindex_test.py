@@ -0,0 +1,42 @@
+import os, re
+from nose.tools import *
+
+from mercurial import hg, ui
+from tortoisehg.util import trigramindex
+
+import helpers
+
+def setup():
+    global _tmpdir
+    _tmpdir = helpers.mktmpdir(__name__)
+
+def test_candidates():
+    path = os.path.join(_tmpdir, 'candidates')
+    client = helpers.HgClient(path)
+    client.init()
+    client.fwrite('a', 'Foo bar\n')
+    client.fwrite('b', 'baz\n')
+    client.fwrite('c', 'foobar\0')
+    client.commit('-Am', 'add files')
+    client.fwrite('b', 'baz foo\n')
+
+    repo = hg.repository(ui.ui(), path)
+    index = trigramindex.TrigramIndex()
+    index.update(repo)
+    assert_equal(2, len(index))
+    files = ['a', 'b', 'c']
+    tip = repo['tip']
+    assert_equal(['a', 'c'],
+                 index.candidates(tip, re.compile('foo|xyzzy'), files))
+    assert_equal(['c'], index.candidates(tip, re.compile('quux'), files))
+    assert_equal(files, index.candidates(tip, re.compile('fo+'), files))
+    # modified files of the working directory are not indexed
+    assert_equal(['a', 'b', 'c'],
+                 index.candidates(repo[None], re.compile('foo'), files))
+
+    index.save(repo)
+    loaded = trigramindex.TrigramIndex()
+    loaded.load(repo)
+    assert_equal(2, len(loaded))
+    assert_equal(['a', 'c'],
+                 loaded.candidates(tip, re.compile('foo'), files))
@@ -5,9 +5,9 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-from mercurial import error, hg, merge as mergemod
+from mercurial import error, merge as mergemod
 
-from tortoisehg.util import hglib
+from tortoisehg.util import hglib, repopool
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qtlib, csinfo, i18n, cmdui, status, resolve
 from tortoisehg.hgqt import qscilib, thgrepo, messageentry
@@ -643,11 +643,17 @@ class ResultPage(BasePage):
 class CheckThread(QThread):
     def __init__(self, repo, parent):
         QThread.__init__(self, parent)
-        self.repo = hg.repository(repo.ui, repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.results = (False, 1)
         self.canceled = False
 
     def run(self):
+        try:
+            self._check()
+        finally:
+            repopool.release(self.repo)
+
+    def _check(self):
         self.repo.dirstate.invalidate()
         unresolved = False
         for root, path, status in thgrepo.recursiveMergeStatus(self.repo):
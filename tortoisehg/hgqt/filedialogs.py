@@ -606,13 +606,13 @@ class FileDiffDialog(_AbstractFileDialog):
             self.goto(self.filerevmodel.graph[0].rev)
 
     def onRevisionSelected(self, rev):
-        if rev is None or rev not in self.filerevmodel.graph.nodesdict:
+        if rev is None or rev not in self.filerevmodel.graph.rowdict:
             return
         if self.sender() is self.tableView_revisions_right:
             side = 'right'
         else:
             side = 'left'
-        path = self.filerevmodel.graph.nodesdict[rev].extra[0]
+        path = self.filerevmodel.graph.filename(rev)
         fc = self.repo.changectx(rev).filectx(path)
         data = hglib.tounicode(fc.data())
         self.filedata[side] = data.splitlines()
@@ -51,6 +51,7 @@ class FileRevModel(HgRepoListModel):
     def setRepo(self, repo, branch='', fromhead=None, follow=False):
         self.repo = repo
         self._datacache = {}
+        self.invalidateCache()
         self.reloadConfig()
 
     def setFilename(self, filename):
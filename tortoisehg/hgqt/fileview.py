@@ -8,10 +8,11 @@
 import os
 import difflib
 import re
+import time
 
 from mercurial import util, patch
 
-from tortoisehg.util import hglib, colormap, thread2
+from tortoisehg.util import annotatecache, hglib, colormap
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qscilib, qtlib, blockmatcher, lexers
 from tortoisehg.hgqt import visdiff, filedata
@@ -998,11 +999,13 @@ class AnnotateView(qscilib.Scintilla):
         self._links = []  # by line
         self._anncache = {}  # by rev
         self._revmarkers = {}  # by rev
+        self._colormarkers = {}  # by color
         self._lastrev = None
+        self._annfctx = None
 
         diffopts = patch.diffopts(repo.ui, section='annotate')
         self._thread = AnnotateThread(self, diffopts=diffopts)
-        self._thread.finished.connect(self.fillModel)
+        self._thread.linesAnnotated.connect(self._addAnnotations)
 
         self._initAnnotateOptionActions()
 
@@ -1104,13 +1107,16 @@ class AnnotateView(qscilib.Scintilla):
         if line < 0:
             return
         try:
-            fctx = self._links[line][0]
-            if fctx.rev() != self._lastrev:
-                s = hglib.get_revision_desc(fctx, self.annfile)
-                self.showMessage.emit(s)
-                self._lastrev = fctx.rev()
+            link = self._links[line]
         except IndexError:
-            pass
+            return
+        if link is None:
+            return  # not annotated yet
+        fctx = link[0]
+        if fctx.rev() != self._lastrev:
+            s = hglib.get_revision_desc(fctx, self.annfile)
+            self.showMessage.emit(s)
+            self._lastrev = fctx.rev()
 
     def _updateannotation(self, ctx, filename):
         if ctx.rev() is None:
@@ -1123,17 +1129,35 @@ class AnnotateView(qscilib.Scintilla):
         self.ctx = ctx
         self.annfile = filename
         self._thread.abort()
-        self._thread.start(ctx[filename])
+        self._annfctx = ctx[filename]
+        self._links = []
+        self._anncache.clear()
+        self._revmarkers.clear()
+        self._colormarkers.clear()
+        self.clearMarginText()
+        self.markerDeleteAll()
+        self._thread.start(self._annfctx)
+
+    @pyqtSlot(object)
+    def _addAnnotations(self, data):
+        fctx, lines = data
+        if fctx is not self._annfctx:
+            return  # of the file annotated before
+        size = max(i for i, _linkfctx, _origline in lines) + 1
+        if size > len(self._links):
+            self._links.extend([None] * (size - len(self._links)))
+        for i, linkfctx, origline in lines:
+            self._links[i] = (linkfctx, origline)
+
+        indexes = [i for i, _linkfctx, _origline in lines]
+        self._updaterevmargin(indexes)
+        self._updatemarkers(indexes)
+        self._updatemarginwidth()
 
     @pyqtSlot()
     def fillModel(self):
-        self._thread.wait()
-        if self._thread.data is None:
+        if not self._links:
             return
-
-        self._links = list(self._thread.data)
-        self._anncache.clear()
-
         self._updaterevmargin()
         self._updatemarkers()
         self._updatemarginwidth()
@@ -1155,8 +1179,9 @@ class AnnotateView(qscilib.Scintilla):
         """True if annotation enabled and available"""
         return self._annotation_enabled
 
-    def _updaterevmargin(self):
-        """Update the content of margin area showing revisions"""
+    def _updaterevmargin(self, lines=None):
+        """Update the content of margin area showing revisions, of the
+        given lines or of all of them"""
         s = self._margin_style
         # Workaround to set style of the current sci widget.
         # QsciStyle sends style data only to the first sci widget.
@@ -1167,35 +1192,59 @@ class AnnotateView(qscilib.Scintilla):
                            s.style(), s.font().family().toAscii().data())
         self.SendScintilla(qsci.SCI_STYLESETSIZE,
                            s.style(), s.font().pointSize())
-        for i, (fctx, _origline) in enumerate(self._links):
-            self.setMarginText(i, self._lineannotation(fctx), s)
-
-    def _updatemarkers(self):
-        """Update markers which colorizes each line"""
-        self._redefinemarkers()
-        for i, (fctx, _origline) in enumerate(self._links):
-            m = self._revmarkers.get(fctx.rev())
+        if lines is None:
+            lines = xrange(len(self._links))
+        for i in lines:
+            link = self._links[i]
+            if link is not None:
+                self.setMarginText(i, self._lineannotation(link[0]), s)
+
+    def _updatemarkers(self, lines=None):
+        """Update markers which colorizes each line, of the given lines
+        unless the colors of the other lines changed"""
+        if not self._redefinemarkers() or lines is None:
+            self.markerDeleteAll()
+            lines = xrange(len(self._links))
+        for i in lines:
+            link = self._links[i]
+            if link is None:
+                continue
+            m = self._revmarkers.get(link[0].rev())
             if m is not None:
                 self.markerAdd(i, m)
 
     def _redefinemarkers(self):
-        """Redefine line markers according to the current revs"""
+        """Redefine line markers according to the current revs, and
+        tell whether the revs marked before kept their markers"""
         curdate = self.ctx.date()[0]
 
         # make sure to colorize at least 1 year
         mindate = curdate - 365 * 24 * 60 * 60
 
-        self._revmarkers.clear()
-        filectxs = iter(fctx for fctx, _origline in self._links)
+        maxcolors = 32
+        filectxs = iter(link[0] for link in self._links if link is not None)
         palette = colormap.makeannotatepalette(filectxs, curdate,
-                                               maxcolors=32, maxhues=8,
+                                               maxcolors=maxcolors, maxhues=8,
                                                maxsaturations=16,
                                                mindate=mindate)
-        for i, (color, fctxs) in enumerate(palette.iteritems()):
-            self.markerDefine(qsci.Background, i)
-            self.setMarkerBackgroundColor(QColor(color), i)
+        # colors keep their marker as more lines are annotated
+        colormarkers = dict((color, i) for color, i
+                            in self._colormarkers.iteritems()
+                            if color in palette)
+        free = sorted(set(xrange(maxcolors)) - set(colormarkers.values()))
+        revmarkers = {}
+        for color, fctxs in palette.iteritems():
+            if color not in colormarkers:
+                i = colormarkers[color] = free.pop(0)
+                self.markerDefine(qsci.Background, i)
+                self.setMarkerBackgroundColor(QColor(color), i)
             for fctx in fctxs:
-                self._revmarkers[fctx.rev()] = i
+                revmarkers[fctx.rev()] = colormarkers[color]
+        kept = util.all(revmarkers.get(rev) == i
+                        for rev, i in self._revmarkers.iteritems())
+        self._colormarkers = colormarkers
+        self._revmarkers = revmarkers
+        return kept
 
     @util.propertycache
     def _margin_style(self):
@@ -1222,40 +1271,43 @@ class AnnotateView(qscilib.Scintilla):
 
 class AnnotateThread(QThread):
     'Background thread for annotating a file at a revision'
+    # (annotated fctx, [(line index, fctx, original line number), ...])
+    linesAnnotated = pyqtSignal(object)
+
+    # lines found within this many seconds are sent at once
+    _interval = 0.1
+
     def __init__(self, parent=None, diffopts=None):
         super(AnnotateThread, self).__init__(parent)
-        self._threadid = None
         self._diffopts = diffopts
+        self._aborted = False
 
     @pyqtSlot(object)
     def start(self, fctx):
         self._fctx = fctx
+        self._aborted = False
         super(AnnotateThread, self).start()
-        self.data = None
 
     @pyqtSlot()
     def abort(self):
-        threadid = self._threadid
-        if threadid is None:
-            return
-        try:
-            thread2._async_raise(threadid, KeyboardInterrupt)
-            self.wait()
-        except ValueError:
-            pass
+        self._aborted = True
+        self.wait()
 
     def run(self):
         assert self.currentThread() != qApp.thread()
-        self._threadid = self.currentThreadId()
-        try:
-            try:
-                data = []
-                for (fctx, line), _text in \
-                        self._fctx.annotate(True, True, self._diffopts):
-                    data.append((fctx, line))
-                self.data = data
-            except KeyboardInterrupt:
-                pass
-        finally:
-            self._threadid = None
-            del self._fctx
+        fctx = self._fctx
+        del self._fctx
+        lines = []
+        lastsent = 0
+        # the walk is abandoned with the generator, which holds no resource
+        for found in annotatecache.iterannotate(fctx, self._diffopts):
+            if self._aborted:
+                return
+            lines.extend(found)
+            now = time.time()
+            if lines and now - lastsent >= self._interval:
+                self.linesAnnotated.emit((fctx, lines))
+                lines = []
+                lastsent = now
+        if lines:
+            self.linesAnnotated.emit((fctx, lines))
@@ -27,8 +27,11 @@ are used by repomodel.py which renders them on a widget.
 import time
 import os
 import itertools
+import marshal
+import array
 
-from mercurial import repoview
+from mercurial import bundlerepo, repoview, util
+from mercurial.node import nullid
 
 LINE_TYPE_PARENT = 0
 LINE_TYPE_GRAFT = 1
@@ -40,12 +43,15 @@ def revision_grapher(repo, **opts):
     opt   start_rev  Tip-most revision of range to graph
     opt   stop_rev   0-most revision of range to graph
     opt   follow     True means graph only ancestors of start_rev
-    opt   revset     set of revisions to graph.
+    opt   revset     set of revisions to graph, RevisionSet or iterable.
                      If used, then start_rev, stop_rev, and follow is ignored
     opt   branch     Only graph this branch
     opt   allparents If set in addition to branch, then cset outside the
                      branch that are ancestors to some cset inside the branch
                      is also graphed
+    opt   knowncolors Dict of rev: color to seed the color palette with,
+                     used to extend a previously built layout
+    opt   nextcolor  First color to assign to new lanes
 
     This generator function walks through the revision history from
     revision start_rev to revision stop_rev (which must be less than
@@ -71,8 +77,10 @@ def revision_grapher(repo, **opts):
     else:
         revhidden = repoview.filterrevs(repo, 'visible')
     if revset:
-        start_rev = max(revset)
-        stop_rev = min(revset)
+        if not isinstance(revset, RevisionSet):
+            revset = RevisionSet(revset)
+        start_rev = revset.max()
+        stop_rev = revset.min()
         follow = False
         hidden = lambda rev: (rev not in revset) or (rev in revhidden)
     else:
@@ -96,7 +104,8 @@ def revision_grapher(repo, **opts):
             return [x for x in ctx.parents()
                     if x and x.branch() == branch]
 
-    rev_color = RevColorPalette(getparents)
+    rev_color = RevColorPalette(getparents, opts.get('knowncolors'),
+                                opts.get('nextcolor', 0))
 
     while curr_rev is None or curr_rev >= stop_rev:
         if hidden(curr_rev):
@@ -263,19 +272,80 @@ def filelog_grapher(repo, path):
         if heads and rev <= heads[-1]:
             rev = heads.pop()
 
+def graph_rows(grapher, maxlog):
+    """Filter the nodes of `grapher` that make rows of a graph of the
+    first `maxlog` revisions"""
+    for gnode in grapher:
+        if gnode is None:
+            continue
+        if not type(gnode.rev) == str and gnode.rev >= maxlog:
+            continue
+        yield gnode
+
 def mq_patch_grapher(repo):
     """Graphs unapplied MQ patches"""
     for patchname in reversed(repo.thgmqunappliedpatches):
         yield GraphNode(patchname, 0, "", [], [])
 
+class RevisionSet(object):
+    """Immutable set of changelog revisions, iterated tip-most first
+
+    Revisions are kept in a sorted array and a bitmap, so that membership
+    test, min(), max() and len() are O(1) whatever the size of the set.
+
+    >>> revs = RevisionSet([3, 10, 5, 3])
+    >>> list(revs), len(revs), revs[0]
+    ([10, 5, 3], 3, 10)
+    >>> revs.min(), revs.max()
+    (3, 10)
+    >>> 5 in revs, 4 in revs, 11 in revs, None in revs, 'qtip' in revs
+    (True, False, False, False, False)
+    >>> bool(RevisionSet()), 0 in RevisionSet()
+    (False, False)
+    """
+
+    def __init__(self, revs=()):
+        self._revs = array.array('i', sorted(set(revs), reverse=True))
+        if self._revs:
+            self._bits = array.array('B', [0]) * ((self._revs[0] >> 3) + 1)
+        else:
+            self._bits = array.array('B')
+        bits = self._bits
+        for rev in self._revs:
+            bits[rev >> 3] |= 1 << (rev & 7)
+
+    def __contains__(self, rev):
+        if type(rev) is not int or rev < 0 or (rev >> 3) >= len(self._bits):
+            return False
+        return bool(self._bits[rev >> 3] & (1 << (rev & 7)))
+
+    def __iter__(self):
+        return iter(self._revs)
+
+    def __len__(self):
+        return len(self._revs)
+
+    def __getitem__(self, idx):
+        return self._revs[idx]
+
+    def min(self):
+        if not self._revs:
+            raise ValueError('empty revision set')
+        return self._revs[-1]
+
+    def max(self):
+        if not self._revs:
+            raise ValueError('empty revision set')
+        return self._revs[0]
+
 class RevColorPalette(object):
     """Assign node and line colors for each revision"""
 
-    def __init__(self, getparents):
+    def __init__(self, getparents, knowncolors=None, nextcolor=0):
         self._getparents = getparents
         self._pendingheads = []
-        self._knowncolors = {}
-        self._nextcolor = 0
+        self._knowncolors = dict(knowncolors or {})
+        self._nextcolor = nextcolor
 
     def addheadctx(self, ctx):
         color = self.assigncolor(ctx.rev())
@@ -322,9 +392,15 @@ class RevColorPalette(object):
 
 class GraphNode(object):
     """
-    Simple class to encapsulate a hg node in the revision graph. Does
-    nothing but declaring attributes.
+    Simple class to encapsulate a hg node in the revision graph.
+
+    Fully built graphs hold one node per revision, so nodes keep their
+    lines packed in an int array and only materialize them as tuples when
+    accessed. `toplines` are the bottom lines of the node `above`.
     """
+    __slots__ = ('rev', 'x', 'color', 'cols', 'extra', 'above',
+                 '_linedata', '_linechildren', '_parents')
+
     def __init__(self, rev, xposition, color, lines, parents, ncols=None,
                  extra=None):
         self.rev = rev
@@ -333,10 +409,50 @@ class GraphNode(object):
         if ncols is None:
             ncols = len(lines)
         self.cols = ncols
-        self.parents = parents
-        self.bottomlines = lines
-        self.toplines = []
         self.extra = extra
+        self.above = None
+        self.bottomlines = lines
+        self.parents = parents
+
+    def _getbottomlines(self):
+        data = self._linedata
+        return [tuple(data[i:i + 4]) + (children, data[i + 4])
+                for i, children in zip(xrange(0, len(data), 5),
+                                       self._linechildren)]
+
+    def _setbottomlines(self, lines):
+        data = array.array('i')
+        for start, end, color, linetype, _children, rev in lines:
+            data.extend((start, end, color, linetype, rev))
+        self._linedata = data
+        self._linechildren = tuple(l[4] for l in lines)
+
+    bottomlines = property(_getbottomlines, _setbottomlines)
+
+    @property
+    def toplines(self):
+        if self.above is None:
+            return []
+        return self.above.bottomlines
+
+    def _ownparents(self):
+        data = self._linedata
+        return [(data[i + 4], data[i + 3]) for i in xrange(0, len(data), 5)
+                if data[i] == self.x]
+
+    def _getparents(self):
+        if self._parents is None:
+            # the common case of revision_grapher(), derived from the lines
+            return self._ownparents()
+        return list(self._parents)
+
+    def _setparents(self, parents):
+        if parents == self._ownparents():
+            self._parents = None
+        else:
+            self._parents = tuple(parents)
+
+    parents = property(_getparents, _setparents)
 
 class Graph(object):
     """
@@ -354,8 +470,10 @@ class Graph(object):
         else:
             self.grapher = grapher
         self.nodes = []
-        self.nodesdict = {}
+        self.rowdict = {}  # rev: row of its node in self.nodes
         self.max_cols = 0
+        self.layoutcache = None
+        self.suspended = False
 
     def __getitem__(self, idx):
         if isinstance(idx, slice):
@@ -373,6 +491,12 @@ class Graph(object):
         # len(graph) is the number of actually built graph nodes
         return len(self.nodes)
 
+    def _appendnode(self, gnode):
+        if self.nodes:
+            gnode.above = self.nodes[-1]
+        self.rowdict[gnode.rev] = len(self.nodes)
+        self.nodes.append(gnode)
+
     def build_nodes(self, nnodes=None, rev=None):
         """
         Build up to `nnodes` more nodes in our graph, or build as many
@@ -383,6 +507,8 @@ class Graph(object):
         """
         if self.grapher is None:
             return False
+        if self.suspended:
+            return True
 
         usetimer = nnodes is None and rev is None
         if usetimer:
@@ -400,10 +526,7 @@ class Graph(object):
                 continue
             if not type(gnode.rev) == str and gnode.rev >= self.maxlog:
                 continue
-            if self.nodes:
-                gnode.toplines = self.nodes[-1].bottomlines
-            self.nodes.append(gnode)
-            self.nodesdict[gnode.rev] = gnode
+            self._appendnode(gnode)
             mcol = mcol.union(set([gnode.x]))
             mcol = mcol.union(set([max(x[:2]) for x in gnode.bottomlines]))
             if rev is not None and gnode.rev <= rev:
@@ -422,23 +545,325 @@ class Graph(object):
             stopped = True
 
         self.max_cols = max(mcol) + 1
+        if stopped and self.layoutcache:
+            self.layoutcache.save(self)
         return not stopped
 
     def isfilled(self):
         return self.grapher is None
 
+    #
+    # Building in another thread
+    #
+
+    def suspend(self):
+        """Stop building nodes until resume(), so that another grapher of
+        the same revisions can build them and add them by append_nodes()"""
+        self.suspended = True
+
+    def append_nodes(self, nodes, maxcol):
+        """Add nodes following the ones built so far, `maxcol` being the
+        highest column they use"""
+        for gnode in nodes:
+            self._appendnode(gnode)
+        self.max_cols = max(self.max_cols, maxcol + 1)
+
+    def resume(self, grapher):
+        """Continue building nodes with `grapher`, which must yield the
+        nodes following the ones built so far; None if all are built"""
+        self.suspended = False
+        self.grapher = grapher
+        if grapher is None and self.layoutcache:
+            self.layoutcache.save(self)
+
     def index(self, rev):
         if len(self) == 0: # graph is empty, let's build some nodes
             self.build_nodes(10)
-        if rev is not None and len(self) > 0 and rev < self.nodes[-1].rev:
-            self.build_nodes(self.nodes[-1].rev - rev)
-        if rev in self.nodesdict:
-            return self.nodes.index(self.nodesdict[rev])
-        return -1
+        if type(rev) is int and rev not in self.rowdict and len(self) > 0:
+            lastrev = self.nodes[-1].rev
+            if type(lastrev) is not int:
+                # only MQ patches or the working directory built so far
+                lastrev = self.maxlog
+            if rev < lastrev:
+                self.build_nodes(lastrev - rev)
+        return self.rowdict.get(rev, -1)
+
+    #
+    # Layout reuse
+    #
+
+    def layout(self, tipnode, hiddenrevs):
+        """Snapshot the layout of the revisions built so far
+
+        Returns None if no revision node has been built yet.
+        """
+        for i, gnode in enumerate(self.nodes):
+            if type(gnode.rev) is int:
+                break
+        else:
+            return None
+        if i > 0:
+            lanes = _lanestate(self.nodes[i - 1])
+        else:
+            lanes = []
+        return GraphLayout(tipnode, self.maxlog, hiddenrevs, self.max_cols,
+                           lanes, self.nodes[i:], self.grapher)
+
+    def reuse_layout(self, layout):
+        """Build the nodes of revisions newer than `layout` and adopt its
+        nodes for the older ones
+
+        The grapher must have been seeded with layout.knowncolors(). Returns
+        False, leaving `layout` untouched, if the edges entering the layout
+        no longer match, in which case the graph has to be built from
+        scratch.
+        """
+        for gnode in self.grapher:
+            if gnode is None:
+                continue
+            if type(gnode.rev) is int and gnode.rev < layout.revcount:
+                break
+            if not type(gnode.rev) == str and gnode.rev >= self.maxlog:
+                continue
+            self._appendnode(gnode)
+        else:
+            if layout.nodes:
+                return False
+
+        if self.nodes:
+            lastnode = self.nodes[-1]
+        else:
+            lastnode = None
+        lanes = _lanestate(lastnode)
+        if [l[:3] for l in lanes] != [l[:3] for l in layout.lanes]:
+            return False
+
+        # children of a lane are referenced by every line down to its rev
+        fixups = [(rev, oldchildren, children) for (rev, _lt, _c, children),
+                  (_r, _olt, _oc, oldchildren) in zip(lanes, layout.lanes)
+                  if children != oldchildren]
+        if fixups and layout.grapher is not None:
+            if not layout.nodes:
+                return False
+            lowestrev = layout.nodes[-1].rev
+            if util.any(rev < lowestrev for rev, _o, _c in fixups):
+                return False  # lane continues into unbuilt nodes
+        for rev, oldchildren, children in fixups:
+            _replacechildren(layout.nodes, rev, oldchildren, children)
+
+        if layout.nodes:
+            layout.nodes[0].above = lastnode
+        start = len(self.nodes)
+        for row, gnode in enumerate(layout.nodes):
+            self.rowdict[gnode.rev] = start + row
+        self.nodes.extend(layout.nodes)
+        self.grapher = layout.grapher
+        mcol = [self.max_cols - 1, layout.maxcols - 1]
+        for gnode in self.nodes[:len(self.nodes) - len(layout.nodes)]:
+            mcol.append(gnode.x)
+            mcol.extend(max(x[:2]) for x in gnode.bottomlines)
+        self.max_cols = max(mcol) + 1
+        return True
 
     #
     # File graph method
     #
 
     def filename(self, rev):
-        return self.nodesdict[rev].extra[0]
+        return self.nodes[self.rowdict[rev]].extra[0]
+
+def _lanestate(gnode):
+    """Describe the edges leaving `gnode` as a list of
+    (rev, line_type, color, children), one per column of the next row"""
+    if gnode is None:
+        return []
+    lanes = {}
+    # revision_grapher() appends the node's own children to an existing lane
+    # when they share a parent, so process the node's lines last
+    for start, end, color, line_type, children, rev in sorted(
+            gnode.bottomlines, key=lambda l: l[0] == gnode.x):
+        if end in lanes:
+            _rev, plinetype, pcolor, pchildren = lanes[end]
+            lanes[end] = (rev, min(plinetype, line_type), pcolor,
+                          pchildren + children)
+        else:
+            lanes[end] = (rev, line_type, color, children)
+    return [lanes[i] for i in sorted(lanes)]
+
+def _replacechildren(nodes, rev, oldchildren, children):
+    """Update the children of the lane of `rev` in nodes above that rev"""
+    n = len(oldchildren)
+    for gnode in nodes:
+        if gnode.rev == rev:
+            return
+        lines = gnode.bottomlines
+        changed = False
+        for i, l in enumerate(lines):
+            if l[5] == rev and l[4][:n] == oldchildren:
+                lines[i] = l[:4] + (children + l[4][n:], rev)
+                changed = True
+        if changed:
+            gnode.bottomlines = lines
+
+class GraphLayout(object):
+    """
+    Lane and color layout of the revisions below `revcount`, as built
+    for the changelog whose last revision was `tipnode`. `lanes` are the
+    edges entering the first of `nodes`, and `grapher` the generator of
+    the nodes not built yet (None if the layout is complete).
+    """
+    def __init__(self, tipnode, revcount, hiddenrevs, maxcols, lanes, nodes,
+                 grapher=None):
+        self.tipnode = tipnode
+        self.revcount = revcount
+        self.hiddenrevs = frozenset(hiddenrevs)
+        self.maxcols = maxcols
+        self.lanes = lanes
+        self.nodes = nodes
+        self.grapher = grapher
+        colors = [c for _r, _lt, c, _ch in lanes]
+        colors.extend(gnode.color for gnode in nodes)
+        if nodes:
+            # lanes still open at the last built node
+            colors.extend(l[2] for l in nodes[-1].bottomlines)
+        self.nextcolor = max([-1] + colors) + 1
+
+    def knowncolors(self):
+        return dict((rev, color) for rev, _lt, color, _ch in self.lanes)
+
+LAYOUT_CACHE_VERSION = 1
+
+class LayoutCache(object):
+    """
+    Create revision graphs that reuse the layout of a previously built
+    graph, so that only revisions appended since have to be laid out.
+
+    The layout of fully built graphs is persisted under .hg/cache/, one
+    file per combination of branch, allparents and showhidden options.
+    """
+    def __init__(self, repo, branch=None, allparents=False,
+                 showhidden=False):
+        self.repo = repo
+        self._opts = dict(branch=branch, allparents=allparents,
+                          showhidden=showhidden)
+        key = '%s\0%d\0%d' % (branch or '', bool(allparents),
+                              bool(showhidden))
+        self._path = 'cache/thggraph-%s' % util.sha1(key).hexdigest()[:12]
+        self._tipnode = nullid
+        self._hiddenrevs = frozenset()
+
+    def _persistent(self):
+        return not isinstance(self.repo, bundlerepo.bundlerepository)
+
+    def graph(self, include_mq=False, layout=None):
+        """Return a new Graph, reusing `layout` or the stored one if they
+        are still valid for the repository"""
+        self._readrepostate()
+        if layout is None:
+            layout = self.load()
+        if layout:
+            graph = self._reusedgraph(layout, include_mq)
+            if graph:
+                return graph
+        grapher = revision_grapher(self.repo, **self._opts)
+        graph = Graph(self.repo, grapher, include_mq=include_mq)
+        graph.layoutcache = self
+        return graph
+
+    def extendgraph(self, graph, include_mq=False):
+        """Return a new Graph adopting the nodes of `graph`, which must have
+        been created by this cache, and laying out the revisions appended
+        since; None if `graph` cannot be extended
+
+        `graph` must not be used after a new Graph is returned.
+        """
+        layout = graph.layout(self._tipnode, self._hiddenrevs)
+        self._readrepostate()
+        if not layout:
+            return None
+        return self._reusedgraph(layout, include_mq)
+
+    def _readrepostate(self):
+        repo = self.repo
+        if len(repo):
+            self._tipnode = repo.changelog.node(len(repo) - 1)
+        else:
+            self._tipnode = nullid
+        if self._opts['showhidden']:
+            self._hiddenrevs = frozenset()
+        else:
+            self._hiddenrevs = frozenset(repoview.filterrevs(repo, 'visible'))
+
+    def _reusedgraph(self, layout, include_mq):
+        if not self._isvalid(layout):
+            return None
+        grapher = revision_grapher(self.repo,
+                                   knowncolors=layout.knowncolors(),
+                                   nextcolor=layout.nextcolor,
+                                   **self._opts)
+        graph = Graph(self.repo, grapher, include_mq=include_mq)
+        if not graph.reuse_layout(layout):
+            return None
+        graph.layoutcache = self
+        if graph.isfilled() and layout.revcount != graph.maxlog:
+            self.save(graph)
+        return graph
+
+    def _isvalid(self, layout):
+        cl = self.repo.changelog
+        if layout.revcount > len(cl):
+            return False
+        if layout.revcount and cl.node(layout.revcount - 1) != layout.tipnode:
+            return False
+        hiddenrevs = frozenset(r for r in self._hiddenrevs
+                               if r < layout.revcount)
+        return layout.hiddenrevs == hiddenrevs
+
+    def load(self):
+        """Read the stored layout; None if missing or unreadable"""
+        if not self._persistent():
+            return None
+        try:
+            f = self.repo.opener(self._path, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(data, tuple) or len(data) != 7
+            or data[0] != LAYOUT_CACHE_VERSION):
+            return None
+        _version, tipnode, revcount, hiddenrevs, maxcols, lanes, nodedata = data
+        nodes = []
+        above = None
+        for rev, x, color, lines, parents in nodedata:
+            gnode = GraphNode(rev, x, color, lines, parents)
+            gnode.above = above
+            above = gnode
+            nodes.append(gnode)
+        return GraphLayout(tipnode, revcount, hiddenrevs, maxcols, lanes,
+                           nodes)
+
+    def save(self, graph):
+        """Store the layout of the fully built `graph`"""
+        if not self._persistent() or not graph.isfilled():
+            return
+        layout = graph.layout(self._tipnode, self._hiddenrevs)
+        if not layout:
+            return
+        nodedata = [(n.rev, n.x, n.color, n.bottomlines, n.parents)
+                    for n in layout.nodes]
+        data = (LAYOUT_CACHE_VERSION, layout.tipnode, layout.revcount,
+                tuple(sorted(layout.hiddenrevs)), layout.maxcols,
+                layout.lanes, nodedata)
+        try:
+            f = self.repo.opener(self._path, 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+        except (EnvironmentError, ValueError):
+            pass
@@ -8,11 +8,12 @@
 import os
 import re
 
-from mercurial import ui, hg, error, commands, match, util, subrepo
+from mercurial import error, match, subrepo
 
 from tortoisehg.hgqt import htmlui, visdiff, qtlib, htmldelegate, thgrepo, cmdui, settings
 from tortoisehg.hgqt import filedialogs, fileview
-from tortoisehg.util import paths, hglib, thread2
+from tortoisehg.util import grepengine, paths, hglib, repopool
+from tortoisehg.util import trigramindex
 from tortoisehg.hgqt.i18n import _
 
 from PyQt4.QtCore import *
@@ -377,73 +378,75 @@ class HistorySearchThread(QThread):
 
     def __init__(self, repo, pattern, icase, inc, exc, follow):
         super(HistorySearchThread, self).__init__()
-        self.repo = hg.repository(repo.ui, repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.pattern = pattern
         self.icase = icase
         self.inc = inc
         self.exc = exc
         self.follow = follow
+        self.canceled = False
         self.completed = False
 
     def cancel(self):
-        if self.isRunning() and hasattr(self, 'thread_id'):
-            try:
-                thread2._async_raise(self.thread_id, KeyboardInterrupt)
-            except ValueError:
-                pass
+        self.canceled = True
 
     def run(self):
+        try:
+            self.searchHistory()
+            if self.canceled:
+                self.showMessage.emit(_('Interrupted'))
+            else:
+                self.completed = True
+        except Exception, e:
+            self.showMessage.emit(hglib.tounicode(str(e)))
+        repopool.release(self.repo)
+
+    def searchHistory(self):
+        topic = _('Searching')
+        unit = _('files')
         haskbf = settings.hasExtension('kbfiles')
         haslf = settings.hasExtension('largefiles')
-        self.thread_id = int(QThread.currentThreadId())
-
-        def emitrow(row):
-            w = DataWrapper(row)
-            self.matchedRow.emit(w)
-        def emitprog(topic, pos, item, unit, total):
-            self.progress.emit(topic, pos, item, unit, total)
-        class incrui(ui.ui):
-            fullmsg = ''
-            def write(self, msg, *args, **opts):
-                self.fullmsg += msg
-                if self.fullmsg.count('\0') >= 6:
-                    try:
-                        fname, line, rev, addremove, user, text, tail = \
-                                self.fullmsg.split('\0', 6)
-                        if haslf and thgrepo.isLfStandin(fname):
-                            raise ValueError
-                        if (haslf or haskbf) and thgrepo.isBfStandin(fname):
-                            raise ValueError
-                        text = hglib.tounicode(text)
-                        text = Qt.escape(text)
-                        text = '<b>%s</b> <span>%s</span>' % (addremove, text)
-                        fname = hglib.tounicode(fname)
-                        user = hglib.tounicode(user)
-                        row = [fname, int(rev), int(line), user, text]
-                        emitrow(row)
-                    except ValueError:
-                        pass
-                    self.fullmsg = tail
-            def progress(topic, pos, item='', unit='', total=None):
-                emitprog(topic, pos, item, unit, total)
-        cwd = os.getcwd()
-        os.chdir(self.repo.root)
-        self.progress.emit(*cmdui.startProgress(_('Searching'), _('history')))
+        regexp = re.compile(self.pattern, self.icase and re.I or 0)
+        matchfn = match.match(self.repo.root, '', [], self.inc, self.exc)
+        startrev = None
+        if self.follow:
+            startrev = self.repo['.'].rev()
+        files = []
+        for wfile in grepengine.changedfiles(self.repo, startrev):
+            if haslf and thgrepo.isLfStandin(wfile):
+                continue
+            if (haslf or haskbf) and thgrepo.isBfStandin(wfile):
+                continue
+            if matchfn(wfile):
+                files.append(wfile)
+        total = len(files)
+        count = 0
+        self.progress.emit(topic, count, '', unit, total)
+        users = {}
+        results = grepengine.searchhistory(self.repo, regexp, files, startrev)
         try:
-            # hg grep [-i] -afn regexp
-            opts = {'all':True, 'user':True, 'follow':self.follow,
-                    'rev':[], 'line_number':True, 'print0':True,
-                    'ignore_case':self.icase, 'include':self.inc,
-                    'exclude':self.exc}
-            u = incrui()
-            commands.grep(u, self.repo, self.pattern, **opts)
-        except Exception, e:
-            self.showMessage.emit(str(e))
-        except KeyboardInterrupt:
-            self.showMessage.emit(_('Interrupted'))
-        self.progress.emit(*cmdui.stopProgress(_('Searching')))
-        os.chdir(cwd)
-        self.completed = True
+            for searched, changes, errors in results:
+                if self.canceled:
+                    break
+                for wfile in errors:
+                    self.showMessage.emit(_('Skipping %s, unable to read') %
+                                          hglib.tounicode(wfile))
+                for wfile, rev, lineno, change, line in changes:
+                    if rev not in users:
+                        user = self.repo[rev].user()
+                        users[rev] = hglib.tounicode(
+                            self.repo.ui.shortuser(user))
+                    text = Qt.escape(hglib.tounicode(line))
+                    text = '<b>%s</b> <span>%s</span>' % (change, text)
+                    row = [hglib.tounicode(wfile), lineno, rev, users[rev],
+                           text]
+                    self.matchedRow.emit(DataWrapper(row))
+                count += searched
+                self.progress.emit(topic, count, files[count - 1], unit,
+                                   total)
+        finally:
+            results.close()
+        self.progress.emit(topic, None, '', '', None)
 
 class CtxSearchThread(QThread):
     '''Background thread for searching a changectx'''
@@ -453,13 +456,14 @@ class CtxSearchThread(QThread):
 
     def __init__(self, repo, regexp, ctx, inc, exc, once, recurse):
         super(CtxSearchThread, self).__init__()
-        self.repo = hg.repository(repo.ui, repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.regexp = regexp
         self.ctx = ctx
         self.inc = inc
         self.exc = exc
         self.once = once
         self.recurse = recurse
+        self.useindex = repo.ui.configbool('tortoisehg', 'grepindex')
         self.canceled = False
         self.completed = False
 
@@ -479,49 +483,60 @@ class CtxSearchThread(QThread):
             self.completed = True
         except Exception, e:
             self.showMessage.emit(hglib.tounicode(str(e)))
+        repopool.release(self.repo)
 
     def searchRepo(self, ctx, prefix, matchfn):
         topic = _('Searching')
         unit = _('files')
-        total = len(ctx.manifest())
-        count = 0
         haskbf = settings.hasExtension('kbfiles')
         haslf = settings.hasExtension('largefiles')
+        files = []
         for wfile in ctx:                # walk manifest
-            if self.canceled:
-                break
             if haslf and thgrepo.isLfStandin(wfile):
                 continue
             if (haslf or haskbf) and thgrepo.isBfStandin(wfile):
                 continue
-            self.progress.emit(topic, count, wfile, unit, total)
-            count += 1
-            if not matchfn(wfile):
-                continue
-            try:
-                data = ctx[wfile].data()     # load file data
-            except EnvironmentError:
-                self.showMessage.emit(_('Skipping %s, unable to read') %
-                                      hglib.tounicode(wfile))
-                continue
-            if util.binary(data):
-                continue
-            for i, line in enumerate(data.splitlines()):
-                pos = 0
-                for m in self.regexp.finditer(line): # perform regexp
-                    self.hu.write(line[pos:m.start()], label='ui.status')
-                    self.hu.write(line[m.start():m.end()], label='grep.match')
-                    pos = m.end()
-                if pos:
+            if matchfn(wfile):
+                files.append(wfile)
+        index = None
+        if self.useindex:
+            index = trigramindex.getindex(ctx._repo)
+            files = index.candidates(ctx, self.regexp, files)
+        total = len(files)
+        count = 0
+        self.progress.emit(topic, count, '', unit, total)
+        repo = self.repo
+        if ctx._repo.root != repo.root:
+            repo = ctx._repo  # a subrepository
+        results = grepengine.search(repo, ctx, self.regexp, files,
+                                    self.once)
+        try:
+            for searched, matches, errors in results:
+                if self.canceled:
+                    break
+                for wfile in errors:
+                    self.showMessage.emit(_('Skipping %s, unable to read') %
+                                          hglib.tounicode(wfile))
+                for wfile, lineno, line, spans in matches:
+                    pos = 0
+                    for start, end in spans:
+                        self.hu.write(line[pos:start], label='ui.status')
+                        self.hu.write(line[start:end], label='grep.match')
+                        pos = end
                     self.hu.write(line[pos:], label='ui.status')
                     path = os.path.join(prefix, wfile)
-                    row = [hglib.tounicode(path), i + 1, ctx.rev(), None,
+                    row = [hglib.tounicode(path), lineno, ctx.rev(), None,
                            hglib.tounicode(self.hu.getdata()[0])]
                     w = DataWrapper(row)
                     self.matchedRow.emit(w)
-                    if self.once:
-                        break
+                count += searched
+                self.progress.emit(topic, count, files[count - 1], unit,
+                                   total)
+        finally:
+            results.close()
         self.progress.emit(topic, None, '', '', None)
+        if index is not None:
+            index.updateasync(ctx._repo.ui, ctx._repo.root)
 
         if ctx.rev() is None and self.recurse:
             for s in ctx.substate:
@@ -7,9 +7,9 @@
 
 import os
 
-from mercurial import hg, ui, mdiff, similar, patch
+from mercurial import mdiff, similar, patch
 
-from tortoisehg.util import hglib, shlib, thread2
+from tortoisehg.util import hglib, repopool, shlib, thread2
 
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qtlib, htmlui, cmdui
@@ -399,7 +399,7 @@ class RenameSearchThread(QThread):
 
     def __init__(self, repo, ufiles, minpct, copies):
         super(RenameSearchThread, self).__init__()
-        self.repo = hg.repository(ui.ui(), repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.ufiles = ufiles
         self.minpct = minpct
         self.copies = copies
@@ -416,6 +416,8 @@ class RenameSearchThread(QThread):
         try:
             try:
                 self.search(self.repo)
+                # an interrupted repository may be left in any state
+                repopool.release(self.repo)
             except KeyboardInterrupt:
                 pass
             except Exception, e:
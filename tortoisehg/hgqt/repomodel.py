@@ -14,15 +14,17 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import binascii, os, re
+import binascii, itertools, os, re, threading, time
 
-from mercurial import util, error
+from mercurial import bundlerepo, error, util
 from mercurial.util import propertycache
 from mercurial.context import workingctx
 
-from tortoisehg.util import hglib
-from tortoisehg.hgqt.graph import Graph
-from tortoisehg.hgqt.graph import revision_grapher
+from tortoisehg.util import hglib, repopool
+from tortoisehg.util.changestats import ChangeStats, changecounts
+from tortoisehg.util.latesttags import LatestTags
+from tortoisehg.hgqt.graph import Graph, LayoutCache, RevisionSet
+from tortoisehg.hgqt.graph import revision_grapher, graph_rows
 from tortoisehg.hgqt.graph import LINE_TYPE_GRAFT
 from tortoisehg.hgqt import qtlib
 from tortoisehg.hgqt.qreorder import writeSeries
@@ -125,6 +127,279 @@ def _parsebranchcolors(value):
         colors.append((key, val))
     return colors
 
+def _revisionset(revs):
+    if isinstance(revs, RevisionSet):
+        return revs
+    return RevisionSet(revs or ())
+
+def _firstrevrow(graph, maxrev):
+    """Row of the first revision below maxrev built in graph, or None"""
+    for row, gnode in enumerate(graph.nodes):
+        if type(gnode.rev) is int and gnode.rev < maxrev:
+            return row
+
+class GraphCell(object):
+    """What the graph column of a row is drawn from: the line segments
+    and the node glyph, which are looked up in the pixmap cache of the
+    model by HgRepoListModel.paintgraph()"""
+    __slots__ = ('width', 'segments', 'x', 'glyph')
+
+    def __init__(self, width, segments, x, glyph):
+        self.width = width
+        self.segments = segments
+        self.x = x
+        self.glyph = glyph
+
+class _LRUCache(object):
+    """Mapping of at most maxsize items, dropping the least recently used
+    half of them when full
+
+    >>> c = _LRUCache(4)
+    >>> for k in 'abcd':
+    ...     c[k] = k.upper()
+    >>> c.get('a'), c.get('c')
+    ('A', 'C')
+    >>> c['e'] = 'E'
+    >>> sorted(k for k in 'abcde' if c.get(k))
+    ['a', 'c', 'e']
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._items = {}  # key: [lastuse, value]
+        self._tick = 0
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        self._tick += 1
+        item[0] = self._tick
+        return item[1]
+
+    def __setitem__(self, key, value):
+        if key not in self._items and len(self._items) >= self._maxsize:
+            byuse = sorted(self._items.iteritems(), key=lambda x: x[1][0])
+            for k, _item in byuse[:len(byuse) / 2]:
+                del self._items[k]
+        self._tick += 1
+        self._items[key] = [self._tick, value]
+
+class _RowContextCache(object):
+    """Changectx of graph rows, fetched by blocks of rows and evicted
+    least recently used block first
+
+    >>> def fetch(start, end):
+    ...     print 'fetch', start, end
+    ...     return range(start, min(end, 10))
+    >>> c = _RowContextCache(fetch, blocksize=4, maxblocks=2)
+    >>> c.get(5), c.get(6), c.get(1)
+    fetch 4 8
+    fetch 0 4
+    (5, 6, 1)
+    >>> c.get(9), c.get(2), c.get(4)
+    fetch 8 12
+    fetch 4 8
+    (9, 2, 4)
+    """
+
+    def __init__(self, fetch, blocksize=64, maxblocks=16):
+        self._fetch = fetch  # fetch(start, end) -> [ctx or None, ...]
+        self._blocksize = blocksize
+        self._maxblocks = maxblocks
+        self._blocks = {}  # blockno: [ctx or None, ...]
+        self._lru = []  # blocknos, least recently used first
+
+    def get(self, row):
+        blockno, i = divmod(row, self._blocksize)
+        block = self._blocks.get(blockno)
+        if block is None or i >= len(block):
+            # missing or fetched before all of its rows were built
+            start = blockno * self._blocksize
+            block = self._fetch(start, start + self._blocksize)
+            if (blockno not in self._blocks
+                and len(self._blocks) >= self._maxblocks):
+                del self._blocks[self._lru.pop(0)]
+            self._blocks[blockno] = block
+        if blockno in self._lru:
+            self._lru.remove(blockno)
+        self._lru.append(blockno)
+        if i < len(block):
+            return block[i]
+
+class GraphBuilderThread(QThread):
+    """Lay out the rows of `graph` not built yet on a private repository
+    instance
+
+    Finished rows are collected by takeRows() as announced by rowsBuilt.
+    Once the thread has stopped, `grapher` yields the rows after them, or
+    is None if all rows are built. If the rows built by `graph` cannot be
+    reproduced, `failed` is set and `graph` has to be built as usual.
+    """
+    rowsBuilt = pyqtSignal()
+
+    def __init__(self, repo, graph, parent, **opts):
+        super(GraphBuilderThread, self).__init__(parent)
+        self.repo = repopool.acquire(repo.ui, repo.root)
+        self._opts = opts
+        self._maxlog = graph.maxlog
+        built = [n for n in graph.nodes if type(n.rev) is not str]
+        self._builtrevs = [n.rev for n in built]
+        self._lastlines = built[-1].bottomlines
+        self._lock = threading.Lock()
+        self._rows = []
+        self._maxcol = 0
+        self.grapher = None
+        self.canceled = False
+        self.failed = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def takeRows(self):
+        """Return the rows built since the last call and their highest
+        column"""
+        self._lock.acquire()
+        try:
+            rows, self._rows = self._rows, []
+            return rows, self._maxcol
+        finally:
+            self._lock.release()
+
+    def _publish(self, rows, maxcol):
+        self._lock.acquire()
+        try:
+            self._rows.extend(rows)
+            self._maxcol = max(self._maxcol, maxcol)
+        finally:
+            self._lock.release()
+        self.rowsBuilt.emit()
+
+    def run(self):
+        try:
+            try:
+                grapher = graph_rows(revision_grapher(self.repo,
+                                                      **self._opts),
+                                     self._maxlog)
+                # catch up with the rows the model has built
+                built = list(itertools.islice(grapher,
+                                              len(self._builtrevs)))
+                if ([n.rev for n in built] != self._builtrevs
+                    or built[-1].bottomlines != self._lastlines):
+                    self.failed = True
+                    return
+                self._build(grapher)
+            except Exception:
+                # the model builds the graph by itself, reporting the error
+                self.failed = True
+        finally:
+            # otherwise the remaining rows are read from it
+            if self.grapher is None:
+                repopool.release(self.repo)
+
+    def _build(self, grapher):
+        rows = []
+        maxcol = 0
+        publishsec = time.time() + 0.05
+        for gnode in grapher:
+            rows.append(gnode)
+            maxcol = max([maxcol, gnode.x]
+                         + [max(l[:2]) for l in gnode.bottomlines])
+            if self.canceled:
+                self.grapher = grapher
+                break
+            # small blocks keep the time spent to add them to the model low
+            cursec = time.time()
+            if cursec > publishsec:
+                self._publish(rows, maxcol)
+                rows = []
+                publishsec = cursec + 0.05
+        self._publish(rows, maxcol)
+
+class ChangeStatsThread(QThread):
+    """Count the files changed by revisions on a private repository
+    instance
+
+    Revisions passed to request() are counted first, most recent request
+    first, then `revs` from the last one. Counts are collected by
+    takeStats() as announced by statsComputed.
+    """
+    statsComputed = pyqtSignal()
+
+    def __init__(self, repo, revs, parent):
+        super(ChangeStatsThread, self).__init__(parent)
+        self.repo = repopool.acquire(repo.ui, repo.root)
+        self._revs = list(revs)
+        self._requested = []
+        self._lock = threading.Lock()
+        self._stats = []
+        self.canceled = False
+        self.failed = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def request(self, rev):
+        self._lock.acquire()
+        try:
+            self._requested.append(rev)
+        finally:
+            self._lock.release()
+
+    def takeStats(self):
+        """Return the (rev, node, counts) computed since the last call,
+        node and counts being None if rev could not be counted"""
+        self._lock.acquire()
+        try:
+            stats, self._stats = self._stats, []
+            return stats
+        finally:
+            self._lock.release()
+
+    def _nextrev(self):
+        self._lock.acquire()
+        try:
+            if self._requested:
+                return self._requested.pop()
+            if self._revs:
+                return self._revs.pop()
+        finally:
+            self._lock.release()
+
+    def _publish(self, stats):
+        self._lock.acquire()
+        try:
+            self._stats.extend(stats)
+        finally:
+            self._lock.release()
+        self.statsComputed.emit()
+
+    def run(self):
+        repo = self.repo
+        stats = []
+        publishsec = time.time() + 0.05
+        try:
+            while not self.canceled:
+                rev = self._nextrev()
+                if rev is None:
+                    break
+                if rev >= len(repo):
+                    # not in this repository instance, nothing to count
+                    stats.append((rev, None, None))
+                    continue
+                stats.append((rev, repo.changelog.node(rev),
+                              changecounts(repo, rev)))
+                cursec = time.time()
+                if cursec > publishsec:
+                    self._publish(stats)
+                    stats = []
+                    publishsec = cursec + 0.05
+        except Exception:
+            # the model counts the remaining revisions by itself
+            self.failed = True
+        self._publish(stats)
+        repopool.release(self.repo)
+
 class HgRepoListModel(QAbstractTableModel):
     """
     Model used for displaying the revisions of a Hg *local* repository
@@ -149,22 +424,29 @@ class HgRepoListModel(QAbstractTableModel):
         """
         QAbstractTableModel.__init__(self, parent)
         self._cache = []
+        self._graphpixmaps = _LRUCache(2000)
         self.graph = None
         self.timerHandle = None
         self.dotradius = 8
         self.rowheight = 20
         self.rowcount = 0
         self.repo = repo
-        self.revset = revset
+        self.revset = _revisionset(revset)
         self.filterbyrevset = rfilter
         self.unicodestar = True
         self.unicodexinabox = True
         self.cfgname = cfgname
-        self.latesttags = {-1: 'null'}
         self.fullauthorname = False
         self.filterbranch = branch  # unicode
         self.showhidden = showhidden
         self.allparents = allparents
+        self._layoutcache = None
+        self._grapheropts = None
+        self._builder = None
+        self._builderrows = 0
+        self._statsthread = None
+        self._statspending = set()
+        self._statsfailed = False
 
         # To be deleted
         self._user_colors = {}
@@ -206,27 +488,75 @@ class HgRepoListModel(QAbstractTableModel):
         branch = self.filterbranch
         allparents = self.allparents
         showhidden = self.showhidden
+        loading = self._builder is not None or self.timerHandle is not None
+        self._discardBuilder()
         self.invalidateCache()
         if self.revset and self.filterbyrevset:
-            grapher = revision_grapher(self.repo,
-                                       branch=hglib.fromunicode(branch),
-                                       revset=self.revset,
-                                       showhidden=showhidden)
+            self._grapheropts = dict(branch=hglib.fromunicode(branch),
+                                     revset=self.revset,
+                                     showhidden=showhidden)
+            grapher = revision_grapher(self.repo, **self._grapheropts)
             self.graph = Graph(self.repo, grapher, include_mq=False)
+            self._layoutcache = None
         else:
-            grapher = revision_grapher(self.repo,
-                                       branch=hglib.fromunicode(branch),
-                                       allparents=allparents,
-                                       showhidden=showhidden)
-            self.graph = Graph(self.repo, grapher, include_mq=True)
+            self._grapheropts = dict(branch=hglib.fromunicode(branch),
+                                     allparents=allparents,
+                                     showhidden=showhidden)
+            self._layoutcache = LayoutCache(self.repo, **self._grapheropts)
+            self.graph = self._layoutcache.graph(include_mq=True)
         self.rowcount = 0
         self.layoutChanged.emit()
         self.ensureBuilt(row=0)
         self.showMessage.emit('')
+        if loading:
+            self.loadall()
         QTimer.singleShot(0, self, SIGNAL('filled()'))
 
+    def extendGraph(self):
+        """Lay out revisions appended to the repository, keeping the rows
+        of the existing revisions and thus selection and scroll position
+
+        Returns False if the graph cannot be extended, in which case the
+        model must be rebuilt.
+        """
+        if not self._layoutcache or not self.graph:
+            return False
+        loading = self._builder is not None
+        self._stopBuilder()
+        oldgraph = self.graph
+        oldrow = _firstrevrow(oldgraph, oldgraph.maxlog)
+        if oldrow is None or oldrow > self.rowcount:
+            return False
+        graph = self._layoutcache.extendgraph(oldgraph, include_mq=True)
+        if not graph:
+            return False
+        # unapplied patches and working directory rows must be unchanged,
+        # so new revisions can be inserted just below them
+        newrow = _firstrevrow(graph, oldgraph.maxlog)
+        if (newrow is None or newrow < oldrow
+            or [n.rev for n in graph[:oldrow]]
+               != [n.rev for n in oldgraph[:oldrow]]):
+            return False
+
+        # row texts depend on tags, bookmarks, phases and branch heads
+        self.invalidateCache()
+        if newrow > oldrow:
+            self.beginInsertRows(QModelIndex(), oldrow, newrow - 1)
+            self.graph = graph
+            self.rowcount += newrow - oldrow
+            self.endInsertRows()
+        else:
+            self.graph = graph
+        if self.rowcount:
+            self.dataChanged.emit(self.index(0, 0),
+                                  self.index(self.rowcount - 1,
+                                             len(self._columns) - 1))
+        if loading:
+            self.loadall()
+        return True
+
     def setRevset(self, revset):
-        self.revset = revset
+        self.revset = _revisionset(revset)
         self.invalidateCache()
 
     def reloadConfig(self):
@@ -267,6 +597,13 @@ class HgRepoListModel(QAbstractTableModel):
         """
         if self.graph.isfilled():
             return
+        if self._builder:
+            # rows are added as the builder thread completes them
+            if rev is None:
+                return
+            self._waitBuilder(rev)
+            if self._builder or self.graph.isfilled():
+                return
         required = 0
         buildrev = rev
         n = len(self.graph)
@@ -291,8 +628,100 @@ class HgRepoListModel(QAbstractTableModel):
             self.updateRowCount()
 
     def loadall(self):
+        if self._builder or self.timerHandle or self.graph.isfilled():
+            return
+        if self._startBuilder():
+            return
         self.timerHandle = self.startTimer(1)
 
+    def stopLoading(self):
+        """Stop loading all revisions in the background"""
+        self._discardBuilder()
+        self._stopChangeStats()
+
+    def _startBuilder(self):
+        graph = self.graph
+        if (isinstance(self.repo, bundlerepo.bundlerepository)
+            or self._grapheropts is None
+            or not [n for n in graph.nodes if type(n.rev) is not str]):
+            return False
+        try:
+            builder = GraphBuilderThread(self.repo, graph, self,
+                                         **self._grapheropts)
+        except error.RepoError:
+            return False
+        builder.rowsBuilt.connect(self._takeBuiltRows)
+        builder.finished.connect(self._onBuilderFinished)
+        self._builder = builder
+        self._builderrows = 0
+        graph.suspend()
+        builder.start()
+        return True
+
+    def _takeBuiltRows(self):
+        if not self._builder:
+            return
+        rows, maxcol = self._builder.takeRows()
+        if not rows:
+            return
+        self.graph.append_nodes(rows, maxcol)
+        self._builderrows += len(rows)
+        self.updateRowCount()
+        self.showMessage.emit(_('filling (%d)') % len(self.graph))
+
+    def _waitBuilder(self, rev):
+        """Wait until the builder thread has passed rev"""
+        builder = self._builder
+        graph = self.graph
+        while True:
+            self._takeBuiltRows()
+            lastrev = graph.nodes[-1].rev
+            if (rev in graph.rowdict
+                or type(rev) is int and type(lastrev) is int
+                   and lastrev < rev):
+                return
+            if builder.wait(50):
+                break
+        self._finishBuilder()
+
+    def _onBuilderFinished(self):
+        if self.sender() is self._builder:
+            self._finishBuilder()
+
+    def _discardBuilder(self):
+        if self._builder:
+            self._builder.cancel()
+            self._builder.wait()
+            self._builder = None
+        if self.timerHandle:
+            self.killTimer(self.timerHandle)
+            self.timerHandle = None
+
+    def _stopBuilder(self):
+        if self._builder:
+            self._builder.cancel()
+            self._builder.wait()
+            self._finishBuilder()
+
+    def _finishBuilder(self):
+        self._takeBuiltRows()
+        builder = self._builder
+        self._builder = None
+        if not builder.failed:
+            self.graph.resume(builder.grapher)
+        elif not self._builderrows:
+            self.graph.resume(self.graph.grapher)
+            if not builder.canceled:
+                self.timerHandle = self.startTimer(1)
+            return
+        else:
+            # rows following those of the builder cannot be built
+            self._initGraph()
+            return
+        if self.graph.isfilled():
+            self.showMessage.emit('')
+            self.loaded.emit()
+
     def timerEvent(self, event):
         if event.timerId() == self.timerHandle:
             self.showMessage.emit(_('filling (%d)')%(len(self.graph)))
@@ -377,32 +806,8 @@ class HgRepoListModel(QAbstractTableModel):
         return 2 * self.dotradius * col + self.dotradius/2 + 8
 
     def graphctx(self, ctx, gnode):
-        w = self.col2x(gnode.cols) + 10
-        h = self.rowheight
-
-        pix = QPixmap(w, h)
-        pix.fill(QColor(0,0,0,0))
-        painter = QPainter(pix)
-        try:
-            self._drawgraphctx(painter, pix, ctx, gnode)
-        finally:
-            painter.end()
-        return QVariant(pix)
-
-    def _drawgraphctx(self, painter, pix, ctx, gnode):
+        """Return the GraphCell to draw for the graph node of ctx"""
         revset = self.revset
-        h = pix.height()
-        dot_y = h / 2
-
-        painter.setRenderHint(QPainter.Antialiasing)
-
-        pen = QPen(Qt.blue)
-        pen.setWidth(2)
-        painter.setPen(pen)
-
-        lpen = QPen(pen)
-        lpen.setColor(Qt.black)
-        painter.setPen(lpen)
         if revset:
             def isactive(start, end, color, line_type, children, rev):
                 return rev in revset and util.any(r in revset for r in children)
@@ -410,114 +815,334 @@ class HgRepoListModel(QAbstractTableModel):
             def isactive(start, end, color, line_type, children, rev):
                 return True
 
-        for y1, y4, lines in ((dot_y, dot_y + h, gnode.bottomlines),
-                              (dot_y - h, dot_y, gnode.toplines)):
-            y2 = y1 + 1 * (y4 - y1)/4
-            ymid = (y1 + y4)/2
-            y3 = y1 + 3 * (y4 - y1)/4
-
+        segments = []
+        for half, lines in (('bottom', gnode.bottomlines),
+                            ('top', gnode.toplines)):
             lines = sorted((isactive(*l), l) for l in lines)
+            for active, (start, end, color, line_type, children, rev) \
+                    in lines:
+                segments.append((half, start, end, color, line_type, active))
 
-            for active, (start, end, color, line_type, children, rev) in lines:
-                lpen = QPen(pen)
-                lpen.setColor(QColor(active and get_color(color) or "gray"))
-                lpen.setStyle(get_style(line_type, active))
-                lpen.setWidth(get_width(line_type, active))
-                painter.setPen(lpen)
-                x1 = self.col2x(start)
-                x2 = self.col2x(end)
-                path = QPainterPath()
-                path.moveTo(x1, y1)
-                path.cubicTo(x1, y2,
-                             x1, y2,
-                             (x1 + x2)/2, ymid)
-                path.cubicTo(x2, y3,
-                             x2, y3,
-                             x2, y4)
-                painter.drawPath(path)
-
-        # Draw node
         if revset and gnode.rev not in revset:
-            dot_color = QColor("gray")
+            dotcolor = str(QColor("gray").name())
             radius = self.dotradius * 0.8
         else:
-            dot_color = QColor(self.namedbranch_color(ctx.branch()))
+            dotcolor = self.namedbranch_color(ctx.branch())
             radius = self.dotradius
-        dotcolor = dot_color.lighter()
-        pencolor = dot_color.darker()
-        truewhite = QColor("white")
-        white = QColor("white")
-        fillcolor = gnode.rev is None and white or dotcolor
-
-        pen = QPen(pencolor)
-        pen.setWidthF(1.5)
-        painter.setPen(pen)
-
-        centre_x = self.col2x(gnode.x)
-        centre_y = h/2
-
-        def circle(r):
-            rect = QRectF(centre_x - r,
-                          centre_y - r,
-                          2 * r, 2 * r)
-            painter.drawEllipse(rect)
-
-        def closesymbol(s):
-            rect_ = QRectF(centre_x - 1.5 * s, centre_y - 0.5 * s, 3 * s, s)
-            painter.drawRect(rect_)
-
-        def diamond(r):
-            poly = QPolygonF([QPointF(centre_x - r, centre_y),
-                              QPointF(centre_x, centre_y - r),
-                              QPointF(centre_x + r, centre_y),
-                              QPointF(centre_x, centre_y + r),
-                              QPointF(centre_x - r, centre_y),])
-            painter.drawPolygon(poly)
-
-        hiddenrev = ctx.hidden()
-        if hiddenrev:
-            painter.setBrush(truewhite)
-            white.setAlpha(64)
-            fillcolor.setAlpha(64)
+        wdparent = False
         if ctx.thgmqappliedpatch():  # diamonds for patches
-            symbolsize = radius / 1.5
-            if hiddenrev:
-                diamond(symbolsize)
-            if ctx.thgwdparent():
-                painter.setBrush(white)
-                diamond(2 * 0.9 * symbolsize)
-            painter.setBrush(fillcolor)
-            diamond(symbolsize)
+            shape = 'patch'
+            wdparent = ctx.thgwdparent()
         elif ctx.thgmqunappliedpatch():
-            symbolsize = radius / 1.5
-            if hiddenrev:
-                diamond(symbolsize)
-            patchcolor = QColor('#dddddd')
-            painter.setBrush(patchcolor)
-            painter.setPen(patchcolor)
-            diamond(symbolsize)
+            shape = 'unappliedpatch'
         elif ctx.extra().get('close'):
-            symbolsize = 0.5 * radius
-            if hiddenrev:
-                closesymbol(symbolsize)
-            painter.setBrush(fillcolor)
-            closesymbol(symbolsize)
+            shape = 'closed'
         else:  # circles for normal revisions
-            symbolsize = 0.5 * radius
+            shape = 'circle'
+            wdparent = ctx.thgwdparent()
+        glyph = (shape, dotcolor, radius, gnode.rev is None, wdparent,
+                 bool(ctx.hidden()))
+        return QVariant(GraphCell(self.col2x(gnode.cols) + 10, segments,
+                                  gnode.x, glyph))
+
+    def paintgraph(self, painter, rect, cell):
+        """Draw the GraphCell at the top left corner of rect"""
+        painter.save()
+        try:
+            painter.setClipRect(rect)
+            painter.translate(rect.topLeft())
+            for segment in cell.segments:
+                pix, x, y = self._graphpixmap(segment, self._drawsegment)
+                painter.drawPixmap(x, y, pix)
+            pix, x, y = self._graphpixmap(cell.glyph, self._drawglyph)
+            painter.drawPixmap(self.col2x(cell.x) + x,
+                               self.rowheight / 2 + y, pix)
+        finally:
+            painter.restore()
+
+    def _graphpixmap(self, key, draw):
+        # lines and nodes are drawn once per distinct look; the cache keeps
+        # those of the rows painted recently
+        item = self._graphpixmaps.get(key)
+        if item is None:
+            item = self._graphpixmaps[key] = draw(*key)
+        return item
+
+    def _drawsegment(self, half, start, end, color, line_type, active):
+        """Draw the half of a line between two rows which lies in the row,
+        returning the pixmap and its position in the row"""
+        h = self.rowheight
+        dot_y = h / 2
+        if half == 'bottom':
+            y1, y4 = dot_y, dot_y + h
+            top, bottom = dot_y, h
+        else:
+            y1, y4 = dot_y - h, dot_y
+            top, bottom = 0, dot_y
+        y2 = y1 + 1 * (y4 - y1)/4
+        ymid = (y1 + y4)/2
+        y3 = y1 + 3 * (y4 - y1)/4
+        x1 = self.col2x(start)
+        x2 = self.col2x(end)
+        left = min(x1, x2) - 2
+
+        pix = QPixmap(abs(x2 - x1) + 5, bottom - top)
+        pix.fill(QColor(0,0,0,0))
+        painter = QPainter(pix)
+        try:
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.translate(-left, -top)
+            lpen = QPen(QColor(active and get_color(color) or "gray"))
+            lpen.setStyle(get_style(line_type, active))
+            lpen.setWidth(get_width(line_type, active))
+            painter.setPen(lpen)
+            path = QPainterPath()
+            path.moveTo(x1, y1)
+            path.cubicTo(x1, y2,
+                         x1, y2,
+                         (x1 + x2)/2, ymid)
+            path.cubicTo(x2, y3,
+                         x2, y3,
+                         x2, y4)
+            painter.drawPath(path)
+        finally:
+            painter.end()
+        return pix, left, top
+
+    def _drawglyph(self, shape, color, radius, workingdir, wdparent,
+                   hiddenrev):
+        """Draw a node symbol, returning the pixmap and its position
+        relative to the centre of the node"""
+        size = 2 * (int(1.2 * radius) + 3)
+        centre_x = centre_y = size / 2
+
+        pix = QPixmap(size, size)
+        pix.fill(QColor(0,0,0,0))
+        painter = QPainter(pix)
+        try:
+            painter.setRenderHint(QPainter.Antialiasing)
+            dot_color = QColor(color)
+            dotcolor = dot_color.lighter()
+            pencolor = dot_color.darker()
+            truewhite = QColor("white")
+            white = QColor("white")
+            fillcolor = workingdir and white or dotcolor
+
+            pen = QPen(pencolor)
+            pen.setWidthF(1.5)
+            painter.setPen(pen)
+
+            def circle(r):
+                rect = QRectF(centre_x - r,
+                              centre_y - r,
+                              2 * r, 2 * r)
+                painter.drawEllipse(rect)
+
+            def closesymbol(s):
+                rect_ = QRectF(centre_x - 1.5 * s, centre_y - 0.5 * s,
+                               3 * s, s)
+                painter.drawRect(rect_)
+
+            def diamond(r):
+                poly = QPolygonF([QPointF(centre_x - r, centre_y),
+                                  QPointF(centre_x, centre_y - r),
+                                  QPointF(centre_x + r, centre_y),
+                                  QPointF(centre_x, centre_y + r),
+                                  QPointF(centre_x - r, centre_y),])
+                painter.drawPolygon(poly)
+
             if hiddenrev:
+                painter.setBrush(truewhite)
+                white.setAlpha(64)
+                fillcolor.setAlpha(64)
+            if shape == 'patch':
+                symbolsize = radius / 1.5
+                if hiddenrev:
+                    diamond(symbolsize)
+                if wdparent:
+                    painter.setBrush(white)
+                    diamond(2 * 0.9 * symbolsize)
+                painter.setBrush(fillcolor)
+                diamond(symbolsize)
+            elif shape == 'unappliedpatch':
+                symbolsize = radius / 1.5
+                if hiddenrev:
+                    diamond(symbolsize)
+                patchcolor = QColor('#dddddd')
+                painter.setBrush(patchcolor)
+                painter.setPen(patchcolor)
+                diamond(symbolsize)
+            elif shape == 'closed':
+                symbolsize = 0.5 * radius
+                if hiddenrev:
+                    closesymbol(symbolsize)
+                painter.setBrush(fillcolor)
+                closesymbol(symbolsize)
+            else:
+                symbolsize = 0.5 * radius
+                if hiddenrev:
+                    circle(symbolsize)
+                if wdparent:
+                    painter.setBrush(white)
+                    circle(0.9 * radius)
+                painter.setBrush(fillcolor)
                 circle(symbolsize)
-            if ctx.thgwdparent():
-                painter.setBrush(white)
-                circle(0.9 * radius)
-            painter.setBrush(fillcolor)
-            circle(symbolsize)
+        finally:
+            painter.end()
+        return pix, -centre_x, -centre_y
 
     def invalidateCache(self):
         self._cache = []
-        for a in ('_roleoffsets',):
+        # the stats index is reloaded and extended to new revisions
+        self._stopChangeStats()
+        for a in ('_roleoffsets', '_rowctxs', '_nodebookmarks',
+                  '_branchheads', '_latesttags', '_changestats'):
             if hasattr(self, a):
                 delattr(self, a)
 
+    @propertycache
+    def _rowctxs(self):
+        return _RowContextCache(self._fetchrowctxs)
+
+    def _fetchrowctxs(self, start, end):
+        """Create the changectx of the rows from start to end, reading
+        their changelog entries in one pass"""
+        ctxs = []
+        for gnode in self.graph[start:end]:
+            if type(gnode.rev) is int:
+                ctxs.append(self.repo.changectx(gnode.rev))
+            else:
+                # working directory and unapplied patches can change
+                # without a new changeset, don't keep them
+                ctxs.append(None)
+        # in revlog order, so that consecutive entries are read at once
+        for ctx in sorted((c for c in ctxs if c), key=lambda c: c.rev()):
+            ctx._changeset
+        return ctxs
+
+    def _rowctx(self, row):
+        gnode = self.graph[row]
+        ctx = self._rowctxs.get(row)
+        if ctx is None or ctx.rev() != gnode.rev:
+            ctx = self.repo.changectx(gnode.rev)
+        return ctx
+
+    @propertycache
+    def _nodebookmarks(self):
+        marks = {}
+        for mark, n in self.repo._bookmarks.iteritems():
+            marks.setdefault(n, []).append(mark)
+        for l in marks.itervalues():
+            l.sort()
+        return marks
+
+    @propertycache
+    def _branchheads(self):
+        return set(self.repo._branchheads)
+
+    @propertycache
+    def _latesttags(self):
+        return LatestTags(self.repo)
+
+    @propertycache
+    def _changestats(self):
+        return ChangeStats(self.repo)
+
+    def _requestChangeStats(self, rev):
+        """Count the files changed by rev in the background"""
+        if rev in self._statspending:
+            if self._statsthread:
+                # the row is displayed now, count it before the others
+                self._statsthread.request(rev)
+            return
+        self._statspending.add(rev)
+        if self._statsthread:
+            self._statsthread.request(rev)
+        else:
+            self._startChangeStats()
+
+    def _startChangeStats(self):
+        try:
+            thread = ChangeStatsThread(self.repo,
+                                       self._changestats.pending(), self)
+        except error.RepoError:
+            self._statsfailed = True
+            return
+        for rev in sorted(self._statspending):
+            thread.request(rev)
+        thread.statsComputed.connect(self._takeChangeStats)
+        thread.finished.connect(self._onChangeStatsFinished)
+        self._statsthread = thread
+        thread.start()
+
+    def _takeChangeStats(self):
+        thread = self._statsthread
+        if not thread:
+            return
+        revs = self._storeChangeStats(thread.takeStats())
+        if 'Changes' not in self._columns:
+            return
+        column = self._columns.index('Changes')
+        rows = []
+        for rev in revs:
+            row = self.graph.rowdict.get(rev, -1)
+            if row < 0 or row >= self.rowcount:
+                continue
+            if row < len(self._cache) and self._cache[row]:
+                self._cache[row][column] = None
+            rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), column),
+                                  self.index(max(rows), column))
+
+    def _storeChangeStats(self, stats):
+        """Store counts of revisions still in the repository and return
+        these revisions"""
+        cl = self.repo.changelog
+        changestats = self._changestats
+        revs = []
+        for rev, node, counts in stats:
+            self._statspending.discard(rev)
+            if rev < len(cl) and cl.node(rev) == node:
+                changestats[rev] = counts
+                revs.append(rev)
+        return revs
+
+    def _onChangeStatsFinished(self):
+        thread = self.sender()
+        if thread is not self._statsthread:
+            return
+        self._takeChangeStats()
+        self._statsthread = None
+        self._changestats.save()
+        if thread.failed:
+            self._statsfailed = True
+            self._updateChangesColumn()
+        elif self._statspending:
+            # requested just before the thread stopped
+            self._startChangeStats()
+
+    def _stopChangeStats(self):
+        thread = self._statsthread
+        if thread:
+            thread.cancel()
+            thread.wait()
+            self._storeChangeStats(thread.takeStats())
+            self._statsthread = None
+        self._statspending.clear()
+        if '_changestats' in self.__dict__:
+            self._changestats.save()
+
+    def _updateChangesColumn(self):
+        if 'Changes' not in self._columns or not self.rowcount:
+            return
+        column = self._columns.index('Changes')
+        for data in self._cache:
+            if data:
+                data[column] = None
+        self.dataChanged.emit(self.index(0, column),
+                              self.index(self.rowcount - 1, column))
+
     @propertycache
     def _roleoffsets(self):
         return {Qt.DisplayRole : 0,
@@ -562,7 +1187,7 @@ class HgRepoListModel(QAbstractTableModel):
                 return nullvariant
             if data[offset] is None:
                 gnode = self.graph[row]
-                ctx = self.repo.changectx(gnode.rev)
+                ctx = self._rowctx(row)
                 data[offset] = self.graphctx(ctx, gnode)
                 self._cache[row] = data
             return data[offset]
@@ -579,7 +1204,7 @@ class HgRepoListModel(QAbstractTableModel):
 
     def rawdata(self, row, column, role):
         gnode = self.graph[row]
-        ctx = self.repo.changectx(gnode.rev)
+        ctx = self._rowctx(row)
 
         if role == Qt.DisplayRole:
             text = self._columnmap[column](self, ctx, gnode)
@@ -606,8 +1231,7 @@ class HgRepoListModel(QAbstractTableModel):
         self.ensureBuilt(row=row)
         if row >= len(self.graph):
             return Qt.ItemFlags(0)
-        gnode = self.graph[row]
-        ctx = self.repo.changectx(gnode.rev)
+        ctx = self._rowctx(row)
 
         dragflags = Qt.ItemFlags(0)
         if ctx.thgmqunappliedpatch():
@@ -694,30 +1318,13 @@ class HgRepoListModel(QAbstractTableModel):
 
     def getlatesttags(self, ctx, gnode):
         rev = ctx.rev()
-        todo = [rev]
-        repo = self.repo
-        while todo:
-            rev = todo.pop()
-            if rev in self.latesttags:
-                continue
-            ctx = repo[rev]
-            tags = [t for t in ctx.tags() if repo.tagtype(t) == 'global']
-            if tags:
-                self.latesttags[rev] = ':'.join(sorted(tags))
-                continue
-            try:
-                if (ctx.parents()):
-                    ptag = max(
-                        self.latesttags[p.rev()] for p in ctx.parents())
-                else:
-                    ptag = ""
-            except KeyError:
-                # Cache miss - recurse
-                todo.append(rev)
-                todo.extend(p.rev() for p in ctx.parents())
-                continue
-            self.latesttags[rev] = ptag
-        return self.latesttags[rev]
+        if rev is None:
+            revs = [p.rev() for p in ctx.parents()]
+        elif type(rev) is int:
+            revs = [rev]
+        else:
+            return ''
+        return max(self._latesttags[r][0] for r in revs)
 
     def gettags(self, ctx, gnode):
         if ctx.rev() is None:
@@ -753,7 +1360,7 @@ class HgRepoListModel(QAbstractTableModel):
                 msg = '*** ' + _('Working Directory') + ' ***'
 
             for pctx in ctx.parents():
-                if self.repo._branchheads and pctx.node() not in self.repo._branchheads:
+                if self._branchheads and pctx.node() not in self._branchheads:
                     text = _('Not a head revision!')
                     msg += " " + qtlib.markup(text, fg='red', weight='bold')
 
@@ -771,12 +1378,12 @@ class HgRepoListModel(QAbstractTableModel):
             return qtlib.markup(msg, fg=HIDDENREV_COLOR)
 
         parts = []
-        if ctx.thgbranchhead():
+        if ctx.node() in self._branchheads:
             branchu = hglib.tounicode(ctx.branch())
             effects = qtlib.geteffect('log.branch')
             parts.append(qtlib.applyeffects(u' %s ' % branchu, effects))
 
-        for mark in ctx.bookmarks():
+        for mark in self._nodebookmarks.get(ctx.node(), ()):
             style = 'log.bookmark'
             if mark == self.repo._bookmarkcurrent:
                 bn = self.repo._bookmarks[self.repo._bookmarkcurrent]
@@ -806,18 +1413,31 @@ class HgRepoListModel(QAbstractTableModel):
 
     def getchanges(self, ctx, gnode):
         """Return the MAR status for the given ctx."""
+        rev = ctx.rev()
+        if type(rev) is not int:
+            M, A, R = ctx.changesToParent(0)
+            counts = len(A), len(M), len(R)
+        elif (isinstance(self.repo, bundlerepo.bundlerepository)
+              or self._statsfailed):
+            counts = changecounts(self.repo, rev)
+        else:
+            counts = self._changestats.get(rev)
+            if counts is None:
+                # the cell is updated once counted
+                self._requestChangeStats(rev)
+                return '...'
         changes = []
-        M, A, R = ctx.changesToParent(0)
-        def addtotal(files, style):
+        def addtotal(count, style):
             effects = qtlib.geteffect(style)
-            text = qtlib.applyeffects(' %s ' % len(files), effects)
+            text = qtlib.applyeffects(' %s ' % count, effects)
             changes.append(text)
-        if A:
-            addtotal(A, 'log.added')
-        if M:
-            addtotal(M, 'log.modified')
-        if R:
-            addtotal(R, 'log.removed')
+        added, modified, removed = counts
+        if added:
+            addtotal(added, 'log.added')
+        if modified:
+            addtotal(modified, 'log.modified')
+        if removed:
+            addtotal(removed, 'log.removed')
         return ''.join(changes)
 
     def getconv(self, ctx, gnode):
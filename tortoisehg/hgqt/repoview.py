@@ -127,7 +127,7 @@ class HgRepoView(QTableView):
 
     def resetBrowseHistory(self, revs, reselrev=None):
         graph = self.model().graph
-        self._rev_history = [r for r in revs if r in graph.nodesdict]
+        self._rev_history = [r for r in revs if r in graph.rowdict]
         if reselrev is not None and reselrev in self._rev_history:
             self._rev_pos = self._rev_history.index(reselrev)
         else:
@@ -390,17 +390,14 @@ class GraphDelegate(QStyledItemDelegate):
 
     def paint(self, painter, option, index):
         QStyledItemDelegate.paint(self, painter, option, index)
-        graph = index.data(repomodel.GraphRole)
-        if graph:
+        cell = index.data(repomodel.GraphRole).toPyObject()
+        if cell:
             # not grayed-out even if revisions are inactive
-            pix = QPixmap(graph)
-            dest = option.rect
-            src = QRect(0, 0, dest.width(), dest.height())
-            painter.drawPixmap(dest, pix, src)
+            index.model().paintgraph(painter, option.rect, cell)
 
     def sizeHint(self, option, index):
-        graph = index.data(repomodel.GraphRole)
-        if graph:
-            return QPixmap(graph).size()
+        cell = index.data(repomodel.GraphRole).toPyObject()
+        if cell:
+            return QSize(cell.width, index.model().rowheight)
         else:
             return QSize(0, 0)
@@ -18,6 +18,7 @@ from tortoisehg.hgqt import qtlib
 from tortoisehg.hgqt.qtlib import QuestionMsgBox, InfoMsgBox, WarningMsgBox
 from tortoisehg.hgqt.qtlib import DemandWidget
 from tortoisehg.hgqt.repomodel import HgRepoListModel
+from tortoisehg.hgqt.graph import RevisionSet
 from tortoisehg.hgqt import cmdui, update, tag, backout, merge, visdiff
 from tortoisehg.hgqt import archive, thgimport, thgstrip, purge, bookmark
 from tortoisehg.hgqt import bisect, rebase, resolve, thgrepo, compress, mq
@@ -68,7 +69,7 @@ class RepoWidget(QWidget):
         self.bundle = None  # bundle file name [local encoding]
         self.bundlesource = None  # source URL of incoming bundle [unicode]
         self.outgoingMode = False
-        self.revset = []
+        self.revset = RevisionSet()
         self.busyIcons = []
         self.namedTabs = {}
         self.repolen = len(repo)
@@ -498,11 +499,11 @@ class RepoWidget(QWidget):
         self.filterbar.setEnableFilter(False)
         self.titleChanged.emit(self.title())
         newlen = len(self.repo)
-        self.revset = range(oldlen, newlen)
+        self.revset = RevisionSet(xrange(oldlen, newlen))
         self.repomodel.setRevset(self.revset)
         self.reload(invalidate=False)
-        self.repoview.resetBrowseHistory(self.revset)
-        self._reload_rev = self.revset[0]
+        self.repoview.resetBrowseHistory(sorted(self.revset))
+        self._reload_rev = self.revset.min()
 
         w = self.setInfoBar(qtlib.ConfirmInfoBar,
             _('Found %d incoming changesets') % len(self.revset))
@@ -518,7 +519,7 @@ class RepoWidget(QWidget):
     def clearBundle(self):
         self.filterbar.setEnableFilter(True)
         self.filterbar.setQuery('')
-        self.revset = []
+        self.revset = RevisionSet()
         self.repomodel.setRevset(self.revset)
         self.repoview.enablefilterpalette(False)
         self.bundle = None
@@ -567,18 +568,17 @@ class RepoWidget(QWidget):
         self.repoview.enablefilterpalette(False)
         if not self.revset:
             return False
-        self.revset = []
+        self.revset = RevisionSet()
         if self.revsetfilter:
             self.reload()
             return True
         else:
-            self.repomodel.setRevset([])
+            self.repomodel.setRevset(self.revset)
             self.refresh()
         return False
 
     def setRevisionSet(self, revisions):
-        revs = revisions[:]
-        revs.sort(reverse=True)
+        revs = RevisionSet(revisions)
         self.revset = revs
         if self.revsetfilter:
             self.reload()
@@ -913,7 +913,8 @@ class RepoWidget(QWidget):
 
     def setupModels(self):
         # Filter revision set in case revisions were removed
-        self.revset = [r for r in self.revset if r < len(self.repo)]
+        repolen = len(self.repo)
+        self.revset = RevisionSet(r for r in self.revset if r < repolen)
         self.repomodel = HgRepoListModel(self.repo, self.repoview.colselect[0],
                                          self.filterbar.branch(), self.revset,
                                          self.revsetfilter, self,
@@ -925,7 +926,11 @@ class RepoWidget(QWidget):
         oldmodel = self.repoview.model()
         self.repoview.setModel(self.repomodel)
         if oldmodel:
+            oldmodel.stopLoading()
             oldmodel.deleteLater()
+        self._saveSeries()
+
+    def _saveSeries(self):
         try:
             self._last_series = self.repo.mq.series[:]
         except AttributeError:
@@ -1031,7 +1036,7 @@ class RepoWidget(QWidget):
                 self.showMessage(_('Repository stripped, incoming preview '
                                    'cleared'))
             elif self.revset:
-                self.revset = []
+                self.revset = RevisionSet()
                 self.filterbar.setQuery('')
                 self.repoview.enablefilterpalette(False)
                 self.showMessage(_('Repository stripped, revision set cleared'))
@@ -1059,6 +1064,29 @@ class RepoWidget(QWidget):
         self.filterbar.refresh()
         self.repoview.saveSettings()
 
+    def extendGraph(self):
+        """Called by repositoryChanged signals; lays out appended revisions
+        only, returns False if the graph has to be rebuilt"""
+        if self.bundle or len(self.repo) < self.repolen:
+            return False
+        view = self.repoview
+        topindex = view.indexAt(QPoint(0, 0))
+        if topindex.isValid() and topindex.row() > 0:
+            toprow = QPersistentModelIndex(topindex)
+        else:
+            toprow = None  # let new revisions scroll in at the top
+        if not self.repomodel.extendGraph():
+            return False
+        self.showMessage('')
+        self.repolen = len(self.repo)
+        if toprow and toprow.isValid():
+            view.scrollTo(self.repomodel.index(toprow.row(), 0),
+                          QAbstractItemView.PositionAtTop)
+        self._saveSeries()
+        self.filterbar.refresh()
+        self.revDetailsWidget.reload()
+        return True
+
     def reloadTaskTab(self):
         tti = self.taskTabsWidget.currentIndex()
         if tti == self.logTabIndex:
@@ -1090,7 +1118,8 @@ class RepoWidget(QWidget):
         'Repository has detected a changelog / dirstate change'
         if self.isVisible():
             try:
-                self.rebuildGraph()
+                if not self.extendGraph():
+                    self.rebuildGraph()
             except (error.RevlogError, error.RepoError), e:
                 self.showMessage(hglib.tounicode(str(e)))
                 self.repomodel = HgRepoListModel(None,
@@ -1190,6 +1219,7 @@ class RepoWidget(QWidget):
         self.grepDemand.forward('saveSettings', s)
         self.filterbar.saveSettings(s)
         self.repoview.saveSettings(s)
+        self.repomodel.stopLoading()
         return True
 
     def setSyncUrl(self, url):
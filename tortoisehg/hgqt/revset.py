@@ -7,10 +7,11 @@
 
 import os
 
-from mercurial import revset, hg, error
+from mercurial import revset, error
 
 from tortoisehg.hgqt import qtlib, cmdui
-from tortoisehg.util import hglib
+from tortoisehg.hgqt.graph import RevisionSet
+from tortoisehg.util import hglib, repopool
 from tortoisehg.hgqt.i18n import _
 
 from PyQt4.Qsci import QsciScintilla, QsciAPIs, QsciLexerPython
@@ -377,7 +378,7 @@ class RevsetThread(QThread):
 
     def __init__(self, repo, query, parent):
         super(RevsetThread, self).__init__(parent)
-        self.repo = hg.repository(repo.ui, repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.text = hglib.fromunicode(query)
         self.query = query
 
@@ -386,12 +387,12 @@ class RevsetThread(QThread):
         try:
             os.chdir(self.repo.root)
             func = revset.match(self.repo.ui, self.text)
-            l = list(func(self.repo, list(self.repo)))
-            if len(l):
-                self.showMessage.emit(_('%d matches found') % len(l))
+            revs = RevisionSet(func(self.repo, list(self.repo)))
+            if len(revs):
+                self.showMessage.emit(_('%d matches found') % len(revs))
             else:
                 self.showMessage.emit(_('No matches found'))
-            self.queryIssued.emit(self.query, l)
+            self.queryIssued.emit(self.query, revs)
         except error.ParseError, e:
             if len(e.args) == 2:
                 msg, pos = e.args
@@ -405,3 +406,4 @@ class RevsetThread(QThread):
             self.showMessage.emit(_('Invalid query: ')+hglib.tounicode(str(e)))
 
         os.chdir(cwd)
+        repopool.release(self.repo)
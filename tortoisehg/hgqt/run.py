@@ -1078,8 +1078,12 @@ def tag(ui, repoagent, *pats, **opts):
      ('',  'remove', None, _('remove the status cache')),
      ('s', 'show', None, _('show the contents of the status cache '
                            '(no update)')),
-     ('',  'all', None, _('udpate all repos in current dir'))],
-    _('thg thgstatus [OPTION]'))
+     ('',  'all', None, _('udpate all repos in current dir')),
+     ('',  'benchmark', None, _('report how long updating the status '
+                                'cache of directories takes')),
+     ('',  'daemon', None, _('serve the status of files to file managers '
+                             'until terminated'))],
+    _('thg thgstatus [OPTION]... [FILE]...'))
 def thgstatus(ui, *pats, **opts):
     """update TortoiseHg status cache"""
     from tortoisehg.util import thgstatus as thgstatusmod
@@ -611,6 +611,12 @@ INFO = (
     _fi(_('Full Path Title'), 'tortoisehg.fullpath', genBoolRBGroup,
         _('Show a full directory path of the repository in the dialog title '
           'instead of just the root directory name.  Default: False')),
+    _fi(_('Search Index'), 'tortoisehg.grepindex', genBoolRBGroup,
+        _('Keep an index of the contents of the files of the working '
+          'directory parent and of recent revisions, to skip the files '
+          'which cannot match when searching the working directory or a '
+          'revision. The index is built in the background after each search '
+          'and kept in the .hg/cache directory. Default: False')),
     _fi(_('Auto-resolve merges'), 'tortoisehg.autoresolve', genBoolRBGroup,
         _('Indicates whether TortoiseHg should attempt to automatically '
           'resolve changes from both sides to the same file, and only report '
@@ -6,10 +6,14 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 import os
+import time
+import bisect
+import operator
+import struct
 
-from mercurial import hg, util, error, context, merge, scmutil
+from mercurial import util, error, context, merge, scmutil
 
-from tortoisehg.util import hglib
+from tortoisehg.util import hglib, repopool, statusengine
 from tortoisehg.hgqt.i18n import _
 from tortoisehg.hgqt import qtlib, wctxactions, visdiff, cmdui, fileview, thgrepo
 
@@ -64,6 +68,8 @@ class StatusWidget(QWidget):
         self.pctx = None
         self.savechecks = True
         self.refthread = None
+        self._wctxrepo = None
+        self._streammodel = None
         self.refreshWctxLater = QTimer(self, interval=10, singleShot=True)
         self.refreshWctxLater.timeout.connect(self.refreshWctx)
         self.partials = {}
@@ -327,8 +333,23 @@ class StatusWidget(QWidget):
         self.refthread = StatusThread(self.repo, self.pctx, self.pats, self.opts)
         self.refthread.finished.connect(self.reloadComplete)
         self.refthread.showMessage.connect(self.reloadFailed)
+        self.refthread.filesFound.connect(self._onFilesFound)
+        self._foundcount = 0
         self.refthread.start()
 
+    @pyqtSlot(object)
+    def _onFilesFound(self, files):
+        self._foundcount += len(files)
+        self.progress.emit(_('Refresh'), self._foundcount, '', _('files'),
+                           None)
+        # show files as they are found, in a model completed by updateModel()
+        tm = self._streammodel
+        if tm is None:
+            tm = self._streammodel = self._createModel(None, {})
+            tm.setFilter(self.le.text())
+            self._setModel(tm)
+        tm.addFiles(files)
+
     @pyqtSlot()
     def reloadComplete(self):
         self.refthread.wait()
@@ -338,6 +359,7 @@ class StatusWidget(QWidget):
         self.progress.emit(*cmdui.stopProgress(_('Refresh')))
         if self.refthread.wctx is not None:
             self.updateModel(self.refthread.wctx, self.refthread.patchecked)
+        self._streammodel = None
         self.refthread = None
         if len(self.repo.parents()) > 1:
             # nuke partial selections if wctx has a merge in-progress
@@ -357,8 +379,7 @@ class StatusWidget(QWidget):
     def canExit(self):
         return not self.isRefreshingWctx()
 
-    def updateModel(self, wctx, patchecked):
-        self.tv.setSortingEnabled(False)
+    def _createModel(self, wctx, patchecked):
         if self.tv.model():
             checked = self.tv.model().getChecked()
         else:
@@ -375,12 +396,27 @@ class StatusWidget(QWidget):
             tm.checkToggled.connect(self.checkToggled)
             tm.checkCountChanged.connect(self.updateCheckCount)
         self.savechecks = True
+        return tm
 
+    def _setModel(self, tm):
+        self.tv.setSortingEnabled(False)
         oldtm = self.tv.model()
         self.tv.setModel(tm)
         if oldtm:
             oldtm.deleteLater()
         self.tv.setSortingEnabled(True)
+
+    def updateModel(self, wctx, patchecked):
+        tm = self._streammodel
+        if tm is None:
+            tm = self._createModel(wctx, patchecked)
+            self._setModel(tm)
+        else:
+            tm.finishFiles(wctx)
+        # the repository of the replaced wctx can be used by another job
+        if self._wctxrepo is not None:
+            repopool.release(self._wctxrepo)
+        self._wctxrepo = wctx._repo
         self.tv.setColumnHidden(COL_PATH, bool(wctx.p2()) or not self.checkable)
         self.tv.setColumnHidden(COL_MERGE_STATE, not tm.anyMerge())
         if self.checkable:
@@ -543,24 +579,44 @@ class StatusWidget(QWidget):
 
 
 class StatusThread(QThread):
-    '''Background thread for generating a workingctx'''
+    '''Background thread for generating a workingctx
+
+    Without patterns nor patch context, the status is computed by
+    statusengine, reporting files by filesFound as (path, status, size)
+    lists while the working directory is walked.
+    '''
 
     showMessage = pyqtSignal(QString)
+    filesFound = pyqtSignal(object)
 
     def __init__(self, repo, pctx, pats, opts, parent=None):
         super(StatusThread, self).__init__()
-        self.repo = hg.repository(repo.ui, repo.root)
+        self.repo = repopool.acquire(repo.ui, repo.root)
         self.pctx = pctx
         self.pats = pats
         self.opts = opts
         self.wctx = None
         self.patchecked = {}
+        self._found = []
+        self._foundsec = 0
+        self._foundinterval = 0.1
+
+    def _reportFiles(self, files, flush=False):
+        self._found.extend(files)
+        cursec = time.time()
+        if self._found and (flush or cursec > self._foundsec):
+            self.filesFound.emit(self._found)
+            self._found = []
+            self._foundsec = cursec + self._foundinterval
+            # each batch costs the model a pass over the rows it has
+            self._foundinterval = min(self._foundinterval * 2, 1.0)
 
     def run(self):
         self.repo.dirstate.invalidate()
         extract = lambda x, y: dict(zip(x, map(y.get, x)))
         stopts = extract(('unknown', 'ignored', 'clean'), self.opts)
         patchecked = {}
+        sizes = {}
         try:
             if self.pats:
                 if self.opts.get('checkall'):
@@ -592,6 +648,13 @@ class StatusThread(QThread):
                 self.repo.bfstatus = False
                 self.repo.lfstatus = False
                 wctx = context.workingctx(self.repo, changes=status)
+            elif statusengine.supported(self.repo):
+                cache = statusengine.getcache(self.repo)
+                status, sizes = statusengine.status(self.repo,
+                                                    report=self._reportFiles,
+                                                    cache=cache, **stopts)
+                self._reportFiles([], flush=True)
+                wctx = context.workingctx(self.repo, changes=status)
             else:
                 wctx = self.repo[None]
                 self.repo.bfstatus = True
@@ -599,6 +662,7 @@ class StatusThread(QThread):
                 wctx.status(**stopts)
                 self.repo.bfstatus = False
                 self.repo.lfstatus = False
+            wctx.filesizes = sizes
             self.wctx = wctx
 
             wctx.dirtySubrepos = []
@@ -616,6 +680,9 @@ class StatusThread(QThread):
             else:
                 err = hglib.tounicode(str(e))
             self.showMessage.emit(err)
+        if self.wctx is None:
+            # otherwise released once the wctx is replaced
+            repopool.release(self.repo)
 
 
 class WctxFileTree(QTreeView):
@@ -686,6 +753,13 @@ class WctxFileTree(QTreeView):
         self._paletteswitcher.enablefilterpalette(enable)
 
 class WctxModel(QAbstractTableModel):
+    """Files of the working directory status
+
+    Rows can be added in batches while the status is computed, by addFiles()
+    then finishFiles(), or all at once from a working context. They are kept
+    in an index sorted by the current sort column, which batches are merged
+    into, and the shown rows are the ones of the index matching the filter.
+    """
     checkCountChanged = pyqtSignal()
     checkToggled = pyqtSignal(QString, bool)
 
@@ -694,76 +768,153 @@ class WctxModel(QAbstractTableModel):
         QAbstractTableModel.__init__(self, parent)
         self.partials = parent.partials
         self.checkCount = 0
-        rows = []
-        nchecked = {}
-        excludes = [f.strip() for f in opts.get('ciexclude', '').split(',')]
-        def mkrow(fname, st):
-            ext, sizek = '', ''
-            try:
-                mst = fname in ms and ms[fname].upper() or ""
-                name, ext = os.path.splitext(fname)
-                sizebytes = wctx[fname].size()
-                sizek = (sizebytes + 1023) // 1024
-            except EnvironmentError:
-                pass
-            return [fname, st, mst, hglib.tounicode(fname), ext[1:], sizek]
+        self._ms = ms
+        self._opts = opts
+        self._defcheck = defcheck
+        self._excludes = [f.strip()
+                          for f in opts.get('ciexclude', '').split(',')]
         if not savechecks:
             checked = {}
+        self._oldchecked = checked
         if pctx:
             # Currently, having a patch context means it's a qrefresh, so only
             # auto-check files in pctx.files()
             pctxfiles = pctx.files()
-            pctxmatch = lambda f: f in pctxfiles
+            self._pctxmatch = lambda f: f in pctxfiles
         else:
-            pctxmatch = lambda f: True
-        if opts['modified']:
-            for m in wctx.modified():
-                nchecked[m] = checked.get(m, 'M' in defcheck and
-                                          m not in excludes and pctxmatch(m))
-                rows.append(mkrow(m, 'M'))
-        if opts['added']:
-            for a in wctx.added():
-                nchecked[a] = checked.get(a, 'A' in defcheck and
-                                          a not in excludes and pctxmatch(a))
-                rows.append(mkrow(a, 'A'))
-        if opts['removed']:
-            for r in wctx.removed():
-                nchecked[r] = checked.get(r, 'R' in defcheck and
-                                          r not in excludes and pctxmatch(r))
-                rows.append(mkrow(r, 'R'))
-        if opts['deleted']:
-            for d in wctx.deleted():
-                nchecked[d] = checked.get(d, 'D' in defcheck and
-                                          d not in excludes and pctxmatch(d))
-                rows.append(mkrow(d, '!'))
-        if opts['unknown']:
-            for u in wctx.unknown() or []:
-                nchecked[u] = checked.get(u, '?' in defcheck)
-                rows.append(mkrow(u, '?'))
-        if opts['ignored']:
-            for i in wctx.ignored() or []:
-                nchecked[i] = checked.get(i, 'I' in defcheck)
-                rows.append(mkrow(i, 'I'))
-        if opts['clean']:
-            for c in wctx.clean() or []:
-                nchecked[c] = checked.get(c, 'C' in defcheck)
-                rows.append(mkrow(c, 'C'))
-        if opts['subrepo']:
-            for s in wctx.dirtySubrepos:
-                nchecked[s] = checked.get(s, 'S' in defcheck)
-                rows.append(mkrow(s, 'S'))
-        # include clean unresolved files
-        for f in ms:
-            if ms[f] == 'u' and f not in nchecked:
-                nchecked[f] = checked.get(f, True)
-                rows.append(mkrow(f, 'C'))
+            self._pctxmatch = lambda f: True
         self.headers = ('*', _('Stat'), _('M'), _('Filename'),
                         _('Type'), _('Size (KB)'))
-        self.checked = nchecked
-        self.unfiltered = rows
-        self.rows = rows
+        self.checked = {}
         self.checkable = checkable
 
+        self._sortcol = None  # rows are kept in the order they are added
+        self._sortorder = Qt.AscendingOrder
+        self._nextserial = 0
+        self._filter = u''
+        # (sort key, lowercase display path, row) of all rows, and of the
+        # shown ones, sorted by key; the same list while not filtered
+        self._index = []
+        self._shown = []
+        self.rows = []
+        if wctx is not None:
+            self.addFiles(self._wctxFiles(wctx, 'MAR!?IC'))
+            self.finishFiles(wctx)
+
+    def _wctxFiles(self, wctx, stats):
+        # sizes from lstat of the status walk, if any
+        sizes = getattr(wctx, 'filesizes', {})
+        for st in stats:
+            name = statusTypes[st].name
+            if not self._opts[name]:
+                continue
+            if st == 'S':
+                files = wctx.dirtySubrepos
+            else:
+                files = getattr(wctx, name)() or []
+            for fname in files:
+                size = sizes.get(fname)
+                if size is None:
+                    try:
+                        size = wctx[fname].size()
+                    except EnvironmentError:
+                        pass
+                yield fname, st, size
+
+    def _defaultChecked(self, fname, st):
+        if st in 'MAR!':
+            return ((st == '!' and 'D' or st) in self._defcheck
+                    and fname not in self._excludes and self._pctxmatch(fname))
+        return st in self._defcheck
+
+    def addFiles(self, files):
+        """Add rows for (path, status, size) of files, size being None if
+        unknown; files of statuses not shown are skipped"""
+        self._addRows((fname, st, size, self._defaultChecked(fname, st))
+                      for fname, st, size in files
+                      if self._opts[statusTypes[st].name])
+
+    def finishFiles(self, wctx):
+        """Add the rows of subrepos and of clean unresolved files, which are
+        known once the status of wctx is complete"""
+        self.addFiles(self._wctxFiles(wctx, 'S'))
+        # include clean unresolved files
+        self._addRows((f, 'C', None, True) for f in self._ms
+                      if self._ms[f] == 'u' and f not in self.checked)
+
+    def _addRows(self, items):
+        batch = []
+        for fname, st, sizebytes, defchecked in items:
+            self.checked[fname] = self._oldchecked.get(fname, defchecked)
+            mst = fname in self._ms and self._ms[fname].upper() or ""
+            ext = os.path.splitext(fname)[1]
+            sizek = ''
+            if sizebytes is not None:
+                sizek = (sizebytes + 1023) // 1024
+            row = [fname, st, mst, hglib.tounicode(fname), ext[1:], sizek]
+            key = self._sortKey(row, _serialkey(self._nextserial))
+            self._nextserial += 1
+            batch.append((key, row[COL_PATH_DISPLAY].lower(), row))
+        if not batch:
+            return
+        batch.sort()
+        if self._filter:
+            # both are sorted runs, which sort() merges in linear time
+            self._index.extend(batch)
+            self._index.sort()
+            self._insertShown(self._filtered(batch))
+        else:
+            self._insertShown(batch)
+            self._index = self._shown
+
+    def _insertShown(self, entries):
+        if not entries:
+            return
+        merged = self._shown + entries
+        merged.sort()  # merges the two sorted runs
+        if len(entries) > 64:
+            # cheaper to lay out everything again than to insert many runs
+            self._setShown(merged)
+            return
+        runs = []
+        for e in entries:
+            pos = bisect.bisect_left(merged, e)
+            if runs and runs[-1][1] == pos - 1:
+                runs[-1][1] = pos
+            else:
+                runs.append([pos, pos])
+        # the rows before each run are already the ones of merged
+        for first, last in runs:
+            self.beginInsertRows(QModelIndex(), first, last)
+            self._shown[first:first] = merged[first:last + 1]
+            self.rows[first:first] = map(_rowof, merged[first:last + 1])
+            self.endInsertRows()
+
+    def _setShown(self, entries):
+        """Replace the shown rows, moving persistent indexes along"""
+        self.layoutAboutToBeChanged.emit()
+        try:
+            oldindexes = [(i, self.rows[i.row()])
+                          for i in self.persistentIndexList()]
+            self._shown = entries
+            self.rows = map(_rowof, entries)
+            if oldindexes:
+                newrows = dict((id(r), i) for i, r in enumerate(self.rows))
+                for oi, row in oldindexes:
+                    if id(row) in newrows:
+                        ni = self.index(newrows[id(row)], oi.column())
+                    else:
+                        ni = QModelIndex()
+                    self.changePersistentIndex(oi, ni)
+        finally:
+            self.layoutChanged.emit()
+
+    def _filtered(self, entries):
+        needle = self._filter
+        if not needle:
+            return entries
+        return [e for e in entries if needle in e[1]]
+
     def rowCount(self, parent):
         if parent.isValid():
             return 0 # no child
@@ -880,87 +1031,89 @@ class WctxModel(QAbstractTableModel):
         self.layoutChanged.emit()
         self.checkCountChanged.emit()
 
-    def sort(self, col, order):
-        self.layoutAboutToBeChanged.emit()
-
-        def getStatusRank(value):
-            """Helper function used to sort items according to their hg status
-
-            Statuses are ranked in the following order:
-                'S','M','A','R','!','?','C','I',''
-            """
-            sortList = ['S','M','A','R','!','?','C','I','']
-
-            try:
-                rank = sortList.index(value)
-            except (IndexError, ValueError):
-                rank = len(sortList) # Set the lowest rank by default
-
-            return rank
+    def _sortKey(self, row, serial):
+        """Return the sort key of row, serial being the packed number of
+        rows added before it
+
+        Keys are byte strings, compared much faster than tuples. Files of
+        equal value in the sort column are sorted by path, in ascending
+        order even if the sort column is in descending order.
+        """
+        col = self._sortcol
+        if col is None:
+            return serial
+        descending = self._sortorder == Qt.DescendingOrder
+        path = row[COL_PATH].lower()
+        if col == COL_PATH_DISPLAY:
+            if descending:
+                return _descendingkey(path) + serial
+            return path + '\0' + serial
+        if col == COL_PATH:
+            value = int(bool(self.checked[row[COL_PATH]]))
+        elif col == COL_STATUS:
+            value = _statusranks.get(row[col], len(_statusranks))
+        elif col == COL_MERGE_STATE:
+            value = _mergeranks.get(row[col], len(_mergeranks))
+        elif col == COL_SIZE:
+            value = row[col] == '' and -1 or row[col]
+        else:
+            value = row[col]
+        if isinstance(value, str):
+            if descending:
+                value = _descendingkey(value)
+            else:
+                value += '\0'
+        else:
+            value = _numberkey(value + 1)
+            if descending:
+                value = value.translate(_complement)
+        return value + path + '\0' + serial
 
-        def getMergeStatusRank(value):
-            """Helper function used to sort according to item merge status
+    def sort(self, col, order):
+        self._sortcol = col
+        self._sortorder = order
+        self._index = sorted((self._sortKey(row, key[-4:]), lpath, row)
+                             for key, lpath, row in self._index)
+        self._setShown(self._filtered(self._index))
 
-            Merge statuses are ranked in the following order:
-                'S','U','R',''
-            """
-            sortList = ['S','U','R','']
+    def setFilter(self, match):
+        'simple match in filename filter, ignoring case'
+        needle = unicode(match).lower()
+        if self._filter and self._filter in needle:
+            # narrowed, only the shown rows can match
+            entries = self._shown
+        else:
+            entries = self._index
+        self._filter = needle
+        self._setShown(self._filtered(entries))
 
-            try:
-                rank = sortList.index(value)
-            except (IndexError, ValueError):
-                rank = len(sortList) # Set the lowest rank by default
+    def getChecked(self):
+        return self.checked.copy()
 
-            return rank
+# rank of statuses and merge statuses in ascending order
+_statusranks = dict((s, i) for i, s in enumerate('SMAR!?CI'))
+_mergeranks = dict((s, i) for i, s in enumerate('SUR'))
 
-        # We want to sort the list by one of the columns (checked state,
-        # mercurial status, file path, file extension, etc)
-        # However, for files which have the same status or extension, etc,
-        # we want them to be sorted alphabetically (without taking into account
-        # the case)
-        # Since Python 2.3 the sort function is guaranteed to be stable.
-        # Thus we can perform the sort in two passes:
-        # 1.- Perform a secondary sort by path
-        # 2.- Perform a primary sort by the actual column that we are sorting on
+# fixed width encodings of positive numbers, in the order of the numbers
+def _numberkey(n):
+    return struct.pack('>Q', n)
 
-        # Secondary sort:
-        self.rows.sort(key=lambda x: x[COL_PATH].lower())
+def _serialkey(n):
+    return struct.pack('>I', n)
 
-        if col == COL_PATH_DISPLAY:
-            # Already sorted!
-            pass
-        else:
-            if order == Qt.DescendingOrder:
-                # We want the secondary sort to be by _ascending_ path,
-                # even when the primary sort is in descending order
-                self.rows.reverse()
-
-            # Now we can perform the primary sort
-            if col == COL_PATH:
-                c = self.checked
-                self.rows.sort(key=lambda x: c[x[col]])
-            elif col == COL_STATUS:
-                self.rows.sort(key=lambda x: getStatusRank(x[col]))
-            elif col == COL_MERGE_STATE:
-                self.rows.sort(key=lambda x: getMergeStatusRank(x[col]))
-            else:
-                self.rows.sort(key=lambda x: x[col])
+# complement of each byte, making the ascending order of complemented
+# strings the descending order of the strings
+_complement = ''.join(chr(255 - i) for i in xrange(256))
 
-        if order == Qt.DescendingOrder:
-            self.rows.reverse()
-        self.layoutChanged.emit()
-        self.reset()
+def _descendingkey(s):
+    """Return a key of byte string s sorting in descending order
 
-    def setFilter(self, match):
-        'simple match in filename filter'
-        self.layoutAboutToBeChanged.emit()
-        self.rows = [r for r in self.unfiltered
-                     if unicode(match) in r[COL_PATH_DISPLAY]]
-        self.layoutChanged.emit()
-        self.reset()
+    >>> sorted(['a', 'ab', 'b', ''], key=_descendingkey)
+    ['b', 'ab', 'a', '']
+    """
+    return s.translate(_complement) + '\xff'
 
-    def getChecked(self):
-        return self.checked.copy()
+_rowof = operator.itemgetter(2)
 
 def statusMessage(status, mst, upath):
     tip = ''
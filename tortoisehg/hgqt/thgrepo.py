@@ -22,7 +22,7 @@ from mercurial import merge, subrepo
 from mercurial import ui as uimod
 from mercurial.util import propertycache
 
-from tortoisehg.util import hglib, paths
+from tortoisehg.util import hglib, inotify, paths
 from tortoisehg.util.patchctx import patchctx
 
 _repocache = {}
@@ -70,27 +70,152 @@ def repository(_ui=None, path='', bundle=None):
 class _LockStillHeld(Exception):
     'Raised to abort status check due to lock existence'
 
+# parts of repository notified by RepoWatcher, to be invalidated
+CHANGE_CHANGELOG = 0x01
+CHANGE_PHASES = 0x02
+CHANGE_BOOKMARKS = 0x04
+CHANGE_LOCALTAGS = 0x08
+CHANGE_DIRSTATE = 0x10
+CHANGE_MQ = 0x20
+CHANGE_CONFIG = 0x40
+CHANGE_ALL = 0x7f
+
+_changenames = [
+    (CHANGE_CHANGELOG, 'changelog'),
+    (CHANGE_PHASES, 'phases'),
+    (CHANGE_BOOKMARKS, 'bookmarks'),
+    (CHANGE_LOCALTAGS, 'localtags'),
+    (CHANGE_DIRSTATE, 'dirstate'),
+    (CHANGE_MQ, 'mq'),
+    (CHANGE_CONFIG, 'config'),
+    ]
+
+class InotifyWatcher(QObject):
+    """Subset of QFileSystemWatcher implemented with inotify
+
+    Events read at once are reported by a single signal per path. Raises
+    OSError if inotify is not available.
+    """
+
+    directoryChanged = pyqtSignal(QString)
+    fileChanged = pyqtSignal(QString)
+
+    def __init__(self, parent=None):
+        super(InotifyWatcher, self).__init__(parent)
+        self._inotify = inotify.Inotify()
+        self._paths = {}  # wd: (path, isdir)
+        self._wds = {}  # path: wd
+        self._notifier = QSocketNotifier(self._inotify.fileno(),
+                                         QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self._readEvents)
+
+    def addPath(self, path):
+        path = unicode(path)
+        if path in self._wds:
+            return
+        isdir = os.path.isdir(path)
+        if isdir:
+            mask = inotify.IN_DIRCHANGES | inotify.IN_ONLYDIR
+        else:
+            mask = inotify.IN_FILECHANGES
+        try:
+            wd = self._inotify.addwatch(hglib.fromunicode(path), mask)
+        except OSError, e:
+            dbgoutput('failed to watch %s: %s' % (hglib.fromunicode(path), e))
+            return
+        # a path replaced by rename may come back with the same wd
+        self._removeWatch(wd)
+        self._paths[wd] = (path, isdir)
+        self._wds[path] = wd
+
+    def removePaths(self, paths):
+        for path in paths:
+            wd = self._wds.get(unicode(path))
+            if wd is not None:
+                self._inotify.rmwatch(wd)
+                self._removeWatch(wd)
+
+    def _removeWatch(self, wd):
+        if wd in self._paths:
+            path, _isdir = self._paths.pop(wd)
+            del self._wds[path]
+
+    def directories(self):
+        return [path for path, isdir in self._paths.itervalues() if isdir]
+
+    def files(self):
+        return [path for path, isdir in self._paths.itervalues() if not isdir]
+
+    @pyqtSlot()
+    def _readEvents(self):
+        changed = {}
+        for wd, mask, _name in self._inotify.read():
+            if mask & inotify.IN_Q_OVERFLOW:
+                # lost events, report all paths
+                for path, isdir in self._paths.itervalues():
+                    changed[path] = isdir
+                continue
+            if wd not in self._paths:
+                continue
+            path, isdir = self._paths[wd]
+            changed[path] = isdir
+            if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF
+                       | inotify.IN_MOVE_SELF):
+                # the watched path is gone, it can be added again
+                self._inotify.rmwatch(wd)
+                self._removeWatch(wd)
+        for path, isdir in sorted(changed.iteritems()):
+            if isdir:
+                self.directoryChanged.emit(path)
+            else:
+                self.fileChanged.emit(path)
+
+def _createfswatcher(parent):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(parent)
+        except OSError, e:
+            dbgoutput('inotify not available: %s' % e)
+    return QFileSystemWatcher(parent)
+
 class RepoWatcher(QObject):
-    """Notify changes of repository by optionally monitoring filesystem"""
+    """Notify changes of repository by optionally monitoring filesystem
+
+    Bursts of filesystem events are coalesced into a single check of the
+    repository state, made once events stop for `pollDelay` ms, or after
+    `maxPollDelay` ms of continuous events. `eventsReceived` and
+    `signalsEmitted` count the events and the resulting notifications.
+
+    repositoryChanged carries the CHANGE_* flags of the modified parts.
+    """
 
     configChanged = pyqtSignal()
-    repositoryChanged = pyqtSignal()
+    repositoryChanged = pyqtSignal(int)
     repositoryDestroyed = pyqtSignal()
     workingBranchChanged = pyqtSignal()
 
+    pollDelay = 100
+    maxPollDelay = 1000
+
     def __init__(self, repo, parent=None):
         super(RepoWatcher, self).__init__(parent)
         self.repo = repo
         self._fswatcher = None
+        self._polltimer = QTimer(self)
+        self._polltimer.setSingleShot(True)
+        self._polltimer.timeout.connect(self._pollChanges)
+        self._pollsince = 0
+        self.eventsReceived = 0
+        self.signalsEmitted = 0
         self.recordState()
         self._uimtime = time.time()
 
     def startMonitoring(self):
         """Start filesystem monitoring to notify changes automatically"""
         if not self._fswatcher:
-            self._fswatcher = QFileSystemWatcher(self)
-            self._fswatcher.directoryChanged.connect(self._pollChanges)
-            self._fswatcher.fileChanged.connect(self._pollChanges)
+            self._fswatcher = _createfswatcher(self)
+            self._fswatcher.directoryChanged.connect(self._onFsChanged)
+            self._fswatcher.fileChanged.connect(self._onFsChanged)
         self._fswatcher.addPath(hglib.tounicode(self.repo.path))
         self._fswatcher.addPath(hglib.tounicode(self.repo.spath))
         self.addMissingPaths()
@@ -101,6 +226,7 @@ class RepoWatcher(QObject):
         if not self._fswatcher:
             return
         self._fswatcher.blockSignals(True)  # ignore pending events
+        self._polltimer.stop()
         dirs = self._fswatcher.directories()
         if dirs:
             self._fswatcher.removePaths(dirs)
@@ -122,6 +248,16 @@ class RepoWatcher(QObject):
             return False
         return not self._fswatcher.signalsBlocked()
 
+    @pyqtSlot()
+    def _onFsChanged(self):
+        self.eventsReceived += 1
+        now = time.time()
+        if not self._polltimer.isActive():
+            self._pollsince = now
+        elif (now - self._pollsince) * 1000 >= self.maxPollDelay:
+            return  # let it time out
+        self._polltimer.start(self.pollDelay)
+
     @pyqtSlot()
     def _pollChanges(self):
         '''Catch writes or deletions of files, or writes to .hg/ folder,
@@ -147,20 +283,24 @@ class RepoWatcher(QObject):
     def pollStatus(self):
         if not os.path.exists(self.repo.path):
             dbgoutput('Repository destroyed', self.repo.root)
-            self.repositoryDestroyed.emit()
+            self._emit(self.repositoryDestroyed)
             return
         if self.locked():
             dbgoutput('locked, aborting')
             return
         try:
-            if self._checkdirstate():
-                dbgoutput('dirstate changed, exiting')
-                return
-            self._checkrepotime()
+            changes = self._checkdirstate() | self._checkrepotime()
+            if changes:
+                self.recordState()
+                self._emit(self.repositoryChanged, changes)
             self._checkuimtime()
         except _LockStillHeld:
             dbgoutput('lock still held - ignoring for now')
 
+    def _emit(self, signal, *args):
+        self.signalsEmitted += 1
+        signal.emit(*args)
+
     def locked(self):
         if os.path.lexists(self.repo.join('wlock')):
             return True
@@ -171,7 +311,7 @@ class RepoWatcher(QObject):
     def recordState(self):
         try:
             self._parentnodes = self._getrawparents()
-            self._repomtime = self._getrepomtime()
+            self._repomtimes = self._getrepomtimes()
             self._dirstatemtime = os.path.getmtime(self.repo.join('dirstate'))
             self._branchmtime = os.path.getmtime(self.repo.join('branch'))
             self._rawbranch = self.repo.opener('branch').read()
@@ -186,47 +326,62 @@ class RepoWatcher(QObject):
         except EnvironmentError:
             return None
 
+    def _getwatchedfilechanges(self):
+        'Return (path, change) of files telling which part of repo changed'
+        repo = self.repo
+        watched = [(repo.sjoin('00changelog.i'), CHANGE_CHANGELOG),
+                   (repo.sjoin('phaseroots'), CHANGE_PHASES),
+                   (repo.join('bookmarks'), CHANGE_BOOKMARKS),
+                   (repo.join('bookmarks.current'), CHANGE_BOOKMARKS),
+                   (repo.join('localtags'), CHANGE_LOCALTAGS)]
+        if hasattr(repo, 'mq'):
+            watched.extend([(repo.mq.path, CHANGE_MQ),
+                            (repo.mq.join('series'), CHANGE_MQ),
+                            (repo.mq.join('status'), CHANGE_MQ),
+                            (repo.mq.join('guards'), CHANGE_MQ),
+                            (repo.join('patches.queue'), CHANGE_MQ)])
+        return watched
+
     def _getwatchedfiles(self):
-        watchedfiles = [self.repo.sjoin('00changelog.i')]
-        watchedfiles.append(self.repo.sjoin('phaseroots'))
-        watchedfiles.append(self.repo.join('localtags'))
-        if hasattr(self.repo, 'mq'):
-            watchedfiles.append(self.repo.mq.path)
-            watchedfiles.append(self.repo.mq.join('series'))
-            watchedfiles.append(self.repo.mq.join('guards'))
-            watchedfiles.append(self.repo.join('patches.queue'))
-        return watchedfiles
-
-    def _getrepomtime(self):
-        'Return the last modification time for the repo'
-        try:
-            existing = [f for f in self._getwatchedfiles() if os.path.isfile(f)]
-            mtime = [os.path.getmtime(wf) for wf in existing]
-            if mtime:
-                return max(mtime)
-        except EnvironmentError:
-            return None
+        return [f for f, _change in self._getwatchedfilechanges()]
+
+    def _getrepomtimes(self):
+        'Return the modification time of the existing watched files'
+        mtimes = {}
+        for f in self._getwatchedfiles():
+            try:
+                if os.path.isfile(f):
+                    mtimes[f] = os.path.getmtime(f)
+            except EnvironmentError:
+                pass
+        return mtimes
 
     def _checkrepotime(self):
         'Check for new changelog entries, or MQ status changes'
-        if self._repomtime < self._getrepomtime():
+        changes = 0
+        mtimes = self._getrepomtimes()
+        for f, change in self._getwatchedfilechanges():
+            if mtimes.get(f) != self._repomtimes.get(f):
+                changes |= change
+        if changes:
             dbgoutput('detected repository change')
             if self.locked():
                 raise _LockStillHeld
-            self.recordState()
-            self.repositoryChanged.emit()
+        return changes
 
     def _checkdirstate(self):
         'Check for new dirstate mtime, then working parent changes'
         try:
             mtime = os.path.getmtime(self.repo.join('dirstate'))
         except EnvironmentError:
-            return False
+            return 0
         if mtime <= self._dirstatemtime:
-            return False
-        changed = self._checkparentchanges() or self._checkbranch()
-        self._dirstatemtime = mtime
-        return changed
+            return 0
+        changes = self._checkparentchanges()
+        if not changes:
+            self._checkbranch()
+            self._dirstatemtime = mtime
+        return changes
 
     def _checkparentchanges(self):
         nodes = self._getrawparents()
@@ -234,10 +389,8 @@ class RepoWatcher(QObject):
             dbgoutput('dirstate change found')
             if self.locked():
                 raise _LockStillHeld
-            self.recordState()
-            self.repositoryChanged.emit()
-            return True
-        return False
+            return CHANGE_DIRSTATE
+        return 0
 
     def _checkbranch(self):
         try:
@@ -260,7 +413,7 @@ class RepoWatcher(QObject):
             if self.locked():
                 raise _LockStillHeld
             self._rawbranch = newbranch
-            self.workingBranchChanged.emit()
+            self._emit(self.workingBranchChanged)
             return True
         return False
 
@@ -272,7 +425,7 @@ class RepoWatcher(QObject):
             if mtime > self._uimtime:
                 dbgoutput('config change detected')
                 self._uimtime = mtime
-                self.configChanged.emit()
+                self._emit(self.configChanged)
         except (EnvironmentError, ValueError):
             pass
 
@@ -337,9 +490,9 @@ class RepoAgent(QObject):
         self._repo.invalidateui()
         self.configChanged.emit()
 
-    @pyqtSlot()
-    def _onRepositoryChanged(self):
-        self._repo.thginvalidate()
+    @pyqtSlot(int)
+    def _onRepositoryChanged(self, changes):
+        self._repo.thginvalidate(changes)
         self.repositoryChanged.emit()
 
     @pyqtSlot()
@@ -351,7 +504,7 @@ class RepoAgent(QObject):
 
     @pyqtSlot()
     def _onWorkingBranchChanged(self):
-        self._repo.thginvalidate()
+        self._repo.thginvalidate(CHANGE_DIRSTATE)
         self.workingBranchChanged.emit()
 
     def isBusy(self):
@@ -472,8 +625,12 @@ class RepoManager(QObject):
 _uiprops = '''_uifiles postpull tabwidth maxdiff
               deadbranches _exts _thghiddentags displayname summarylen
               shortname mergetools namedbranches'''.split()
-_thgrepoprops = '''_thgmqpatchnames thgmqunappliedpatches
-                   _branchheads'''.split()
+_mqprops = '''mq _thgmqpatchnames thgmqunappliedpatches'''.split()
+_changelogprops = '''_branchheads namedbranches'''.split()
+# cached by localrepository, reloaded only if the file was changed where
+# filecache is used
+_phasesprops = ['_phasecache', '_phaseroots', '_phaserev']
+_bookmarksprops = ['_bookmarks', '_bookmarkcurrent']
 
 def _extendrepo(repo):
     class thgrepository(repo.__class__):
@@ -693,18 +850,47 @@ def _extendrepo(repo):
             f = open(os.path.join(self.shelfdir, patch), "wb")
             f.close()
 
-        def thginvalidate(self):
-            'Should be called when mtime of repo store/dirstate are changed'
-            self.dirstate.invalidate()
+        @propertycache
+        def thginvalidatecounts(self):
+            'Number of invalidations by part of repository, for debugging'
+            return dict((name, 0) for _change, name in _changenames)
+
+        def thginvalidate(self, changes=CHANGE_ALL):
+            '''Should be called when mtime of repo store/dirstate are changed
+
+            changes is the CHANGE_* flags of the parts to invalidate.'''
+            names = [name for change, name in _changenames
+                     if changes & change]
+            for name in names:
+                self.thginvalidatecounts[name] += 1
+            dbgoutput('invalidate', ' '.join(names))
+            props = []
+            if changes & CHANGE_DIRSTATE:
+                self.dirstate.invalidate()
             if not isinstance(repo, bundlerepo.bundlerepository):
-                self.invalidate()
-            # mq.queue.invalidate does not handle queue changes, so force
-            # the queue object to be rebuilt
-            if 'mq' in self.__dict__:
-                delattr(self, 'mq')
-            for a in _thgrepoprops + _uiprops:
+                if changes & (CHANGE_CHANGELOG | CHANGE_LOCALTAGS):
+                    # tags and branch heads depend on both
+                    self.invalidate()
+                    props.extend(_changelogprops)
+                else:
+                    if changes & CHANGE_PHASES:
+                        props.extend(_phasesprops)
+                    if changes & CHANGE_BOOKMARKS:
+                        props.extend(_bookmarksprops)
+                if (changes & CHANGE_PHASES
+                    and hasattr(self, 'invalidatevolatilesets')):
+                    # hidden revisions depend on phases
+                    self.invalidatevolatilesets()
+            if changes & CHANGE_MQ:
+                # mq.queue.invalidate does not handle queue changes, so force
+                # the queue object to be rebuilt
+                props.extend(_mqprops)
+            if changes & CHANGE_CONFIG:
+                props.extend(_uiprops)
+            for a in props:
                 if a in self.__dict__:
-                    delattr(self, a)
+                    # not delattr(), which filecache may not support
+                    del self.__dict__[a]
 
         def invalidateui(self):
             'Should be called when mtime of ui files are changed'
@@ -0,0 +1,343 @@
+# annotatecache.py - incremental annotation of file revisions
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""incremental annotation of file revisions
+
+Files are annotated as filectx.annotate(follow=True, linenumber=True)
+does, but the annotations of file revisions are kept, keyed by the path
+and filelog node of the revision and by the diff options they were
+computed with.
+
+Lines are resolved walking back from the revision, the latest revisions
+first, so that they can be shown as they are found, until each of them is
+found changed in a revision or reaches an annotated ancestor. A revision
+whose parents are annotated is thus annotated by diffing it against them,
+so browsing successive revisions of a file costs one diff each rather than
+a walk of its whole history.
+
+An annotation is stored as a table of the (path, filelog node) the lines
+come from, and arrays of the index in this table and of the line number
+of each line. Nodes are kept rather than revision numbers, which change
+when a repository is stripped.
+
+Annotations are kept in memory, the least recently used first discarded
+past a number of bytes, and written under .hg/cache/thgannotate/, the
+least recently used files being removed past a number of bytes.
+"""
+
+import array
+import heapq
+import marshal
+import os
+import threading
+
+from mercurial import mdiff, util
+from mercurial.node import nullrev
+
+CACHE_VERSION = 1
+
+def _optskey(diffopts):
+    """Key of the diff options changing the blocks annotations rely on"""
+    if diffopts is None:
+        diffopts = mdiff.defaultopts
+    return tuple(bool(getattr(diffopts, name, False)) for name in
+                 ('ignorews', 'ignorewsamount', 'ignoreblanklines'))
+
+def pack(lines):
+    """Return the compact form of a list of (source, line number)
+
+    >>> sources, srcs, linenos = pack([(('a', 'n1'), 1), (('b', 'n2'), 1),
+    ...                                (('a', 'n1'), 3)])
+    >>> sources, map(int, srcs), map(int, linenos)
+    ((('a', 'n1'), ('b', 'n2')), [0, 1, 0], [1, 1, 3])
+    """
+    sources = []
+    index = {}
+    srcs = array.array('I')
+    linenos = array.array('I')
+    for src, lineno in lines:
+        i = index.get(src)
+        if i is None:
+            i = index[src] = len(sources)
+            sources.append(src)
+        srcs.append(i)
+        linenos.append(lineno)
+    return tuple(sources), srcs, linenos
+
+def unpack(packed):
+    """Return the list of (source, line number) of a compact annotation"""
+    sources, srcs, linenos = packed
+    return [(sources[i], lineno) for i, lineno in zip(srcs, linenos)]
+
+def _packedsize(packed):
+    sources, srcs, linenos = packed
+    return (srcs.itemsize * len(srcs) + linenos.itemsize * len(linenos)
+            + 64 * len(sources))
+
+class AnnotateCache(object):
+    """Annotations of the file revisions of a repository"""
+    _dir = 'cache/thgannotate'
+
+    def __init__(self, maxmemory=32 << 20, maxdisk=64 << 20):
+        self.maxmemory = maxmemory
+        self.maxdisk = maxdisk
+        self._lock = threading.Lock()
+        self._entries = {}  # key: [last use, size, packed annotation]
+        self._size = 0
+        self._tick = 0
+
+    def _get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._tick += 1
+            entry[0] = self._tick
+            return entry[2]
+        finally:
+            self._lock.release()
+
+    def _put(self, key, packed):
+        size = _packedsize(packed)
+        self._lock.acquire()
+        try:
+            old = self._entries.get(key)
+            if old is not None:
+                self._size -= old[1]
+            self._tick += 1
+            self._entries[key] = [self._tick, size, packed]
+            self._size += size
+            if self._size > self.maxmemory:
+                # the least recently used down to 3/4 of the limit
+                for entry in sorted(self._entries.iteritems(),
+                                    key=lambda e: e[1][0]):
+                    if self._size <= self.maxmemory * 3 // 4:
+                        break
+                    del self._entries[entry[0]]
+                    self._size -= entry[1][1]
+        finally:
+            self._lock.release()
+
+    def _filename(self, key):
+        return '%s/%s' % (self._dir, util.sha1(repr(key)).hexdigest())
+
+    def _read(self, repo, key):
+        """Return the annotation of key stored on disk, or None"""
+        name = self._filename(key)
+        try:
+            f = repo.opener(name, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+            os.utime(repo.join(name), None)
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(data, tuple) or len(data) != 5
+            or data[:2] != (CACHE_VERSION, key)):
+            return None
+        srcs = array.array('I')
+        srcs.fromstring(data[3])
+        linenos = array.array('I')
+        linenos.fromstring(data[4])
+        return data[2], srcs, linenos
+
+    def _write(self, repo, key, packed):
+        sources, srcs, linenos = packed
+        data = (CACHE_VERSION, key, sources, srcs.tostring(),
+                linenos.tostring())
+        try:
+            f = repo.opener(self._filename(key), 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+            self._evictfiles(repo.join(self._dir))
+        except (EnvironmentError, ValueError):
+            pass
+
+    def _evictfiles(self, path):
+        """Remove the least recently used files of path past maxdisk"""
+        files = []
+        total = 0
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        if total <= self.maxdisk:
+            return
+        files.sort()
+        for mtime, size, name in files:
+            if total <= self.maxdisk * 3 // 4:
+                break
+            try:
+                os.unlink(os.path.join(path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def lookup(self, repo, path, node, diffopts=None):
+        """Return the compact annotation of the revision node of path if
+        known, from memory or disk, or None"""
+        key = (path, node, _optskey(diffopts))
+        packed = self._get(key)
+        if packed is None:
+            packed = self._read(repo, key)
+            if packed is not None:
+                self._put(key, packed)
+        return packed
+
+    def iterannotate(self, repo, path, node, diffopts=None):
+        """Yield lists of (line index, (source, line number)) resolving
+        the lines of the revision node of path, the lines coming from the
+        latest revisions first
+
+        Source is the (path, filelog node) of the revision the line comes
+        from, following copies and renames. Lines are resolved by walking
+        back from the revision, until all of them are found in a revision
+        or an annotated ancestor.
+        """
+        optskey = _optskey(diffopts)
+        packed = self.lookup(repo, path, node, diffopts)
+        if packed is not None:
+            yield list(enumerate(unpack(packed)))
+            return
+        logs = {}
+        def getlog(path):
+            if path not in logs:
+                logs[path] = repo.file(path)
+            return logs[path]
+        def linkrev(f):
+            fl = getlog(f[0])
+            return fl.linkrev(fl.rev(f[1]))
+        def parents(f):
+            path, node = f
+            fl = getlog(path)
+            pl = [(path, r) for r in fl.parentrevs(fl.rev(node))]
+            renamed = fl.renamed(node)
+            if renamed:
+                pl[0] = (renamed[0], getlog(renamed[0]).rev(renamed[1]))
+            return [(p, getlog(p).node(r)) for p, r in pl if r != nullrev]
+
+        base = (path, node)
+        texts = {base: getlog(path).read(node)}
+        # as many lines as the editor shows and filectx.annotate() counts,
+        # bare CRs ending lines, though diff blocks do not split them
+        size = len(texts[base].splitlines())
+        result = [None] * size
+        # (revision, lines) of which the lines of base are looked for,
+        # children being walked before their parents
+        pending = {base: [(i, i) for i in xrange(size)]}
+        heap = [(-linkrev(base), base)]
+        while heap:
+            f = heapq.heappop(heap)[1]
+            queries = pending.pop(f)
+            text = texts.pop(f, None)
+            resolved = []
+            packed = f != base and self.lookup(repo, f[0], f[1], diffopts)
+            if packed:
+                sources, srcs, linenos = packed
+                for i, j in queries:
+                    resolved.append((i, (sources[srcs[j]], linenos[j])))
+            else:
+                if text is None:
+                    text = getlog(f[0]).read(f[1])
+                # like filectx.annotate(), the last parent a line is
+                # unchanged from is where it comes from
+                origins = [None] * len(text.splitlines())
+                for p in parents(f):
+                    ptext = texts.get(p)
+                    if ptext is None:
+                        ptext = getlog(p[0]).read(p[1])
+                    blocks = mdiff.allblocks(ptext, text, opts=diffopts,
+                                             refine=True)
+                    used = False
+                    for (a1, a2, b1, b2), t in blocks:
+                        # changed blocks and blocks of blank lines belong
+                        # to the child
+                        if t == '=':
+                            origins[b1:b2] = [(p, j) for j in xrange(a1, a2)]
+                            used = True
+                    if used and p not in texts:
+                        texts[p] = ptext
+                for i, j in queries:
+                    origin = origins[j]
+                    if origin is None:
+                        resolved.append((i, (f, j + 1)))
+                        continue
+                    p = origin[0]
+                    if p not in pending:
+                        pending[p] = []
+                        heapq.heappush(heap, (-linkrev(p), p))
+                    pending[p].append((i, origin[1]))
+            # parents no line was found in
+            for p in texts.keys():
+                if p not in pending:
+                    del texts[p]
+            for i, line in resolved:
+                result[i] = line
+            if resolved:
+                yield resolved
+        packed = pack(result)
+        self._put(base + (optskey,), packed)
+        self._write(repo, base + (optskey,), packed)
+
+    def annotate(self, repo, path, node, diffopts=None):
+        """Return the (source, line number) of the lines of the revision
+        node of path, as iterannotate() finds them"""
+        result = []
+        for lines in self.iterannotate(repo, path, node, diffopts):
+            result.extend(lines)
+        result.sort()
+        return [line for i, line in result]
+
+_caches = {}  # repository root: AnnotateCache
+_cacheslock = threading.Lock()
+
+def getcache(repo):
+    """Return the AnnotateCache shared by the views of repo"""
+    _cacheslock.acquire()
+    try:
+        cache = _caches.get(repo.root)
+        if cache is None:
+            cache = _caches[repo.root] = AnnotateCache()
+        return cache
+    finally:
+        _cacheslock.release()
+
+def iterannotate(fctx, diffopts=None):
+    """Yield lists of (line index, filectx, line number) resolving the
+    lines of fctx, as fctx.annotate(True, True, diffopts) annotates them,
+    using the cache of its repository
+
+    The lines coming from the latest revisions are yielded first, and the
+    annotation stops when the generator is no longer iterated.
+    """
+    repo = fctx._repo
+    if fctx.filenode() is None:
+        lines = fctx.annotate(True, True, diffopts)
+        yield [(i, l[0], l[1]) for i, (l, _text) in enumerate(lines)]
+        return
+    fctxs = {}
+    for lines in getcache(repo).iterannotate(repo, fctx.path(),
+                                             fctx.filenode(), diffopts):
+        result = []
+        for i, (src, lineno) in lines:
+            if src not in fctxs:
+                fctxs[src] = repo.filectx(src[0], fileid=src[1])
+            result.append((i, fctxs[src], lineno))
+        yield result
+
+def annotate(fctx, diffopts=None):
+    """Return the (filectx, line number) of the lines of fctx, as
+    iterannotate() finds them"""
+    result = []
+    for lines in iterannotate(fctx, diffopts):
+        result.extend(lines)
+    result.sort(key=lambda l: l[0])
+    return [(linkfctx, lineno) for i, linkfctx, lineno in result]
@@ -7,9 +7,10 @@
 
 import os
 import sys
+import time
 
-from mercurial import hg, util, ui, node, merge, error, scmutil
-from tortoisehg.util import paths, debugthg, hglib
+from mercurial import hg, util, ui, node, merge, error
+from tortoisehg.util import paths, debugthg, hglib, statusengine
 
 debugging = False
 enabled = True
@@ -59,12 +60,54 @@ ROOT = "r"
 UNRESOLVED = 'U'
 
 # file status cache
-overlay_cache = {}
-cache_tick_count = 0
+CACHE_REPOS = 8     # repositories whose states are kept
+repo_cache = []     # RepoStates, least recently used first
 cache_root = None
 cache_pdir = None
 
 
+class RepoStates(object):
+    """
+    Overlay states of the working directory of a repository, valid while
+    its dirstate, ignore and merge state files are unchanged.
+    """
+    def __init__(self, root, states, default=UNKNOWN, expires=None):
+        self.root = root
+        self.ident = _identity(root)
+        self.started = time.time()
+        self.states = states
+        self.default = default
+        self.expires = expires  # for failures, in ticks
+
+    def valid(self, path):
+        if self.expires is not None:
+            return GetTickCount() < self.expires
+        if _identity(self.root) != self.ident:
+            return False
+        # files edited or directory entries changed since status ran
+        try:
+            mtime = os.lstat(path).st_mtime
+        except OSError:
+            return path not in self.states
+        return mtime < self.started or mtime > time.time()
+
+    def get(self, path):
+        return self.states.get(path, self.default)
+
+
+def _identity(root):
+    ident = []
+    for path in (os.path.join(root, '.hg', 'dirstate'),
+                 os.path.join(root, '.hg', 'merge', 'state'),
+                 os.path.join(root, '.hgignore')):
+        try:
+            st = os.stat(path)
+            ident.append((st.st_size, st.st_mtime))
+        except OSError:
+            ident.append(None)
+    return tuple(ident)
+
+
 def add_dirs(list):
     dirs = set()
     if list:
@@ -91,96 +134,82 @@ def get_states(upath, repo=None):
     """
     Get the states of a given path in source control.
     """
-    global overlay_cache, cache_tick_count
     global cache_root, cache_pdir
-    global enabled, localonly
-    global includepaths, excludepaths
 
     #debugf("called: _get_state(%s)", path)
-    tc = GetTickCount()
-
     try:
         # handle some Asian charsets
         path = upath.encode('mbcs')
     except:
         path = upath
-     # check if path is cached
-    pdir = os.path.dirname(path)
-    status = overlay_cache.get(path, '')
-    if overlay_cache and (cache_pdir == pdir or cache_pdir and
-              status not in ' r' and path.startswith(cache_pdir)):
-        #use cached data when pdir has not changed or when the cached state is a repo state
-        if tc - cache_tick_count < CACHE_TIMEOUT:
-            if not status:
-                if os.path.isdir(os.path.join(path, '.hg')):
-                    add(path, ROOT)
-                    status = ROOT
-                else:
-                    status = overlay_cache.get(pdir + '*', NOT_IN_REPO)
-                    add(path, status)
-                debugf("%s: %s (cached~)", (path, status))
-            else:
-                debugf("%s: %s (cached)", (path, status))
-            return status
-        else:
-            debugf("Timed out!!")
-            overlay_cache.clear()
-            cache_tick_count = GetTickCount()
      # path is a drive
     if path.endswith(":\\"):
-        add(path, NOT_IN_REPO)
         return NOT_IN_REPO
-     # open repo
+     # find root, the one of the last directory unless path is a repo
+    pdir = os.path.dirname(path)
     if cache_pdir == pdir:
         root = cache_root
+        if os.path.isdir(os.path.join(path, '.hg')):
+            root = path
     else:
         debugf("find new root")
-        root = paths.find_root(path)
-        if root == path:
-            if not overlay_cache:
-                cache_root = pdir
-            add(path, ROOT)
-            debugf("%s: r", path)
-            return ROOT
-        cache_root = root
-        cache_pdir = pdir
-
+        root = paths.find_root_cached(path)
+        if root != path:
+            cache_root = root
+            cache_pdir = pdir
+    if root == path:
+        debugf("%s: r", path)
+        return ROOT
     if root is None:
         debugf("_get_state: not in repo")
-        overlay_cache = {None: None}
-        cache_tick_count = GetTickCount()
         return NOT_IN_REPO
     debugf("_get_state: root = " + root)
     hgdir = os.path.join(root, '.hg', '')
     if pdir == hgdir[:-1] or pdir.startswith(hgdir):
-        add(pdir, NOT_IN_REPO)
         return NOT_IN_REPO
-    try:
-        if not enabled:
-            overlay_cache = {None: None}
-            cache_tick_count = GetTickCount()
-            debugf("overlayicons disabled")
+    if not enabled:
+        debugf("overlayicons disabled")
+        return NOT_IN_REPO
+    if localonly and paths.netdrive_status(path):
+        debugf("%s: is a network drive", path)
+        return NOT_IN_REPO
+    if includepaths:
+        for p in includepaths:
+            if path.startswith(p):
+                break
+        else:
+            debugf("%s: is not in an include path", path)
             return NOT_IN_REPO
-        if localonly and paths.netdrive_status(path):
-            debugf("%s: is a network drive", path)
-            overlay_cache = {None: None}
-            cache_tick_count = GetTickCount()
+    for p in excludepaths:
+        if path.startswith(p):
+            debugf("%s: is in an exclude path", path)
             return NOT_IN_REPO
-        if includepaths:
-            for p in includepaths:
-                if path.startswith(p):
-                    break
-            else:
-                debugf("%s: is not in an include path", path)
-                overlay_cache = {None: None}
-                cache_tick_count = GetTickCount()
-                return NOT_IN_REPO
-        for p in excludepaths:
-            if path.startswith(p):
-                debugf("%s: is in an exclude path", path)
-                overlay_cache = {None: None}
-                cache_tick_count = GetTickCount()
-                return NOT_IN_REPO
+
+     # check if path is cached
+    for i in xrange(len(repo_cache) - 1, -1, -1):
+        entry = repo_cache[i]
+        if entry.root == root:
+            del repo_cache[i]
+            if entry.valid(path):
+                status = entry.get(path)
+                debugf("%s: %s (cached)", (path, status))
+                repo_cache.append(entry)
+                return status
+            debugf("%s: outdated", root)
+            break
+
+    entry = _get_repo_states(root, repo)
+    repo_cache.append(entry)
+    if len(repo_cache) > CACHE_REPOS:
+        del repo_cache[:len(repo_cache) - CACHE_REPOS]
+    status = entry.get(path)
+    debugf("%s: %s", (path, status))
+    return status
+
+
+def _get_repo_states(root, repo=None):
+    failed = GetTickCount() + CACHE_TIMEOUT
+    try:
         tc1 = GetTickCount()
         real = os.path.realpath #only test if necessary (symlink in path)
         if not repo or (repo.root != root and repo.root != real(root)):
@@ -188,34 +217,63 @@ def get_states(upath, repo=None):
             debugf("hg.repository() took %g ticks", (GetTickCount() - tc1))
     except error.RepoError:
         # We aren't in a working tree
-        debugf("%s: not in repo", pdir)
-        add(pdir + '*', IGNORED)
-        return IGNORED
+        debugf("%s: not in repo", root)
+        return RepoStates(root, {}, IGNORED, failed)
     except Exception, e:
-        debugf("error while handling %s:", pdir)
+        debugf("error while handling %s:", root)
         debugf(e)
-        add(pdir + '*', UNKNOWN)
-        return UNKNOWN
+        return RepoStates(root, {}, UNKNOWN, failed)
 
      # get file status
     tc1 = GetTickCount()
-
+    entry = RepoStates(root, {})
     try:
-        matcher = scmutil.match(repo[None], [pdir])
-        repostate = repo.status(match=matcher, ignored=True,
-                        clean=True, unknown=True)
+        entry.states = repo_states(repo, root)
     except util.Abort, inst:
         debugf("abort: %s", inst)
-        debugf("treat as unknown : %s", path)
-        return UNKNOWN
-
+        debugf("treat as unknown : %s", root)
+        return RepoStates(root, {}, UNKNOWN, failed)
     debugf("status() took %g ticks", (GetTickCount() - tc1))
+    return entry
+
+
+def invalidate(path=None):
+    """
+    Forget the states of the repository of path, or of all repositories.
+    """
+    if path is None:
+        del repo_cache[:]
+        return
+    repo_cache[:] = [e for e in repo_cache
+                     if path != e.root and
+                        not path.startswith(os.path.join(e.root, ''))]
+
+
+def repo_states(repo, root):
+    """
+    Return the states of root and of the files and directories of its
+    working directory, by absolute path.
+    """
+    if statusengine.supported(repo):
+        repostate, sizes = statusengine.status(
+            repo, ignored=True, clean=True, unknown=True,
+            cache=statusengine.getcache(repo))
+    else:
+        repostate = repo.status(ignored=True, clean=True, unknown=True)
+    return status_states(repo, root, [list(files) for files in repostate])
+
+
+def status_states(repo, root, repostate):
+    """
+    Return the states of the files of repostate, the status of repo, and of
+    their directories, by absolute path.
+    """
+    cache = {}
+    def add(path, state):
+        cache[path] = cache.get(path, '') + state
+
     mergestate = repo.dirstate.parents()[1] != node.nullid and \
               hasattr(merge, 'mergestate')
-
-    # cached file info
-    tc = GetTickCount()
-    overlay_cache = {}
     add(root, ROOT)
     add(os.path.join(root, '.hg'), NOT_IN_REPO)
     states = STATUS_STATES
@@ -234,11 +292,4 @@ def get_states(upath, repo=None):
         for f in grp:
             fpath = os.path.join(root, os.path.normpath(f))
             add(fpath, st)
-    status = overlay_cache.get(path, UNKNOWN)
-    debugf("%s: %s", (path, status))
-    cache_tick_count = GetTickCount()
-    return status
-
-
-def add(path, state):
-    overlay_cache[path] = overlay_cache.get(path, '') + state
+    return cache
@@ -0,0 +1,137 @@
+# changestats.py - number of files changed by revisions
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""number of files added, modified and removed by revisions, kept under
+.hg/cache/ as they are computed"""
+
+import array
+import marshal
+
+from mercurial import bundlerepo
+from mercurial.node import nullid
+
+CACHE_VERSION = 1
+
+def changecounts(repo, rev):
+    """Return the number of files added, modified and removed by rev,
+    compared to its first parent"""
+    ctx = repo[rev]
+    parents = ctx.parents()
+    if len(parents) > 1:
+        # files taken from the second parent are not listed by files()
+        modified, added, removed = repo.status(parents[0].node(),
+                                               ctx.node())[:3]
+        return len(added), len(modified), len(removed)
+    mf = ctx.manifest()
+    pmf = parents[0].manifest()
+    added = modified = removed = 0
+    for f in ctx.files():
+        if f in mf:
+            if f not in pmf:
+                added += 1
+            elif mf[f] != pmf[f] or mf.flags(f) != pmf.flags(f):
+                modified += 1
+        elif f in pmf:
+            removed += 1
+    return added, modified, removed
+
+class ChangeStats(object):
+    """Number of files added, modified and removed by each revision
+
+    Counts are filled in by the caller, typically from changecounts() run
+    by a worker, and are None until then.
+    """
+    _path = 'cache/thgchangestats'
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._clear()
+        self._load()
+        self.update()
+
+    def _clear(self):
+        self._counts = array.array('i')  # added, modified, removed per rev
+        self._tipnode = nullid
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._counts) // 3
+
+    def get(self, rev):
+        """Return (added, modified, removed) of rev or None if unknown"""
+        i = rev * 3
+        if rev < 0 or i >= len(self._counts) or self._counts[i] < 0:
+            return None
+        return tuple(self._counts[i:i + 3])
+
+    def __setitem__(self, rev, counts):
+        i = rev * 3
+        if 0 <= rev and i < len(self._counts):
+            self._counts[i:i + 3] = array.array('i', counts)
+            self._dirty = True
+
+    def pending(self):
+        """Return the revisions not counted yet, oldest first"""
+        counts = self._counts
+        return [i // 3 for i in xrange(0, len(counts), 3) if counts[i] < 0]
+
+    def update(self):
+        """Make room for revisions appended since, or for all of them if
+        revisions were removed"""
+        cl = self._repo.changelog
+        start = len(self)
+        if start > len(cl) or start and cl.node(start - 1) != self._tipnode:
+            self._clear()
+            start = 0
+        if start == len(cl):
+            return
+        self._counts.extend([-1] * ((len(cl) - start) * 3))
+        self._tipnode = cl.node(len(cl) - 1)
+        self._dirty = True
+
+    def _persistent(self):
+        return not isinstance(self._repo, bundlerepo.bundlerepository)
+
+    def _load(self):
+        if not self._persistent():
+            return
+        try:
+            f = self._repo.opener(self._path, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return
+        if (not isinstance(data, tuple) or len(data) != 3
+            or data[0] != CACHE_VERSION):
+            return
+        _version, tipnode, counts = data
+        try:
+            self._counts.fromstring(counts)
+        except (TypeError, ValueError):
+            self._clear()
+            return
+        if len(self._counts) % 3:
+            self._clear()
+            return
+        self._tipnode = tipnode
+
+    def save(self):
+        """Store the counts if some were changed"""
+        if not self._dirty or not self._persistent():
+            return
+        data = (CACHE_VERSION, self._tipnode, self._counts.tostring())
+        try:
+            f = self._repo.opener(self._path, 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+            self._dirty = False
+        except (EnvironmentError, ValueError):
+            pass
@@ -0,0 +1,195 @@
+# dirstatus.py - directory states of the working directory for overlays
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""directory states of the working directory for overlays
+
+The states of modified ('m'), added ('a') and removed or deleted ('r')
+files are kept in .hg/thgdirstatus, with the strongest state of the files
+below every directory, 'r' being the strongest and 'a' the weakest, so
+that overlay clients can tell the state of any directory by looking it up
+in the memory map of the file.
+
+The file starts with a header of struct format '>4sIQdII': the magic
+'THGD', the format version, the size and mtime of the dirstate when the
+states were computed, and the numbers of files and directories. It is
+followed by the uint32 offsets of the records of files then of
+directories, each sorted by path, and the records, made of the state and
+the path of a file or directory followed by '\\0'. The root directory is
+the empty path.
+
+Clients should unmap it quickly, since it may not be replaced while mapped
+on Windows.
+"""
+
+import mmap
+import os
+import struct
+
+from mercurial import scmutil
+
+FILENAME = 'thgdirstatus'
+VERSION = 1
+
+_header = '>4sIQdII'
+_headersize = struct.calcsize(_header)
+_offset = '>I'
+_offsetsize = struct.calcsize(_offset)
+
+_strength = {'a': 1, 'm': 2, 'r': 3}
+
+def filestates(status):
+    """Return the states of the files of a repository status by path"""
+    modified, added, removed, deleted = status[:4]
+    states = {}
+    for fn in added:
+        states[fn] = 'a'
+    for fn in modified:
+        states[fn] = 'm'
+    for fn in removed + deleted:
+        states[fn] = 'r'
+    return states
+
+def rollup(states):
+    """Return the strongest state of the files below each directory
+
+    >>> sorted(rollup({'a/b/c': 'm', 'a/d': 'a', 'e': 'r'}).items())
+    [('', 'r'), ('a', 'm'), ('a/b', 'm')]
+    """
+    dirs = {}
+    for fn, st in states.iteritems():
+        strength = _strength[st]
+        dn = fn
+        while dn:
+            dn = dn[:max(dn.rfind('/'), 0)]
+            if _strength.get(dirs.get(dn), 0) >= strength:
+                break  # so are its ancestors
+            dirs[dn] = st
+    return dirs
+
+def _dirstateidentity(repo):
+    try:
+        st = os.stat(repo.join('dirstate'))
+        return st.st_size, st.st_mtime
+    except OSError:
+        return 0, 0.0
+
+def _records(states):
+    paths = sorted(states)
+    return paths, ['%s%s\0' % (states[p], p) for p in paths]
+
+def pack(ident, states):
+    """Return the contents of the file for the file states"""
+    dirs = rollup(states)
+    files, filerecords = _records(states)
+    dirs, dirrecords = _records(dirs)
+    records = filerecords + dirrecords
+    offset = _headersize + _offsetsize * len(records)
+    offsets = []
+    for rec in records:
+        offsets.append(struct.pack(_offset, offset))
+        offset += len(rec)
+    header = struct.pack(_header, 'THGD', VERSION, ident[0], ident[1],
+                         len(files), len(dirs))
+    return ''.join([header] + offsets + records)
+
+class DirStatusFile(object):
+    """Memory map of the directory states of a repository, raising
+    EnvironmentError or ValueError if it cannot be read"""
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if len(self._map) < _headersize:
+            self.close()
+            raise ValueError('truncated directory states')
+        (magic, version, dssize, dsmtime, self._nfiles,
+         self._ndirs) = struct.unpack(_header, self._map[:_headersize])
+        if magic != 'THGD' or version != VERSION:
+            self.close()
+            raise ValueError('unsupported directory states')
+        self.dirstate = dssize, dsmtime
+
+    def _record(self, i):
+        start = _headersize + i * _offsetsize
+        offset = struct.unpack(_offset,
+                               self._map[start:start + _offsetsize])[0]
+        end = self._map.find('\0', offset)
+        return self._map[offset], self._map[offset + 1:end]
+
+    def get(self, path):
+        """Return the state of the directory of path relative to the root,
+        None if it has no changed files"""
+        lo, hi = self._nfiles, self._nfiles + self._ndirs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            st, dn = self._record(mid)
+            if dn < path:
+                lo = mid + 1
+            elif dn > path:
+                hi = mid
+            else:
+                return st
+        return None
+
+    def files(self):
+        """Return the states of the changed files by path"""
+        return dict((fn, st) for st, fn in
+                    map(self._record, xrange(self._nfiles)))
+
+    def dirs(self):
+        """Return the states of the directories with changed files"""
+        return dict((dn, st) for st, dn in
+                    map(self._record, xrange(self._nfiles,
+                                             self._nfiles + self._ndirs)))
+
+    def close(self):
+        self._map.close()
+
+def read(root):
+    """Return the DirStatusFile of the repository at root"""
+    return DirStatusFile(os.path.join(root, '.hg', FILENAME))
+
+def update(repo, files=None):
+    """Bring the directory states of repo up to date
+
+    If the paths relative to the root which changed are given in files and
+    nothing else changed the dirstate since the last update, only their
+    status is computed. Return the states of the changed files and whether
+    the whole working directory was checked.
+    """
+    oldident = oldstates = None
+    try:
+        old = DirStatusFile(repo.join(FILENAME))
+        try:
+            oldident, oldstates = old.dirstate, old.files()
+        finally:
+            old.close()
+    except (EnvironmentError, ValueError):
+        pass
+
+    full = (files is None or '' in files or oldstates is None
+            or oldident != _dirstateidentity(repo))
+    if full:
+        states = filestates(repo.status())
+    else:
+        m = scmutil.match(repo[None], ['path:' + f for f in files])
+        states = dict((fn, st) for fn, st in oldstates.iteritems()
+                      if not m(fn))
+        states.update(filestates(repo.status(match=m)))
+
+    # status may have written the dirstate
+    ident = _dirstateidentity(repo)
+    if ident != oldident or states != oldstates:
+        f = repo.opener(FILENAME, 'wb', atomictemp=True)
+        try:
+            f.write(pack(ident, states))
+        except:
+            f.discard()
+            raise
+        f.close()
+    return states, full
@@ -0,0 +1,304 @@
+# grepengine.py - search of file contents and history by a pool of processes
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""search of file contents and history by a pool of processes
+
+The files of a revision, or of the working directory, are split into
+shards searched by worker processes, each opening the repository once.
+Revisions are read from their filelog by the node found in the manifest,
+without creating changectx and filectx objects. Binary files are skipped
+before being split into lines, and so are files in which the pattern,
+compiled in multiline mode, matches nowhere, when this tells for sure that
+no line matches.
+
+The history of files is searched by walking their filelog, comparing
+the matching lines of each revision to the ones of its parent, so that
+only the lines added or removed are reported, and lines are only diffed
+for revisions in which the pattern matches.
+
+Worker processes are forked, so files are searched by the calling process
+on platforms without fork(), without the multiprocessing module, or when
+there are too few of them to pay for starting workers.
+"""
+
+import difflib
+import os
+import re
+
+from mercurial import error, hg, ui as uimod
+from mercurial.node import nullrev
+
+# constructs matching differently on a line and on the text around it
+_contextual = re.compile(r'\(\?<|\(\?=|\(\?!|\\A|\\Z')
+
+def prefilter(pattern, flags):
+    """Return a regexp matching a text if the given one matches any of its
+    lines, or None if there is no such regexp
+
+    >>> prefilter(r'^foo$', 0).search('bar\\nfoo\\n') is not None
+    True
+    >>> prefilter(r'foo(?!bar)', 0) is None
+    True
+    """
+    if _contextual.search(pattern):
+        return None
+    return re.compile(pattern, flags | re.MULTILINE)
+
+def matchlines(regexp, quickre, data, once=False):
+    """Return the (line number, line, match spans) of the lines of data
+    matched by regexp, or nothing if data is binary"""
+    if '\0' in data:
+        return []
+    # lines end at '\r' as well for splitlines()
+    if quickre and '\r' not in data and not quickre.search(data):
+        return []
+    found = []
+    for i, line in enumerate(data.splitlines()):
+        spans = [m.span() for m in regexp.finditer(line)]
+        # matches ending at the start of the line are not shown
+        if spans and spans[-1][1]:
+            found.append((i + 1, line, spans))
+            if once:
+                break
+    return found
+
+def searchfiles(repo, regexp, quickre, files, once=False):
+    """Search files, a list of (path, filenode) of which filenode is None
+    for files of the working directory
+
+    Return the (path, line number, line, match spans) of matching lines,
+    and the paths of files which could not be read.
+    """
+    matches = []
+    errors = []
+    for path, fnode in files:
+        try:
+            if fnode is None:
+                data = repo.wread(path)
+            else:
+                data = repo.file(path).read(fnode)
+        except EnvironmentError:
+            errors.append(path)
+            continue
+        found = matchlines(regexp, quickre, data, once)
+        matches.extend((path, lineno, line, spans)
+                       for lineno, line, spans in found)
+    return matches, errors
+
+def _difflines(a, b):
+    """Yield the removed and added lines between the (line number, line)
+    lists a and b"""
+    sm = difflib.SequenceMatcher(None, [l for n, l in a], [l for n, l in b])
+    for tag, alo, ahi, blo, bhi in sm.get_opcodes():
+        if tag in ('delete', 'replace'):
+            for lineno, line in a[alo:ahi]:
+                yield '-', lineno, line
+        if tag in ('insert', 'replace'):
+            for lineno, line in b[blo:bhi]:
+                yield '+', lineno, line
+
+def filehistory(repo, regexp, quickre, path, revs=None, follow=False):
+    """Search the revisions of a file linked to the changesets revs, or
+    to all of them
+
+    Return the (path, changeset revision, line number, change, line) of
+    the matching lines added (change '+') or removed ('-') by each
+    revision compared to its parent, latest revisions first. Revisions
+    are compared to the revision they were copied from if follow is True.
+    """
+    fl = repo.file(path)
+    states = {}  # filelog revision: matching (line number, line)
+    def linestates(fl, node):
+        data = fl.read(node)
+        return [(lineno, line) for lineno, line, spans
+                in matchlines(regexp, quickre, data)]
+    def parentstates(frev, node):
+        p1 = fl.parentrevs(frev)[0]
+        if p1 != nullrev:
+            if p1 not in states:
+                states[p1] = linestates(fl, fl.node(p1))
+            return states[p1]
+        copied = follow and fl.renamed(node)
+        if copied:
+            return linestates(repo.file(copied[0]), copied[1])
+        return []
+    changes = []
+    for frev in fl:
+        rev = fl.linkrev(frev)
+        if revs is not None and rev not in revs:
+            continue
+        node = fl.node(frev)
+        if frev not in states:
+            states[frev] = linestates(fl, node)
+        cur = states[frev]
+        prev = parentstates(frev, node)
+        if not cur and not prev:
+            continue
+        changes.extend((path, rev, lineno, change, line)
+                       for change, lineno, line in _difflines(prev, cur))
+    # stable sort, keeping the order of the changes of each revision
+    changes.sort(key=lambda c: c[1], reverse=True)
+    return changes
+
+def _ancestors(repo, startrev):
+    if startrev is None:
+        return None
+    return set(repo.changelog.ancestors([startrev], inclusive=True))
+
+def changedfiles(repo, startrev=None):
+    """Return the sorted paths of the files changed by the ancestors of
+    startrev, or by all changesets"""
+    cl = repo.changelog
+    revs = _ancestors(repo, startrev)
+    if revs is None:
+        revs = cl
+    files = set()
+    for rev in revs:
+        files.update(cl.read(cl.node(rev))[3])
+    return sorted(files)
+
+def _searchfiles(repo, shared, shard):
+    pattern, flags, once = shared
+    return searchfiles(repo, re.compile(pattern, flags),
+                       prefilter(pattern, flags), shard, once)
+
+def _searchhistory(repo, shared, shard):
+    pattern, flags, revs, follow = shared
+    regexp = re.compile(pattern, flags)
+    quickre = prefilter(pattern, flags)
+    changes = []
+    errors = []
+    for path in shard:
+        try:
+            changes.extend(filehistory(repo, regexp, quickre, path, revs,
+                                       follow))
+        except (EnvironmentError, error.LookupError, error.RevlogError):
+            errors.append(path)
+    return changes, errors
+
+_worker = {}  # state of a worker process
+
+def _initworker(root, shared):
+    _worker['root'] = root
+    _worker['shared'] = shared
+
+def _runshard(job):
+    func, shard = job
+    repo = _worker.get('repo')
+    if repo is None:
+        repo = _worker['repo'] = hg.repository(uimod.ui(), _worker['root'])
+    return func(repo, _worker['shared'], shard)
+
+class _ShardSearch(object):
+    """Iterator over the shards of items, giving for each of them its
+    length and the items of the result of func(repo, shared, shard),
+    computed by forked workers if there are enough items
+
+    Workers are stopped by close(), or once all shards are searched.
+    """
+
+    def __init__(self, repo, func, shared, items, shardsize, workers,
+                 minitems):
+        self._repo = repo
+        self._func = func
+        self._shared = shared
+        self._shards = [items[i:i + shardsize]
+                        for i in xrange(0, len(items), shardsize)]
+        self._next = 0
+        self._pool = None
+        self._pending = []  # results of the shards submitted to workers
+        self._submitted = 0
+        if len(items) < minitems or not hasattr(os, 'fork'):
+            return
+        try:
+            import multiprocessing
+        except ImportError:
+            return
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        if workers <= 1:
+            return
+        try:
+            self._pool = multiprocessing.Pool(workers, _initworker,
+                                              (repo.root, shared))
+        except OSError:
+            return
+        # a few shards ahead only, which are left to finish on close()
+        # since Pool.terminate() may hang while workers send results
+        self._ahead = workers * 2
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._next >= len(self._shards):
+            self.close()
+            raise StopIteration
+        shard = self._shards[self._next]
+        self._next += 1
+        if self._pool is None:
+            result = self._func(self._repo, self._shared, shard)
+        else:
+            while (self._submitted < len(self._shards)
+                   and len(self._pending) < self._ahead):
+                job = self._func, self._shards[self._submitted]
+                self._pending.append(self._pool.apply_async(_runshard,
+                                                            (job,)))
+                self._submitted += 1
+            try:
+                result = self._pending.pop(0).get()
+            except:
+                self.close()
+                raise
+        return (len(shard),) + tuple(result)
+
+    def close(self):
+        """Stop searching and the workers"""
+        self._next = len(self._shards)
+        pool = self._pool
+        if pool is None:
+            return
+        self._pool = None
+        self._pending = []
+        pool.close()
+        pool.join()
+
+def search(repo, ctx, regexp, paths, once=False, workers=None,
+           shardsize=64, minfiles=1000):
+    """Search the given files of ctx, a revision of repo
+
+    Return an iterator giving for each searched shard of them its number
+    of files, the matches and the paths of files which could not be read,
+    as searchfiles() returns them, in the order of paths. Its close()
+    method stops the search and the workers.
+    """
+    if ctx.rev() is None:
+        files = [(path, None) for path in paths]
+    else:
+        mf = ctx.manifest()
+        files = [(path, mf[path]) for path in paths]
+    shared = regexp.pattern, regexp.flags, once
+    return _ShardSearch(repo, _searchfiles, shared, files, shardsize,
+                        workers, minfiles)
+
+def searchhistory(repo, regexp, paths, startrev=None, workers=None,
+                  shardsize=8, minfiles=100):
+    """Search the history of the given files
+
+    Return an iterator giving for each searched shard of them its number
+    of files, the changes as filehistory() returns them and the paths of
+    files which could not be read, in the order of paths. Its close()
+    method stops the search and the workers.
+
+    If startrev is given, only its ancestors are searched and files are
+    followed across copies and renames.
+    """
+    revs = _ancestors(repo, startrev)
+    shared = regexp.pattern, regexp.flags, revs, startrev is not None
+    return _ShardSearch(repo, _searchhistory, shared, paths, shardsize,
+                        workers, minfiles)
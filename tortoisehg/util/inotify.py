@@ -0,0 +1,143 @@
+# inotify.py - minimal binding of the Linux inotify API
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""minimal ctypes binding of the Linux inotify API, raising OSError where
+it is not available"""
+
+import errno
+import os
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# changes of a directory entry or of a file content
+IN_DIRCHANGES = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                 | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+IN_FILECHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF
+                  | IN_MOVE_SELF)
+
+_IN_NONBLOCK = 0x800
+_IN_CLOEXEC = 0x80000
+
+_eventheader = 'iIII'  # wd, mask, cookie, len
+_eventheadersize = struct.calcsize(_eventheader)
+
+_libc = None
+_geterrno = None
+
+def _getlibc():
+    global _libc, _geterrno
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on %s'
+                          % sys.platform)
+        try:
+            import ctypes, ctypes.util
+        except ImportError:
+            raise OSError(errno.ENOSYS, 'inotify needs ctypes')
+        name = ctypes.util.find_library('c') or 'libc.so.6'
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            geterrno = ctypes.get_errno
+        except TypeError:
+            # Python < 2.6, errno read right after the call from libc
+            libc = ctypes.CDLL(name)
+            errnoloc = libc.__errno_location
+            errnoloc.restype = ctypes.POINTER(ctypes.c_int)
+            geterrno = lambda: errnoloc()[0]
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported by libc')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc, _geterrno = libc, geterrno
+    return _libc
+
+def _oserror(path=None):
+    err = _geterrno()
+    return OSError(err, os.strerror(err), path)
+
+def parseevents(data):
+    """Split raw inotify data into (wd, mask, name) tuples
+
+    >>> data = struct.pack(_eventheader, 1, IN_CREATE, 0, 8)
+    >>> data += 'wlock\\0\\0\\0'
+    >>> data += struct.pack(_eventheader, 2, IN_IGNORED, 0, 0)
+    >>> parseevents(data)
+    [(1, 256, 'wlock'), (2, 32768, '')]
+    """
+    events = []
+    pos = 0
+    while pos + _eventheadersize <= len(data):
+        wd, mask, _cookie, namelen = struct.unpack(
+            _eventheader, data[pos:pos + _eventheadersize])
+        pos += _eventheadersize
+        name = data[pos:pos + namelen].rstrip('\0')
+        pos += namelen
+        events.append((wd, mask, name))
+    return events
+
+class Inotify(object):
+    """Non-blocking inotify instance, to be polled when fileno() is
+    readable"""
+
+    def __init__(self):
+        self._fd = -1
+        libc = _getlibc()
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise _oserror()
+
+    def fileno(self):
+        return self._fd
+
+    def addwatch(self, path, mask):
+        """Watch path for events of mask and return its watch descriptor"""
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            raise _oserror(path)
+        return wd
+
+    def rmwatch(self, wd):
+        # fails if the path was removed, which stopped watching it anyway
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self):
+        """Return the pending (wd, mask, name) events"""
+        chunks = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            chunks.append(data)
+        return parseevents(''.join(chunks))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,161 @@
+# latesttags.py - latest global tags of revisions
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""latest global tags of all revisions, computed in one pass over the
+changelog and kept under .hg/cache/ so that only revisions appended
+since have to be computed next time"""
+
+import array
+import marshal
+
+from mercurial import bundlerepo, error, util
+from mercurial.node import nullid, nullrev
+
+CACHE_VERSION = 1
+
+class LatestTags(object):
+    """Latest global tags of each revision and distance to them
+
+    A revision having global tags gets them joined by ':', at distance 0.
+    Others get the greatest latest tags of their parents, one step further
+    than the closest parent having them. Revisions descending from no tag
+    get 'null'.
+    """
+    _path = 'cache/thglatesttags'
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._clear()
+        self._load()
+        self.update()
+
+    def _clear(self):
+        self._names = []  # distinct tags, joined by ':'
+        self._nameids = {}  # name: index in self._names
+        self._tags = array.array('i')  # rev: index in self._names
+        self._distances = array.array('i')  # rev: distance
+        self._tagsid = None
+        self._tipnode = nullid
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __getitem__(self, rev):
+        """Return (tags, distance) of rev"""
+        if rev == nullrev:
+            return 'null', 0
+        return self._names[self._tags[rev]], self._distances[rev]
+
+    def _nameid(self, name):
+        try:
+            return self._nameids[name]
+        except KeyError:
+            self._names.append(name)
+            i = self._nameids[name] = len(self._names) - 1
+            return i
+
+    def _globaltags(self):
+        repo = self._repo
+        cl = repo.changelog
+        revtags = {}
+        for name, node in repo.tags().iteritems():
+            if repo.tagtype(name) != 'global':
+                continue
+            try:
+                rev = cl.rev(node)
+            except error.LookupError:
+                continue
+            revtags.setdefault(rev, []).append(name)
+        return dict((rev, ':'.join(sorted(names)))
+                    for rev, names in revtags.iteritems())
+
+    def update(self):
+        """Compute the revisions appended since, or all of them if tags
+        were changed or revisions removed"""
+        cl = self._repo.changelog
+        revtags = self._globaltags()
+        tagsid = util.sha1(repr(sorted(revtags.iteritems()))).digest()
+        start = len(self._tags)
+        if (tagsid != self._tagsid or start > len(cl)
+            or start and cl.node(start - 1) != self._tipnode):
+            self._clear()
+            self._tagsid = tagsid
+            start = 0
+        if start == len(cl):
+            return
+
+        names = self._names
+        tags = self._tags
+        distances = self._distances
+        nulltag = self._nameid('null')
+        for rev in xrange(start, len(cl)):
+            if rev in revtags:
+                tags.append(self._nameid(revtags[rev]))
+                distances.append(0)
+                continue
+            best = None
+            for p in cl.parentrevs(rev):
+                if p == nullrev:
+                    if best is None:
+                        best = (nulltag, 0)
+                    continue
+                cand = (tags[p], distances[p])
+                if (best is None or names[cand[0]] > names[best[0]]
+                    or cand[0] == best[0] and cand[1] < best[1]):
+                    best = cand
+            tags.append(best[0])
+            distances.append(best[1] + 1)
+        self._tipnode = cl.node(len(cl) - 1)
+        self._save()
+
+    def _persistent(self):
+        return not isinstance(self._repo, bundlerepo.bundlerepository)
+
+    def _load(self):
+        if not self._persistent():
+            return
+        try:
+            f = self._repo.opener(self._path, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return
+        if (not isinstance(data, tuple) or len(data) != 6
+            or data[0] != CACHE_VERSION):
+            return
+        _version, tipnode, tagsid, names, tags, distances = data
+        try:
+            self._tags.fromstring(tags)
+            self._distances.fromstring(distances)
+        except (TypeError, ValueError):
+            self._clear()
+            return
+        if (len(self._tags) != len(self._distances)
+            or self._tags and max(self._tags) >= len(names)):
+            self._clear()
+            return
+        self._names = list(names)
+        self._nameids = dict((name, i) for i, name in enumerate(names))
+        self._tagsid = tagsid
+        self._tipnode = tipnode
+
+    def _save(self):
+        if not self._persistent():
+            return
+        data = (CACHE_VERSION, self._tipnode, self._tagsid,
+                tuple(self._names), self._tags.tostring(),
+                self._distances.tostring())
+        try:
+            f = self._repo.opener(self._path, 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+        except (EnvironmentError, ValueError):
+            pass
@@ -10,7 +10,7 @@ try:
 except ImportError:
     icon_path, bin_path, license_path, locale_path = None, None, None, None
 
-import os, sys
+import os, sys, threading, time
 
 def find_root(path=None):
     p = path or os.getcwd()
@@ -23,6 +23,95 @@ def find_root(path=None):
             return None
     return p
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class RootCache(object):
+    """Roots found by find_root() for paths, None included
+
+    An entry is valid while the mtimes of its path and of its parent
+    directory are unchanged, which tells that no .hg was created or removed
+    in them, while the .hg of its root is still a directory, and for timeout
+    seconds, after which repositories created or removed further up are
+    noticed. At most maxsize entries are kept.
+    """
+
+    def __init__(self, timeout=5.0, maxsize=10000):
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = {}  # path: (mtimes, expiry, root)
+
+    def find(self, paths):
+        """Return the roots of the repositories of paths, None for the ones
+        not in a repository; each directory is stat'ed at most once"""
+        now = time.time()
+        known = {}    # path: root, as walked by this call
+        checked = {}  # root: whether its .hg is a directory
+        self._lock.acquire()
+        try:
+            roots = [self._find(p, now, known, checked) for p in paths]
+            if len(self._entries) > self.maxsize:
+                self._entries.clear()
+            return roots
+        finally:
+            self._lock.release()
+
+    def _find(self, path, now, known, checked):
+        mtime = _mtime(path), _mtime(os.path.dirname(path))
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime and entry[1] > now:
+            root = entry[2]
+            if root is None or root == path:
+                return root
+            if root not in checked:
+                checked[root] = os.path.isdir(os.path.join(root, '.hg'))
+            if checked[root]:
+                return root
+        root = self._walk(path, known)
+        self._entries[path] = (mtime, now + self.timeout, root)
+        return root
+
+    def _walk(self, path, known):
+        chain = []
+        p = path
+        while p not in known:
+            chain.append(p)
+            if os.path.isdir(os.path.join(p, '.hg')):
+                root = p
+                break
+            parent = os.path.dirname(p)
+            if parent == p or not os.access(parent, os.R_OK):
+                root = None
+                break
+            p = parent
+        else:
+            root = known[p]
+        for p in chain:
+            known[p] = root
+        return root
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+_rootcache = RootCache()
+
+def find_roots(paths):
+    """Return find_root() of each of paths, from recent results when still
+    valid, stat'ing each of their ancestors at most once"""
+    return _rootcache.find(paths)
+
+def find_root_cached(path):
+    """Return find_root(path), from a recent result when still valid"""
+    return _rootcache.find([path])[0]
+
 def get_tortoise_icon(icon):
     "Find a tortoisehg icon"
     icopath = os.path.join(get_icon_path(), icon)
@@ -0,0 +1,153 @@
+# repopool.py - repository instances shared by background jobs
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""repository instances shared by background jobs
+
+A job acquires a repository instance of its own, only reads from it, and
+releases it when done. Released instances are kept for the next jobs on
+the same repository with the same settings, as long as its changelog and
+config are unchanged, saving the cost of reading config, loading
+extensions and parsing the changelog index again.
+"""
+
+import os
+import threading
+import weakref
+
+from mercurial import hg
+
+def _storepath(root):
+    hgpath = os.path.join(root, '.hg')
+    try:
+        f = open(os.path.join(hgpath, 'sharedpath'))
+        try:
+            hgpath = f.read().rstrip('\n')
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return os.path.join(hgpath, 'store')
+
+def _identity(root):
+    """Return what tells if a repository instance is still up-to-date"""
+    ident = []
+    for path in (os.path.join(_storepath(root), '00changelog.i'),
+                 os.path.join(root, '.hg', '00changelog.i'),
+                 os.path.join(root, '.hg', 'hgrc')):
+        try:
+            st = os.stat(path)
+            ident.append((st.st_size, st.st_mtime))
+        except OSError:
+            ident.append(None)
+    return tuple(ident)
+
+def _uikey(ui):
+    """Return what tells if an instance was opened with the settings of ui"""
+    return list(ui.walkconfig())
+
+class RepoPool(object):
+    """Repository instances checked out by one job at a time
+
+    Instances which are not released are simply dropped when no longer
+    referenced. At most `maxidle` released instances are kept, the least
+    recently used ones being dropped first.
+    """
+
+    def __init__(self, maxidle=4):
+        self.maxidle = maxidle
+        self._lock = threading.Lock()
+        # (root, ident, uikey, repo, ui), least recently used first
+        self._idle = []
+        # repo: (root, ident, uikey, ui)
+        self._inuse = weakref.WeakKeyDictionary()
+        self._opened = 0
+        self._reused = 0
+
+    def acquire(self, ui, root):
+        """Return a repository instance owned by the caller until it is
+        released"""
+        root = os.path.realpath(root)
+        ident = _identity(root)
+        uikey = _uikey(ui)
+        repo = None
+        self._lock.acquire()
+        try:
+            for i in xrange(len(self._idle) - 1, -1, -1):
+                eroot, eident, euikey, erepo, eui = self._idle[i]
+                if eroot != root or euikey != uikey:
+                    continue
+                del self._idle[i]
+                if eident == ident and repo is None:
+                    repo, repoui = erepo, eui
+                # others are outdated
+        finally:
+            self._lock.release()
+
+        if repo is None:
+            repo = hg.repository(ui, root)
+            repoui = repo.ui.copy()
+            reused = False
+        else:
+            # settings changed by the previous job, and what the changelog
+            # does not tell: dirstate, bookmarks, phases, tags
+            repo.ui = repoui.copy()
+            repo.invalidate()
+            repo.dirstate.invalidate()
+            reused = True
+        self._lock.acquire()
+        try:
+            self._inuse[repo] = (root, ident, uikey, repoui)
+            if reused:
+                self._reused += 1
+            else:
+                self._opened += 1
+        finally:
+            self._lock.release()
+        return repo
+
+    def release(self, repo):
+        """Make repo available to other jobs; it must not be used after"""
+        self._lock.acquire()
+        try:
+            entry = self._inuse.pop(repo, None)
+            if entry is None:
+                return
+            root, ident, uikey, repoui = entry
+            self._idle.append((root, ident, uikey, repo, repoui))
+            if len(self._idle) > self.maxidle:
+                del self._idle[:len(self._idle) - self.maxidle]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Drop the released instances"""
+        self._lock.acquire()
+        try:
+            del self._idle[:]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return the numbers of idle and checked out instances, and of
+        instances opened and reused since start"""
+        self._lock.acquire()
+        try:
+            return {'idle': len(self._idle), 'inuse': len(self._inuse),
+                    'opened': self._opened, 'reused': self._reused}
+        finally:
+            self._lock.release()
+
+_pool = RepoPool()
+
+def acquire(ui, root):
+    """Return a repository instance for a background job, to be passed to
+    release() once the job no longer uses it"""
+    return _pool.acquire(ui, root)
+
+def release(repo):
+    _pool.release(repo)
+
+def stats():
+    return _pool.stats()
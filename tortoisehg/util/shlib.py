@@ -62,7 +62,7 @@ if os.name == 'nt':
                                  shellcon.SHCNF_FLUSH,
                                  None, None)
 
-    def update_thgstatus(ui, root, wait=False):
+    def update_thgstatus(ui, root, wait=False, files=None):
         '''Rewrite the file .hg/thgstatus
 
         Caches the information provided by repo.status() in the file 
@@ -74,7 +74,11 @@ if os.name == 'nt':
         line consists of one char for the status of the directory (r, m or a),
         followed by the relative path of the directory in the repo. If the
         file .hg/thgstatus is empty, then the repo's working directory is
-        clean.
+        clean. The states of all ancestor directories are kept in
+        .hg/thgdirstatus as well, see dirstatus.
+
+        If the paths relative to root which changed are given in files, only
+        their status is checked when possible.
 
         Specify wait=True to wait until the system clock ticks to the next
         second before accessing Mercurial's dirstate. This is useful when
@@ -87,6 +91,7 @@ if os.name == 'nt':
         ensures that there are no unset entries left in .hg/dirstate when this
         function exits.
         '''
+        from tortoisehg.util import dirstatus as dirstatusmod
         if wait:
             tref = time.time()
             tdelta = float(int(tref)) + 1.0 - tref
@@ -96,20 +101,18 @@ if os.name == 'nt':
         repo = hg.repository(ui, root) # a fresh repo object is needed
         repo.bfstatus = True
         repo.lfstatus = True
-        repostate = repo.status() # will update .hg/dirstate as a side effect
+        # will update .hg/dirstate as a side effect
+        states = dirstatusmod.update(repo, files)[0]
         repo.bfstatus = False
         repo.lfstatus = False
-        modified, added, removed, deleted = repostate[:4]
 
         dirstatus = {}
         def dirname(f):
             return '/'.join(f.split('/')[:-1])
-        for fn in added:
-            dirstatus[dirname(fn)] = 'a'
-        for fn in modified:
-            dirstatus[dirname(fn)] = 'm'
-        for fn in removed + deleted:
-            dirstatus[dirname(fn)] = 'r'
+        # removed, modified and added in that order of preference
+        for fn, st in sorted(states.iteritems(),
+                             key=lambda e: 'amr'.index(e[1])):
+            dirstatus[dirname(fn)] = st
 
         update = False
         f = None
@@ -0,0 +1,313 @@
+# statusdaemon.py - overlay states served over a Unix domain socket
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""overlay states served over a Unix domain socket
+
+The daemon keeps the overlay states of cachethg for the whole working
+directory of the repositories it was asked about, and answers file manager
+extensions from them, so that they never run Mercurial in their own
+process. States are computed by an updater thread, update requests queued
+within a short delay being handled as one batch, as the overlay server
+does on Windows.
+
+A request is one connection, on which the client writes 'command|args',
+args being separated by '\\0', and shuts down writing. The reply, if any,
+is read until the end of the connection. Commands are:
+
+:states: reply the states of absolute paths, separated by '\\0' in the
+         same order; it is empty for paths of repositories not known yet,
+         whose states are then computed and announced by shell_notify();
+         states are computed again, meanwhile replying the previous ones,
+         once the dirstate, merge state or .hgignore of their repository
+         changed
+:update: compute the states of the repositories of paths again
+:remove: forget the states of the repositories of paths
+:terminate: stop the daemon
+"""
+
+import errno
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+from mercurial import ui as uimod
+from mercurial import error, util
+from tortoisehg.util import cachethg, paths, repopool, shlib
+
+def socketpath():
+    """Return the path of the socket of the daemon of the current user"""
+    path = os.environ.get('THG_STATUS_SOCKET')
+    if path:
+        return path
+    rundir = os.environ.get('XDG_RUNTIME_DIR')
+    if rundir and os.path.isdir(rundir):
+        return os.path.join(rundir, 'thg-status')
+    return os.path.join(os.path.expanduser('~'), '.tortoisehg', 'status')
+
+def formatrequest(cmd, args):
+    return '%s|%s' % (cmd, '\0'.join(args))
+
+def parserequest(req):
+    """Split a request into its command and arguments
+
+    >>> parserequest('states|/a\\0/b')
+    ('states', ['/a', '/b'])
+    >>> parserequest('terminate|')
+    ('terminate', [])
+    """
+    cmd, args = (req.split('|', 1) + [''])[:2]
+    return cmd, args and args.split('\0') or []
+
+def collectbatch(requests, args, delay=0.2):
+    """Return args and the arguments of the update requests queued within
+    delay; other requests are left in the queue"""
+    batch = list(args)
+    time.sleep(delay)
+    deferred = []
+    try:
+        while True:
+            req = requests.get_nowait()
+            cmd, args = parserequest(req)
+            if cmd == 'update':
+                batch.extend(args)
+            else:
+                deferred.append(req)
+    except Queue.Empty:
+        pass
+    for req in deferred:
+        requests.put(req)
+    return batch
+
+def repostates(ui, root):
+    """Return the overlay states of root and the files and directories of
+    its working directory, by absolute path"""
+    repo = repopool.acquire(ui, root)
+    try:
+        return cachethg.repo_states(repo, root)
+    finally:
+        repopool.release(repo)
+
+class StatusIndex(object):
+    """Overlay states of the working directories of repositories, computed
+    by an updater thread"""
+
+    def __init__(self, ui=None):
+        self._ui = ui or uimod.ui()
+        self._lock = threading.Lock()
+        self._states = {}  # root: {path: states}
+        self._failed = set()
+        self._identities = {}  # root: cachethg._identity() of the states
+        self._queued = set()  # roots whose states are requested
+        self.requests = Queue.Queue(0)
+
+    def states(self, files):
+        """Return the states of absolute paths, empty for the ones of
+        repositories whose states are not known yet"""
+        files = [os.path.normpath(f) for f in files]
+        roots = paths.find_roots(files)
+        identities = dict((root, cachethg._identity(root))
+                          for root in set(roots) if root is not None)
+        results = []
+        unknown = set()  # roots whose states are unknown or outdated
+        self._lock.acquire()
+        try:
+            for path, root in zip(files, roots):
+                if root is None:
+                    results.append(cachethg.NOT_IN_REPO)
+                    continue
+                states = self._states.get(root)
+                if (root in self._identities and root not in self._queued
+                    and self._identities[root] != identities[root]):
+                    unknown.add(root)
+                if root in self._failed:
+                    results.append(cachethg.UNKNOWN)
+                elif states is None:
+                    if root not in self._queued:
+                        unknown.add(root)
+                    results.append('')
+                elif path.startswith(os.path.join(root, '.hg', '')):
+                    results.append(cachethg.NOT_IN_REPO)
+                else:
+                    results.append(states.get(path, cachethg.UNKNOWN))
+            self._queued.update(unknown)
+        finally:
+            self._lock.release()
+        if unknown:
+            self.requests.put(formatrequest('update', sorted(unknown)))
+        return results
+
+    def update(self, batch):
+        """Compute the states of the repositories of paths in batch and
+        notify the shell of the ones which changed"""
+        roots = set(paths.find_roots([os.path.normpath(p) for p in batch]))
+        roots.discard(None)
+        changed = []
+        for root in sorted(roots):
+            # taken first so that changes made meanwhile are not missed
+            identity = cachethg._identity(root)
+            try:
+                states = repostates(self._ui, root)
+            except (EnvironmentError, error.Abort, error.ConfigError,
+                    error.RepoError, error.RevlogError), e:
+                self._ui.debug('failed updating %s (%s)\n' % (root, e))
+                states = None
+            self._lock.acquire()
+            try:
+                if states is None:
+                    isnew = root not in self._failed
+                    self._failed.add(root)
+                    self._states.pop(root, None)
+                else:
+                    isnew = self._states.get(root) != states
+                    self._failed.discard(root)
+                    self._states[root] = states
+                self._identities[root] = identity
+                self._queued.discard(root)
+            finally:
+                self._lock.release()
+            # the shell asks for states again, and may ask for an update
+            # which does not change anything and is not notified
+            if isnew:
+                changed.append(root)
+        if changed:
+            shlib.shell_notify(changed)
+
+    def remove(self, args):
+        roots = paths.find_roots([os.path.normpath(p) for p in args])
+        self._lock.acquire()
+        try:
+            for root in roots:
+                self._states.pop(root, None)
+                self._failed.discard(root)
+                self._identities.pop(root, None)
+        finally:
+            self._lock.release()
+
+class Updater(threading.Thread):
+    """Thread handling the update and remove requests of an index"""
+
+    def __init__(self, index):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.index = index
+
+    def run(self):
+        requests = self.index.requests
+        while True:
+            cmd, args = parserequest(requests.get())
+            if cmd == 'terminate':
+                return
+            elif cmd == 'update':
+                self.index.update(collectbatch(requests, args))
+            elif cmd == 'remove':
+                self.index.remove(args)
+
+def _recvall(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        req = _recvall(self.request)
+        cmd, args = parserequest(req)
+        if cmd == 'states':
+            reply = '\0'.join(self.server.index.states(args))
+            self.request.sendall(reply)
+        elif cmd in ('update', 'remove'):
+            self.server.index.requests.put(req)
+        elif cmd == 'terminate':
+            self.server.index.requests.put(req)
+            self.server.terminate()
+
+class StatusServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Server answering the requests of file managers from an index"""
+    address_family = getattr(socket, 'AF_UNIX', None)
+    daemon_threads = True
+
+    def __init__(self, path, index):
+        self.index = index
+        self.terminated = False
+        try:
+            SocketServer.TCPServer.__init__(self, path, _RequestHandler)
+        except:
+            if hasattr(self, 'socket'):
+                self.server_close()
+            raise
+
+    def server_bind(self):
+        SocketServer.TCPServer.server_bind(self)
+        os.chmod(self.server_address, 0600)
+
+    def serve(self):
+        """Handle requests until terminate() is called"""
+        while not self.terminated:
+            self.handle_request()
+
+    def terminate(self):
+        self.terminated = True
+        # wake up serve() waiting for a connection
+        request('states', (), self.server_address)
+
+def request(cmd, args=(), path=None):
+    """Send a request to the daemon and return its reply, or None if it is
+    not running"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path or socketpath())
+            sock.sendall(formatrequest(cmd, args))
+            sock.shutdown(socket.SHUT_WR)
+            return _recvall(sock)
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+
+def query(files, path=None):
+    """Return the states of absolute paths, or None if the daemon is not
+    running"""
+    if not files:
+        return []
+    reply = request('states', files, path)
+    if reply is None:
+        return None
+    return reply.split('\0')
+
+def serve(ui, path=None):
+    """Run the daemon until it is asked to terminate"""
+    path = path or socketpath()
+    if request('states', (), path) is not None:
+        raise util.Abort('status daemon already running on %s' % path)
+    try:
+        os.unlink(path)  # left by a daemon which did not terminate cleanly
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    index = StatusIndex(ui)
+    updater = Updater(index)
+    updater.start()
+    server = StatusServer(path, index)
+    ui.note('status daemon listening on %s\n' % path)
+    try:
+        server.serve()
+    finally:
+        server.server_close()
+        index.requests.put('terminate|')
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
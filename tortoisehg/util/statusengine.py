@@ -0,0 +1,391 @@
+# statusengine.py - working directory status walked by a pool of threads
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""working directory status walked by a pool of threads
+
+Directories are listed and their entries lstat'ed by worker threads,
+which release the GIL while waiting for the filesystem, while the calling
+thread classifies the entries against the dirstate as dirstate.status()
+does. Files which cannot be told clean from their lstat are compared by
+repo.status(). What was costly to find out can be kept in a StatusCache
+for the next walks.
+"""
+
+import marshal
+import os
+import Queue
+import stat
+import threading
+import time
+
+from mercurial import extensions, scmutil, util
+
+CACHE_VERSION = 1
+
+_rangemask = 0x7fffffff
+
+# extensions changing the status of files
+_statusextensions = ('largefiles', 'kbfiles', 'inotify')
+
+def supported(repo):
+    """Tell if status() reports the same files as repo.status() would"""
+    for name in _statusextensions:
+        try:
+            extensions.find(name)
+            return False
+        except KeyError:
+            pass
+    # names read from disk are not folded to the ones of the dirstate
+    return not repo.dirstate._checkcase
+
+def _listdir(path):
+    """Return (name, lstat) of the entries of path"""
+    entries = []
+    for name in os.listdir(path):
+        try:
+            st = os.lstat(os.path.join(path, name))
+        except OSError:
+            continue  # removed meanwhile
+        entries.append((name, st))
+    return entries
+
+def _isrepo(entries):
+    for name, st in entries:
+        if name == '.hg' and stat.S_ISDIR(st.st_mode):
+            return True
+    return False
+
+def _lstatfiles(paths):
+    """Return (path, lstat) of paths, lstat being None for missing ones"""
+    results = []
+    for path, fullpath in paths:
+        try:
+            st = os.lstat(fullpath)
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                st = None
+        except OSError:
+            st = None
+        results.append((path, st))
+    return results
+
+class _Workers(object):
+    """Threads calling functions, whose results are read in completion
+    order by the thread submitting them"""
+
+    def __init__(self, count):
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        self._pending = 0
+        self._threads = []
+        for i in xrange(count):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, arg, data=None):
+        self._pending += 1
+        self._tasks.put((func, arg, data))
+
+    def results(self):
+        """Yield (data, result, error) of the submitted calls, including the
+        ones submitted meanwhile; only EnvironmentError is not raised"""
+        while self._pending:
+            data, res, err = self._results.get()
+            self._pending -= 1
+            if err and not isinstance(err, EnvironmentError):
+                raise err
+            yield data, res, err
+
+    def close(self):
+        for t in self._threads:
+            self._tasks.put(None)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, arg, data = task
+            try:
+                self._results.put((data, func(arg), None))
+            except Exception, e:
+                self._results.put((data, None, e))
+
+def _ignoreidentity(repo):
+    """Return what tells if the ignore patterns are unchanged"""
+    files = [repo.wjoin('.hgignore')]
+    for name, path in repo.ui.configitems('ui'):
+        if name == 'ignore' or name.startswith('ignore.'):
+            files.append(util.expandpath(path))
+    ident = []
+    for path in files:
+        try:
+            st = os.stat(path)
+            ident.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            ident.append((path, None, None))
+    return tuple(ident)
+
+class StatusCache(object):
+    """What status() found costly to tell in its last walk
+
+    That is the status of files whose contents had to be compared, valid
+    while their dirstate entry and lstat are unchanged, and whether untracked
+    files and directories are ignored, valid while the ignore files are
+    unchanged. It is kept under .hg/cache/.
+
+    hits and misses count the files and directories whose status was reused
+    and computed again.
+    """
+    _path = 'cache/thgstatuscache'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ignoreid = None
+        self._lookups = {}  # path: (dirstate entry + lstat, status)
+        self._ignored = {}  # untracked path: whether it is ignored
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ignoreid):
+        """Return the (lookups, ignored) dicts, which must not be modified"""
+        self._lock.acquire()
+        try:
+            if ignoreid != self._ignoreid:
+                return self._lookups, {}
+            return self._lookups, self._ignored
+        finally:
+            self._lock.release()
+
+    def update(self, ignoreid, lookups, ignored, hits, misses):
+        """Replace the cached entries by the ones of the last walk"""
+        self._lock.acquire()
+        try:
+            if (misses or len(lookups) != len(self._lookups)
+                or len(ignored) != len(self._ignored)):
+                self._dirty = True
+            self._ignoreid = ignoreid
+            self._lookups = lookups
+            self._ignored = ignored
+            self.hits += hits
+            self.misses += misses
+        finally:
+            self._lock.release()
+
+    def load(self, repo):
+        try:
+            f = repo.opener(self._path, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return
+        if (not isinstance(data, tuple) or len(data) != 4
+            or data[0] != CACHE_VERSION):
+            return
+        _version, ignoreid, lookups, ignored = data
+        self.update(ignoreid, lookups, ignored, 0, 0)
+        self._dirty = False
+
+    def save(self, repo):
+        """Store the entries if they were changed"""
+        self._lock.acquire()
+        try:
+            if not self._dirty:
+                return
+            data = (CACHE_VERSION, self._ignoreid, self._lookups,
+                    self._ignored)
+            self._dirty = False
+        finally:
+            self._lock.release()
+        try:
+            f = repo.opener(self._path, 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+        except (EnvironmentError, ValueError):
+            pass
+
+_caches = {}  # repository root: StatusCache
+_cacheslock = threading.Lock()
+
+def getcache(repo):
+    """Return the StatusCache shared by the walks of repo"""
+    root = os.path.realpath(repo.root)
+    _cacheslock.acquire()
+    try:
+        cache = _caches.get(root)
+        if cache is None:
+            cache = _caches[root] = StatusCache()
+            cache.load(repo)
+        return cache
+    finally:
+        _cacheslock.release()
+
+def status(repo, ignored=False, clean=False, unknown=True, report=None,
+           workers=8, cache=None):
+    """Return the (modified, added, removed, deleted, unknown, ignored,
+    clean) lists of the working directory, and the size of listed files by
+    path
+
+    If given, report is called with lists of (path, status, size) as files
+    are classified, status being one of 'MAR!?IC' and size None for files
+    missing on disk. If a StatusCache is given, what it knows is reused and
+    it is updated.
+    """
+    listignored, listclean, listunknown = ignored, clean, unknown
+    dirstate = repo.dirstate
+    dmap = dirstate._map
+    copymap = dirstate._copymap
+    checkexec = dirstate._checkexec
+    ignore = dirstate._ignore
+    join = repo.wjoin
+
+    if cache is not None:
+        ignoreid = _ignoreidentity(repo)
+        oldlookups, oldignored = cache.get(ignoreid)
+    else:
+        oldlookups, oldignored = {}, {}
+    newlookups = {}
+    newignored = {}
+    lookupsigs = {}
+    counts = [0, 0]  # hits, misses
+    # contents may change again within the same second without changing
+    # the lstat of files modified since then
+    racytime = int(time.time()) - 1
+
+    lists = dict((st, []) for st in 'MAR!?IC')
+    listed = 'MAR!' + (listunknown and '?' or '') + (listignored and 'I' or '')
+    listed += listclean and 'C' or ''
+    sizes = {}
+    seen = set()
+    lookup = []
+    batch = []
+
+    def isignored(nf):
+        try:
+            ig = oldignored[nf]
+            counts[0] += 1
+        except KeyError:
+            ig = bool(ignore(nf))  # a match object with some versions
+            counts[1] += 1
+        newignored[nf] = ig
+        return ig
+
+    def add(fn, st, status):
+        if status not in listed:
+            return
+        lists[status].append(fn)
+        size = None
+        if st:
+            size = sizes[fn] = st.st_size
+        batch.append((fn, status, size))
+
+    def classify(fn, st):
+        seen.add(fn)
+        state, mode, size, time = dmap[fn]
+        if not st and state in 'nma':
+            add(fn, st, '!')
+        elif state == 'n':
+            mtime = int(st.st_mtime)
+            if (size >= 0 and
+                ((size != st.st_size and size != st.st_size & _rangemask)
+                 or ((mode ^ st.st_mode) & 0100 and checkexec))
+                or size == -2  # other parent
+                or fn in copymap):
+                add(fn, st, 'M')
+            elif time != mtime and time != mtime & _rangemask:
+                sig = (state, mode, size, time, st.st_size, st.st_mtime,
+                       st.st_mode)
+                cached = oldlookups.get(fn)
+                if cached and cached[0] == sig:
+                    counts[0] += 1
+                    newlookups[fn] = cached
+                    add(fn, st, cached[1])
+                else:
+                    counts[1] += 1
+                    if mtime < racytime:
+                        lookupsigs[fn] = sig
+                    lookup.append(fn)
+            else:
+                add(fn, st, 'C')
+        elif state == 'm':
+            add(fn, st, 'M')
+        elif state == 'a':
+            add(fn, st, 'A')
+        elif state == 'r':
+            add(fn, st, 'R')
+
+    def flush():
+        if report and batch:
+            report(batch[:])
+        del batch[:]
+
+    pool = _Workers(workers)
+    try:
+        pool.submit(_listdir, repo.root, ('', False))
+        for (nd, dirignored), entries, err in pool.results():
+            if err:
+                continue  # unreadable, its tracked files are seen below
+            if not nd:
+                entries = [e for e in entries if e[0] != '.hg']
+            elif _isrepo(entries):
+                continue  # files of another repository
+            for name, st in entries:
+                nf = nd and nd + '/' + name or name
+                if stat.S_ISDIR(st.st_mode):
+                    if nf in dmap:
+                        classify(nf, None)  # file replaced by directory
+                    subignored = dirignored or isignored(nf)
+                    if listignored or not subignored:
+                        pool.submit(_listdir, join(nf), (nf, subignored))
+                elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                    if nf in dmap:
+                        classify(nf, st)
+                    elif dirignored or isignored(nf):
+                        add(nf, st, 'I')
+                    else:
+                        add(nf, st, '?')
+                elif nf in dmap:
+                    classify(nf, None)
+            flush()
+
+        # tracked files in ignored directories, or missing
+        unseen = [(fn, join(fn)) for fn in dmap if fn not in seen]
+        for i in xrange(0, len(unseen), 256):
+            pool.submit(_lstatfiles, unseen[i:i + 256])
+        for _data, results, _err in pool.results():
+            for fn, st in results:
+                classify(fn, st)
+            flush()
+    finally:
+        pool.close()
+
+    if lookup:
+        # same size and mode but different mtime, compare contents
+        s = repo.status(match=scmutil.matchfiles(repo, lookup), clean=True)
+        for status, files in (('M', s[0]), ('!', s[3]), ('C', s[6])):
+            for fn in files:
+                try:
+                    st = os.lstat(join(fn))
+                except OSError:
+                    st = None
+                add(fn, st, status)
+                if fn in lookupsigs and status != '!':
+                    newlookups[fn] = (lookupsigs[fn], status)
+        flush()
+
+    if cache is not None:
+        cache.update(ignoreid, newlookups, newignored, *counts)
+        cache.save(repo)
+        repo.ui.debug('status cache: %d hits, %d misses\n' % tuple(counts))
+
+    return ([sorted(lists[st]) for st in 'MAR!?IC'], sizes)
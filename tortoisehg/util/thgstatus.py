@@ -7,23 +7,56 @@
 
 '''update TortoiseHg status cache'''
 
-from mercurial import hg
-from tortoisehg.util import paths, shlib
+from mercurial import hg, scmutil
+from tortoisehg.util import dirstatus, paths, shlib, statusdaemon
 import os
+import time
 
 def cachefilepath(repo):
     return repo.join("thgstatus")
 
+def benchmark(ui, repo, files):
+    '''report how long updating and reading the directory states take'''
+    def timed(func, *args):
+        start = time.time()
+        result = func(*args)
+        return time.time() - start, result
+
+    elapsed, (states, full) = timed(dirstatus.update, repo)
+    ui.status("full update: %.3fs, %d changed files\n"
+              % (elapsed, len(states)))
+    if not files:
+        # as if the directories of changed files were notified
+        files = sorted(set(f[:max(f.rfind('/'), 0)] for f in states))
+    if files:
+        elapsed, (states, full) = timed(dirstatus.update, repo, files)
+        ui.status("update of %d paths: %.3fs (%s)\n"
+                  % (len(files), elapsed, full and 'full' or 'incremental'))
+
+    def readall():
+        f = dirstatus.read(repo.root)
+        try:
+            dirs = dirstatus.rollup(states)
+            for dn in dirs:
+                f.get(dn)
+            return dirs
+        finally:
+            f.close()
+    elapsed, dirs = timed(readall)
+    ui.status("read of %d directory states: %.3fs\n" % (len(dirs), elapsed))
+
 def run(_ui, *pats, **opts):
 
+    if opts.get('daemon'):
+        statusdaemon.serve(_ui)
+        return
+
     if opts.get('all'):
-        roots = []
         base = os.getcwd()
-        for f in os.listdir(base):
-            r = paths.find_root(os.path.join(base, f))
-            if r is not None:
-                roots.append(r)
-        for r in roots:
+        roots = set(paths.find_roots([os.path.join(base, f)
+                                      for f in os.listdir(base)]))
+        roots.discard(None)
+        for r in sorted(roots):
             _ui.note("%s\n" % r) 
             shlib.update_thgstatus(_ui, r, wait=False)
             shlib.shell_notify([r])
@@ -45,6 +78,12 @@ def run(_ui, *pats, **opts):
             pass
         return
 
+    if opts.get('benchmark'):
+        files = [scmutil.canonpath(repo.root, repo.getcwd(), p)
+                 for p in pats]
+        benchmark(_ui, repo, files)
+        return
+
     if opts.get('show'):
         try:
             f = open(cachefilepath(repo), 'rb')
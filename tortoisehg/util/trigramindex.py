@@ -0,0 +1,304 @@
+# trigramindex.py - trigram index narrowing the files to search
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+"""trigram index narrowing the files to search
+
+The index tells which file revisions, identified by their filelog node,
+contain each sequence of three characters, compared case-insensitively.
+The literal strings a regular expression requires are split into
+trigrams, and only files whose revision contains all of them, or which
+were not indexed, may match.
+
+The files of the working directory parent, and the ones changed by the
+changesets added since, are indexed in the background, so files of the
+working directory unchanged since its parent and of the revisions near it
+are narrowed. The index is kept under .hg/cache/.
+"""
+
+import array
+import itertools
+import marshal
+import sre_constants
+import sre_parse
+import threading
+
+from mercurial import node as nodemod
+
+CACHE_VERSION = 1
+
+# files bigger than this are not indexed, thus always searched
+MAXSIZE = 1 << 20
+
+# at most this many changesets added since the last update are indexed
+MAXREVS = 1000
+
+def trigrams(data):
+    """Return the set of lowercase trigrams of data
+
+    >>> sorted(trigrams('FooBar'))
+    ['bar', 'foo', 'oba', 'oob']
+    """
+    data = data.lower()
+    return set(itertools.imap(''.join,
+                              itertools.izip(data, data[1:], data[2:])))
+
+def _clauses(code):
+    """Return the trigrams required by the parsed pattern code, as a list of
+    clauses which must all be satisfied, by any of their alternative sets
+    of trigrams"""
+    clauses = []
+    run = []
+    def flush():
+        if len(run) >= 3:
+            clauses.append([trigrams(''.join(run))])
+        del run[:]
+    for op, av in code:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+            continue
+        flush()
+        if op == sre_constants.SUBPATTERN:
+            clauses.extend(_clauses(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] >= 1:
+                clauses.extend(_clauses(av[2]))
+        elif op == sre_constants.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                # nested alternatives are dropped, which is looser
+                required = set()
+                for alts in _clauses(branch):
+                    if len(alts) == 1:
+                        required |= alts[0]
+                if not required:
+                    break
+                alternatives.append(required)
+            else:
+                clauses.append(alternatives)
+    flush()
+    return clauses
+
+def query(pattern, flags=0):
+    """Return the trigrams any line matched by pattern contains, as
+    _clauses() does
+
+    >>> [map(sorted, c) for c in query('(foo|bar)+.*bazz?')]
+    [[['foo'], ['bar']], [['baz']]]
+    >>> query('ab.*cd')
+    []
+    """
+    try:
+        code = sre_parse.parse(pattern, flags)
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return []
+    return _clauses(code)
+
+class TrigramIndex(object):
+    """Trigrams of indexed file revisions"""
+    _path = 'cache/thgtrigrams'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}      # filelog node: document id
+        self._postings = {}  # trigram: array of document ids
+        self._parent = nodemod.nullid  # working parent whose files are in
+        self._tip = (-1, nodemod.nullid)  # last changeset whose files are in
+        self._dirty = False
+        self._updater = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _docsmatching(self, clauses):
+        result = None
+        for alts in clauses:
+            matched = set()
+            for tris in alts:
+                postings = [self._postings.get(t) for t in tris]
+                if None in postings:
+                    continue
+                postings.sort(key=len)
+                docs = set(postings[0])
+                for p in postings[1:]:
+                    if not docs:
+                        break
+                    docs.intersection_update(p)
+                matched |= docs
+            if result is None:
+                result = matched
+            else:
+                result &= matched
+        return result
+
+    def candidates(self, ctx, regexp, files):
+        """Return the files of ctx in which regexp may match"""
+        clauses = query(regexp.pattern, regexp.flags)
+        if not clauses:
+            return files
+        mf = ctx.manifest()
+        self._lock.acquire()
+        try:
+            docs = self._docsmatching(clauses)
+            result = []
+            for f in files:
+                # modified files of the working directory have no node
+                docid = self._docs.get(mf.get(f))
+                if docid is None or docid in docs:
+                    result.append(f)
+            return result
+        finally:
+            self._lock.release()
+
+    def _pending(self, repo):
+        """Return the (path, filelog node) to index and the working parent
+        and tip they are up-to-date with"""
+        cl = repo.changelog
+        parent = repo.dirstate.parents()[0]
+        files = set()
+        if parent != self._parent:
+            files.update(repo[parent].manifest().iteritems())
+        tiprev, tipnode = self._tip
+        if tiprev < 0 or tiprev >= len(cl) or cl.node(tiprev) != tipnode:
+            tiprev = len(cl) - 1  # index history from now on
+        for rev in xrange(max(tiprev + 1, len(cl) - MAXREVS), len(cl)):
+            ctx = repo[rev]
+            mf = ctx.manifest()
+            for f in ctx.files():
+                if f in mf:
+                    files.add((f, mf[f]))
+        tip = len(cl) - 1, cl.tip()
+        return [e for e in files if e[1] not in self._docs], parent, tip
+
+    def update(self, repo):
+        """Index the files of the working parent of repo and of the
+        changesets added since the last update"""
+        files, parent, tip = self._pending(repo)
+        batch = []
+        for f, n in sorted(files):
+            fl = repo.file(f)
+            try:
+                if fl.size(fl.rev(n)) > MAXSIZE:
+                    continue
+                data = fl.read(n)
+            except (LookupError, EnvironmentError):
+                continue
+            if '\0' in data:
+                continue
+            batch.append((n, trigrams(data)))
+            if len(batch) >= 256:
+                self._add(batch)
+                batch = []
+        self._add(batch)
+        self._lock.acquire()
+        try:
+            self._dirty = self._dirty or (self._parent, self._tip) != (
+                parent, tip)
+            self._parent, self._tip = parent, tip
+        finally:
+            self._lock.release()
+
+    def _add(self, batch):
+        self._lock.acquire()
+        try:
+            for n, tris in batch:
+                if n in self._docs:
+                    continue
+                docid = self._docs[n] = len(self._docs)
+                for t in tris:
+                    p = self._postings.get(t)
+                    if p is None:
+                        p = self._postings[t] = array.array('I')
+                    p.append(docid)
+                self._dirty = True
+        finally:
+            self._lock.release()
+
+    def updateasync(self, ui, root):
+        """Update the index and save it in a background thread, unless it
+        is being updated"""
+        from tortoisehg.util import repopool
+        def run():
+            try:
+                repo = repopool.acquire(ui, root)
+                try:
+                    self.update(repo)
+                    self.save(repo)
+                finally:
+                    repopool.release(repo)
+            except Exception, e:
+                ui.debug('trigram index update failed: %s\n' % e)
+        self._lock.acquire()
+        try:
+            if self._updater and self._updater.isAlive():
+                return
+            self._updater = threading.Thread(target=run)
+            self._updater.setDaemon(True)
+            self._updater.start()
+        finally:
+            self._lock.release()
+
+    def load(self, repo):
+        try:
+            f = repo.opener(self._path, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return
+        if (not isinstance(data, tuple) or len(data) != 5
+            or data[0] != CACHE_VERSION):
+            return
+        _version, parent, tip, docs, postings = data
+        for t, p in postings.iteritems():
+            a = array.array('I')
+            a.fromstring(p)
+            postings[t] = a
+        self._lock.acquire()
+        try:
+            self._parent, self._tip = parent, tip
+            self._docs, self._postings = docs, postings
+            self._dirty = False
+        finally:
+            self._lock.release()
+
+    def save(self, repo):
+        """Store the index if it was changed"""
+        self._lock.acquire()
+        try:
+            if not self._dirty:
+                return
+            postings = dict((t, p.tostring())
+                            for t, p in self._postings.iteritems())
+            data = (CACHE_VERSION, self._parent, self._tip, self._docs,
+                    postings)
+            self._dirty = False
+        finally:
+            self._lock.release()
+        try:
+            f = repo.opener(self._path, 'wb', atomictemp=True)
+            try:
+                f.write(marshal.dumps(data))
+            except:
+                f.discard()
+                raise
+            f.close()
+        except (EnvironmentError, ValueError):
+            pass
+
+_indexes = {}  # repository root: TrigramIndex
+_indexeslock = threading.Lock()
+
+def getindex(repo):
+    """Return the TrigramIndex of repo, loaded from its cache"""
+    _indexeslock.acquire()
+    try:
+        index = _indexes.get(repo.root)
+        if index is None:
+            index = _indexes[repo.root] = TrigramIndex()
+            index.load(repo)
+        return index
+    finally:
+        _indexeslock.release()